@@ -2,6 +2,7 @@ import os
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from SegmentRegistrationLib import DistanceMapRegistrationLogic, AsyncPipeline, StageProfiler, VolumeResampler, SegmentRasterizer, MomentAlignment, DisplacementFieldCache, OverlapMetrics, SurfaceDistanceMetrics, FiducialErrors, DicomStudyExporter, NodeRegistry, SceneEventCounter, SubjectHierarchyPatientIndex
 import logging
 
 invalidShItemID = slicer.vtkMRMLSubjectHierarchyNode.GetInvalidItemID()
@@ -22,7 +23,7 @@ class ProstateMRIUSContourPropagation(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "Prostate MRI-US Contour Propagation"
     self.parent.categories = ["Radiotherapy"]
-    self.parent.dependencies = ["DicomRtImportExport", "SubjectHierarchy", "Segmentations", "CropVolume", "BRAINSFit", "DistanceMapBasedRegistration", "SegmentComparison"]
+    self.parent.dependencies = ["DicomRtImportExport", "SubjectHierarchy", "Segmentations", "CropVolume", "BRAINSFit", "DistanceMapBasedRegistration", "SegmentComparison", "SegmentRegistration"]
     self.parent.contributors = ["Csaba Pinter (Queen's)"]
     self.parent.helpText = """
     Contour propagation for prostate MRI scans to US images for brachytherapy tumor tracking
@@ -154,6 +155,22 @@ class ProstateMRIUSContourPropagationWidget(ScriptedLoadableModuleWidget):
     self.registrationCollapsibleButtonLayout.addRow(self.performRegistrationButton)
     self.performRegistrationButton.connect('clicked()', self.onPerformRegistration)
 
+    # Registration progress bar and cancel button (only shown while registration is in progress)
+    self.registrationProgressLayout = qt.QHBoxLayout()
+    self.registrationProgressBar = qt.QProgressBar()
+    self.registrationProgressBar.name = "registrationProgressBar"
+    self.registrationProgressBar.setRange(0, 100)
+    self.registrationProgressLayout.addWidget(self.registrationProgressBar)
+    self.cancelRegistrationButton = qt.QPushButton("Cancel")
+    self.cancelRegistrationButton.toolTip = "Stop registration after the current step"
+    self.cancelRegistrationButton.name = "cancelRegistrationButton"
+    self.registrationProgressLayout.addWidget(self.cancelRegistrationButton)
+    self.cancelRegistrationButton.connect('clicked()', self.onCancelRegistration)
+    self.registrationProgressWidget = qt.QWidget()
+    self.registrationProgressWidget.setLayout(self.registrationProgressLayout)
+    self.registrationProgressWidget.visible = False
+    self.registrationCollapsibleButtonLayout.addRow(self.registrationProgressWidget)
+
     # MR DICOM export button
     self.mrDicomExportButton = qt.QPushButton("Export deformed MRI study to DICOM")
     self.mrDicomExportButton.toolTip = "Initiate export of the deformed MRI study containing the image and structures into DICOM files on local storage"
@@ -331,12 +348,34 @@ class ProstateMRIUSContourPropagationWidget(ScriptedLoadableModuleWidget):
 
   #------------------------------------------------------------------------------
   def onPerformRegistration(self):
-    qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
+    # Run registration in the background so that the application stays responsive
+    if not self.logic.performRegistrationAsync(self.onRegistrationProgress, self.onRegistrationFinished):
+      return
+    self.performRegistrationButton.enabled = False
+    self.registrationProgressBar.value = 0
+    self.registrationProgressBar.setFormat('%p%')
+    self.cancelRegistrationButton.enabled = True
+    self.registrationProgressWidget.visible = True
 
-    if self.logic.performRegistration():
-      self.onRegistrationSuccessful()
+  #------------------------------------------------------------------------------
+  def onRegistrationProgress(self, stageName, stageIndex, numberOfStages, overallProgress):
+    self.registrationProgressBar.value = int(overallProgress * 100)
+    self.registrationProgressBar.setFormat('%s (%d/%d): %%p%%' % (stageName, stageIndex+1, numberOfStages))
+
+  #------------------------------------------------------------------------------
+  def onCancelRegistration(self):
+    self.cancelRegistrationButton.enabled = False
+    self.registrationProgressBar.setFormat('Cancelling...')
+    self.logic.cancelRegistration()
 
-    qt.QApplication.restoreOverrideCursor()
+  #------------------------------------------------------------------------------
+  def onRegistrationFinished(self, success, cancelled):
+    self.registrationProgressWidget.visible = False
+    self.performRegistrationButton.enabled = True
+    if success:
+      self.onRegistrationSuccessful()
+    elif not cancelled:
+      qt.QMessageBox.critical(None, 'Registration failed', 'Registration failed. See application log for details.')
 
   #------------------------------------------------------------------------------
   def onMrDicomExport(self):
@@ -406,12 +445,7 @@ class ProstateMRIUSContourPropagationWidget(ScriptedLoadableModuleWidget):
       layoutManager = slicer.app.layoutManager()
       layoutManager.layout = slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView
       tableView = layoutManager.tableWidget(0).tableView()
-      tableView.setMRMLTableNode(self.logic.diceTableNode)
-      # First four rows contain input information
-      tableView.hideRow(0)
-      tableView.hideRow(1)
-      tableView.hideRow(2)
-      tableView.hideRow(3)
+      tableView.setMRMLTableNode(self.logic.similarityMetricsTableNode)
       tableView.setColumnWidth(0,120)
     else:
       logging.error('Similarity calculation failed')
@@ -424,7 +458,7 @@ class ProstateMRIUSContourPropagationWidget(ScriptedLoadableModuleWidget):
       layoutManager.layout = slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView
       tableView = layoutManager.tableWidget(0).tableView()
       tableView.setMRMLTableNode(self.logic.fiducialErrorsTableNode)
-      # First four rows may have been hidden for segment similarity results
+      # First four rows may have been hidden for earlier results
       tableView.showRow(0)
       tableView.showRow(1)
       tableView.showRow(2)
@@ -459,22 +493,24 @@ class ProstateMRIUSContourPropagationWidget(ScriptedLoadableModuleWidget):
   def exit(self):
     pass
 
+  #------------------------------------------------------------------------------
+  def cleanup(self):
+    """Runs when the application is closed or the module is reloaded
+    """
+    self.logic.patientIndex.stop()
+
   #------------------------------------------------------------------------------
   def selectInitialPatients(self):
     mrPatientItemCandidate = invalidShItemID
     usPatientItemCandidate = invalidShItemID
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    children = vtk.vtkIdList()
-    shNode.GetItemChildren(shNode.GetSceneItemID(), children)
-    for i in range(children.GetNumberOfIds()):
-      child = children.GetId(i)
-      if shNode.GetItemLevel(child) == slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMLevelPatient():
-        # Try to guess patient selection by patient name
-        name = shNode.GetItemName(child)
-        if "US" in name and not usPatientItemCandidate:
-          usPatientItemCandidate = child
-        if "MR" in name and not mrPatientItemCandidate:
-          mrPatientItemCandidate = child
+    for patientItemID in self.logic.patientIndex.getPatientItemIDs():
+      # Try to guess patient selection by patient name
+      name = shNode.GetItemName(patientItemID)
+      if "US" in name and not usPatientItemCandidate:
+        usPatientItemCandidate = patientItemID
+      if "MR" in name and not mrPatientItemCandidate:
+        mrPatientItemCandidate = patientItemID
     # Select guess if available, select first patient as US otherwise
     if usPatientItemCandidate:
       self.usPatientItemCombobox.setCurrentItem(usPatientItemCandidate)
@@ -526,6 +562,9 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
 
     self.parsedUsPatientShItemID = invalidShItemID
     self.parsedMrPatientShItemID = invalidShItemID
+    # Index of the volume and segmentation nodes of the patients by modality, used for parsing the patients.
+    # Kept up to date from subject hierarchy events, so that selecting a patient does not walk its branch
+    self.patientIndex = SubjectHierarchyPatientIndex()
 
     self.mrVolumeNodeForExport = None
     self.mrSegmentationNodeForMrExport = None
@@ -533,26 +572,272 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     self.mrSegmentationNodeForUsExport = None
     # Flag determining whether the exported MR volume is resampled to match the US geometry or not
     self.resampleMrToUsGeometryForExport = False
-
+    # If enabled, then the MR volume is resampled to the US geometry for export slab by slab on a thread pool
+    # (see VolumeResampler.resampleToReferenceGeometry), so that the memory needed in addition to the input and
+    # output volumes stays bounded. Otherwise the whole volume is resampled in one step on an oriented image data copy
+    self.useSlabResamplingForExport = True
+    # Exporter writing the deformed studies to DICOM without the export dialog (when an output directory is given)
+    self.dicomStudyExporter = DicomStudyExporter()
+
+    self.preAlignmentMri2UsLinearTransform = None
     self.affineTransformNode = None
     self.bsplineTransformNode = None
     self.fiducialErrorsTableNode = None
     self.segmentComparisonNode = None
     self.diceTableNode = None
     self.hausdorffTableNode = None
+    self.similarityMetricsTableNode = None
+    # Flag determining whether the surface distance metrics (maximum, 95% Hausdorff, and mean distance) are added
+    # to the overlap metrics in the similarity metrics table
+    self.computeSurfaceDistanceMetrics = True
+    # Flag determining whether the Dice and Hausdorff tables of the Segment Comparison module are also computed
+    # for the prostate pair when calculating similarity (the similarity metrics table is always computed)
+    self.computeSegmentComparisonTables = False
 
     # Flag determining whether to keep temporary intermediate nodes in the scene
     # such as ROI, models, distance maps, smoothed volumes
     self.keepIntermediateNodes = False
 
+    # Logic performing the distance map based registration of the labelmaps
+    self.distanceMapRegistrationLogic = DistanceMapRegistrationLogic()
+
+    # Volumes are resampled in-process by default. If enabled, the Resample Scalar Volume CLI is used instead
+    self.useCliResampling = False
+    self.volumeResampler = VolumeResampler()
+    # If enabled, then only the region around the US prostate segment (determined the same way as the region for
+    # cropping the MRI) is resampled instead of the whole US volume. Only for in-process resampling
+    self.restrictUsResamplingToRoi = False
+    # If enabled, then only the prostate segments are rasterized, directly into the labelmap geometry.
+    # Otherwise the segmentations are cloned, hardened, and all their segments are converted to labelmap
+    self.useFastSegmentRasterization = True
+    # If enabled, then the labelmaps only cover the extent of the prostate segments on the cropped MR volume grid
+    # (only the voxels of the segments are rasterized). Only for fast segment rasterization
+    self.cropLabelmapsToSegmentExtent = True
+
+    # Pre-alignment of the MR prostate to the US prostate before registration:
+    # - 'BoundingBox': translation between the centers of the prostate bounding boxes
+    # - 'Moments': rigid transform aligning the centroids and principal axes of the prostates (see MomentAlignment)
+    self.preAlignmentMode = 'BoundingBox'
+
+    # Cache (StageCache) for the smoothed labelmap and distance map of the US prostate, for registering many MR contours
+    # (for example from several readers) to the same US prostate. If set, then the US prostate labelmap is created on the
+    # grid of the resampled US volume (instead of the cropped MR volume), so that it only depends on the US inputs
+    self.usDistanceMapCache = None
+
+    # Flag determining whether the deformable result is applied as a displacement field sampled from the B-spline
+    # transform around the US prostate (see DisplacementFieldCache), which is much faster to evaluate when reslicing
+    # the MR volume and converting the MR segmentation. The B-spline transform node is kept as the registration result
+    self.useDisplacementFieldCache = False
+    self.displacementFieldCache = DisplacementFieldCache()
+
+    # Pipeline running the registration asynchronously (see performRegistrationAsync)
+    self.registrationPipeline = None
+
+    # Wall time, CPU time, memory, and voxel counts of the stages of the last performRegistration or
+    # performRegistrationAsync call.
+    # See StageProfiler.getReport for the contents, and StageProfiler.writeReport for saving it
+    self.timingReport = None
+
+    # Registry of the nodes created by the running performRegistration call (None outside of it). Intermediate nodes
+    # are removed by the registry in one batch at the end of the run, also if the run fails
+    self.nodeRegistry = None
+    # Number and size of the released and leaked nodes of the last performRegistration call (see NodeRegistry.finish)
+    self.leakReport = None
+
+    # If enabled, then performRegistration runs in the batch processing state of the scene, so that observers (views,
+    # node selectors, subject hierarchy) are updated once at the end of the run instead of after each change of the
+    # scene. Unless intermediate nodes are kept, they are also hidden from the user interface and have no display nodes.
+    # performRegistrationAsync returns to the event loop between stages, so there each stage processed on the main
+    # thread runs in the batch processing state, and observers are updated once after the stage
+    self.useSceneBatchProcessing = True
+    # Flag determining whether the intermediate nodes of the running registration are hidden (set by performRegistration
+    # and performRegistrationAsync)
+    self.hideIntermediateNodes = False
+    # If enabled, then the MRML events invoked during performRegistration or performRegistrationAsync are counted (see
+    # sceneEventReport). Counting observes every node of the scene from Python, which is expensive on large scenes, so
+    # it is only meant for benchmarking
+    self.countSceneEvents = False
+    # Number of MRML events invoked during the last registration if counted (see SceneEventCounter.getReport)
+    self.sceneEventReport = None
+
+    # If enabled, then performRegistration and performRegistrationAsync compute the intermediate data that is not
+    # processed by CLIs (cropped MR volume, resampled US volume, labelmaps, cropped and smoothed labelmaps) in a private
+    # scratch scene, which is not observed by the user interface, and the MR volume is cropped in-process (no ROI and
+    # crop parameters nodes). Only the result transforms and the distance maps registered by BRAINSFit are added to
+    # the main scene. Not used if intermediate nodes are kept
+    self.useScratchScene = True
+    # Scratch scene of the running registration (set by performRegistration and performRegistrationAsync)
+    self.scratchScene = None
+
   #------------------------------------------------------------------------------
-  def performRegistration(self):
+  def performRegistration(self, caseId=None):
+    """Perform registration workflow and record timing report (see timingReport)
+    :param caseId: Identifier of the registered case stored in the timing report
+    """
     logging.info('Performing registration workflow')
-    self.cropMRI()
-    self.preAlignSegmentations()
-    self.resampleUS()
-    self.createProstateContourLabelmaps()
-    return self.performDistanceBasedRegistration()
+    profiler = StageProfiler('ProstateMRIUSContourPropagation', caseId)
+    self.nodeRegistry = NodeRegistry('ProstateMRIUSContourPropagation', caseId)
+    self.nodeRegistry.start()
+    sceneEventCounter = SceneEventCounter() if self.countSceneEvents else None
+    if sceneEventCounter is not None:
+      sceneEventCounter.start()
+    self.hideIntermediateNodes = self.useSceneBatchProcessing and not self.keepIntermediateNodes
+    self.distanceMapRegistrationLogic.hideIntermediateNodes = self.hideIntermediateNodes
+    if self.useScratchScene and not self.keepIntermediateNodes:
+      self.scratchScene = slicer.vtkMRMLScene()
+    self.distanceMapRegistrationLogic.scratchScene = self.scratchScene
+    if self.useSceneBatchProcessing:
+      slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      # Stages report failure by returning False
+      with profiler.measureStage('CropMRI', [self.mrVolumeNode]) as stage:
+        stage.setSuccess(self.cropMRI() is not False)
+        stage.setOutputNodes([self.mrCroppedVolumeNode])
+      with profiler.measureStage('PreAlignSegmentations', [self.mrSegmentationNode, self.usSegmentationNode]) as stage:
+        stage.setSuccess(self.preAlignSegmentations() is not False)
+      with profiler.measureStage('ResampleUS', [self.usVolumeNode]) as stage:
+        stage.setSuccess(self.resampleUS() is not False)
+        stage.setOutputNodes([self.usResampledVolumeNode])
+      with profiler.measureStage('CreateProstateContourLabelmaps', [self.usSegmentationNode, self.mrSegmentationNode]) as stage:
+        stage.setSuccess(self.createProstateContourLabelmaps() is not False)
+        stage.setOutputNodes([self.usProstateLabelmap, self.mrProstateLabelmap])
+      with profiler.measureStage('DistanceBasedRegistration', [self.usProstateLabelmap, self.mrProstateLabelmap]) as stage:
+        success = self.performDistanceBasedRegistration()
+        stage.setSuccess(success)
+    finally:
+      self.leakReport = self.nodeRegistry.finish(self.getResultNodes(), self.getIntermediateNodes(), not self.keepIntermediateNodes)
+      self.nodeRegistry = None
+      if not self.keepIntermediateNodes:
+        self.distanceMapRegistrationLogic.intermediateNodes = []
+      # Observers are updated once when the batch processing ends
+      if self.useSceneBatchProcessing:
+        slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+      self.hideIntermediateNodes = False
+      self.distanceMapRegistrationLogic.hideIntermediateNodes = False
+      if self.scratchScene is not None:
+        self.scratchScene.Clear(1)
+        self.scratchScene = None
+        self.distanceMapRegistrationLogic.scratchScene = None
+      if sceneEventCounter is not None:
+        sceneEventCounter.stop()
+        self.sceneEventReport = sceneEventCounter.getReport()
+      else:
+        self.sceneEventReport = None
+      # Also reported if a stage raised an exception, so that the report of a previous case is not kept
+      self.timingReport = profiler.getReport()
+    return success
+
+  #------------------------------------------------------------------------------
+  def getResultNodes(self):
+    """Get nodes created by the registration workflow that are kept in the scene
+    """
+    return [self.preAlignmentMri2UsLinearTransform, self.affineTransformNode, self.bsplineTransformNode]
+
+  #------------------------------------------------------------------------------
+  def getIntermediateNodes(self):
+    """Get temporary nodes created by the registration workflow
+    """
+    return [self.mrCroppedVolumeNode, self.usResampledVolumeNode, self.usProstateLabelmap, self.mrProstateLabelmap,
+      self.usVolumeHardenedNode, self.mrSegmentationHardenedNode, self.usSegmentationHardenedNode] \
+      + self.distanceMapRegistrationLogic.intermediateNodes
+
+  #------------------------------------------------------------------------------
+  def getIntermediateScene(self):
+    """Get scene for the intermediate nodes that are not processed by CLIs: the scratch scene of the running
+    registration if any, otherwise the main scene
+    """
+    return self.scratchScene if self.scratchScene is not None else slicer.mrmlScene
+
+  #------------------------------------------------------------------------------
+  def hideIntermediateNode(self, node):
+    """Hide intermediate node from the user interface and remove its display nodes if hideIntermediateNodes is set.
+    Hidden nodes are not added to subject hierarchy
+    """
+    if not self.hideIntermediateNodes:
+      return
+    node.SetHideFromEditors(True)
+    if node.IsA('vtkMRMLDisplayableNode'):
+      displayNodes = [node.GetNthDisplayNode(index) for index in range(node.GetNumberOfDisplayNodes())]
+      node.RemoveAllDisplayNodeIDs()
+      for displayNode in displayNodes:
+        if displayNode is not None and displayNode.GetScene() is not None:
+          displayNode.GetScene().RemoveNode(displayNode)
+
+  #------------------------------------------------------------------------------
+  def performRegistrationAsync(self, progressCallback=None, finishedCallback=None):
+    """Perform registration workflow without blocking the application.
+    The distance maps are computed on a worker thread, the registrations run as background CLIs, and the event loop is
+    processed between stages. The stages accessing the scene throughout (cropping the MRI, pre-alignment, creating the
+    labelmaps) run on the main thread.
+    :param progressCallback: Called as progressCallback(stageName, stageIndex, numberOfStages, overallProgress)
+    :param finishedCallback: Called as finishedCallback(success, cancelled) when the workflow ended
+    """
+    if self.registrationPipeline is not None and self.registrationPipeline.isRunning():
+      logging.error('Registration is already in progress')
+      return False
+    logging.info('Performing registration workflow asynchronously')
+    # The stages of the pipeline are measured from starting until their CLI or background task finished
+    profiler = StageProfiler('ProstateMRIUSContourPropagation')
+    sceneEventCounter = SceneEventCounter() if self.countSceneEvents else None
+    if sceneEventCounter is not None:
+      sceneEventCounter.start()
+    self.hideIntermediateNodes = self.useSceneBatchProcessing and not self.keepIntermediateNodes
+    self.distanceMapRegistrationLogic.hideIntermediateNodes = self.hideIntermediateNodes
+    if self.useScratchScene and not self.keepIntermediateNodes:
+      self.scratchScene = slicer.vtkMRMLScene()
+    self.distanceMapRegistrationLogic.scratchScene = self.scratchScene
+
+    def batchProcessed(stageFunction):
+      # The scene cannot stay in batch processing state while the event loop runs between stages, so each stage
+      # processed on the main thread is batched on its own
+      if not self.useSceneBatchProcessing:
+        return stageFunction
+      def stage():
+        slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+        try:
+          return stageFunction()
+        finally:
+          slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+      return stage
+
+    def onPipelineFinished(status):
+      self.timingReport = profiler.getReport()
+      if status != AsyncPipeline.Completed and not self.keepIntermediateNodes:
+        self.removeIntermedateNodes()
+      self.hideIntermediateNodes = False
+      self.distanceMapRegistrationLogic.hideIntermediateNodes = False
+      if self.scratchScene is not None:
+        self.scratchScene.Clear(1)
+        self.scratchScene = None
+        self.distanceMapRegistrationLogic.scratchScene = None
+      if sceneEventCounter is not None:
+        sceneEventCounter.stop()
+        self.sceneEventReport = sceneEventCounter.getReport()
+      else:
+        self.sceneEventReport = None
+      if finishedCallback is not None:
+        finishedCallback(status == AsyncPipeline.Completed, status == AsyncPipeline.Cancelled)
+
+    stages = [
+      ('Cropping MRI volume', batchProcessed(self.cropMRI)),
+      ('Pre-aligning segmentations', batchProcessed(self.preAlignSegmentations)),
+      ('Resampling US volume', lambda: self.resampleUS(waitForCompletion=False)),
+      ('Adding resampled US volume to study', batchProcessed(self.addResampledUSToStudy)),
+      ('Creating prostate contour labelmaps', batchProcessed(self.createProstateContourLabelmaps)),
+      ('Computing distance maps', lambda: self.prepareDistanceBasedRegistration(waitForCompletion=False)),
+      ('Affine registration', lambda: self.distanceMapRegistrationLogic.startAffineRegistration(
+        self.affineTransformNode, waitForCompletion=False, initialTransformNode=self.preAlignmentMri2UsLinearTransform)),
+      ('Deformable registration', lambda: self.distanceMapRegistrationLogic.startDeformableRegistration(
+        self.affineTransformNode, self.bsplineTransformNode, waitForCompletion=False)),
+      ('Cleaning up', batchProcessed(self.finalizeDistanceBasedRegistration)) ]
+    self.registrationPipeline = AsyncPipeline(stages, progressCallback, onPipelineFinished, profiler)
+    self.registrationPipeline.start()
+    return True
+
+  #------------------------------------------------------------------------------
+  def cancelRegistration(self):
+    if self.registrationPipeline is not None:
+      self.registrationPipeline.cancel()
 
   #------------------------------------------------------------------------------
   def parseUSPatient(self):
@@ -562,19 +847,8 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
       # Do not re-parse the patient, because any changed selection will be over-ridden by the default (which was not optimal, that's why the user changed it)
       return
     # Parse US patient
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    self.usVolumeNode = None
-    self.usSegmentationNode = None
-    usSeriesCollection = vtk.vtkCollection()
-    shNode.GetDataNodesInBranch(self.usPatientShItemID, usSeriesCollection)
-    for i in range(0,usSeriesCollection.GetNumberOfItems()):
-      currentDataNode = usSeriesCollection.GetItemAsObject(i)
-      if currentDataNode.IsA('vtkMRMLScalarVolumeNode') and not currentDataNode.IsA('vtkMRMLSegmentationNode'):
-        currentSeriesItemID = shNode.GetItemByDataNode(currentDataNode)
-        if shNode.GetItemAttribute(currentSeriesItemID, slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMSeriesModalityAttributeName()) == 'US':
-          self.usVolumeNode = currentDataNode
-      if currentDataNode.IsA('vtkMRMLSegmentationNode'):
-        self.usSegmentationNode = currentDataNode
+    self.usVolumeNode = self.patientIndex.getVolumeNode(self.usPatientShItemID, 'US')
+    self.usSegmentationNode = self.patientIndex.getSegmentationNode(self.usPatientShItemID)
     self.parsedUsPatientShItemID = self.usPatientShItemID
 
   #------------------------------------------------------------------------------
@@ -585,19 +859,8 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
       # Do not re-parse the patient, because any changed selection will be over-ridden by the default (which was not optimal, that's why the user changed it)
       return
     # Parse MRI patient
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    self.mrVolumeNode = None
-    self.mrSegmentationNode = None
-    mrSeriesCollection = vtk.vtkCollection()
-    shNode.GetDataNodesInBranch(self.mrPatientShItemID, mrSeriesCollection)
-    for i in range(0,mrSeriesCollection.GetNumberOfItems()):
-      currentDataNode = mrSeriesCollection.GetItemAsObject(i)
-      if currentDataNode.IsA('vtkMRMLScalarVolumeNode') and not currentDataNode.IsA('vtkMRMLSegmentationNode'):
-        currentSeriesItemID = shNode.GetItemByDataNode(currentDataNode)
-        if shNode.GetItemAttribute(currentSeriesItemID, slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMSeriesModalityAttributeName()) == 'MR':
-          self.mrVolumeNode = currentDataNode
-      if currentDataNode.IsA('vtkMRMLSegmentationNode'):
-        self.mrSegmentationNode = currentDataNode
+    self.mrVolumeNode = self.patientIndex.getVolumeNode(self.mrPatientShItemID, 'MR')
+    self.mrSegmentationNode = self.patientIndex.getSegmentationNode(self.mrPatientShItemID)
     self.parsedMrPatientShItemID = self.mrPatientShItemID
 
   #------------------------------------------------------------------------------
@@ -605,25 +868,32 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     logging.info('Cropping MRI volume')
     if not self.mrVolumeNode or not self.mrSegmentationNode:
       logging.error('Unable to access MR volume or segmentation')
+      return False
+
+    # Determine ROI position and size (add prostate width along RL axis, square slice, add height/2 along IS)
+    #TODO: Support tilted volumes
+    bounds = [0]*6
+    self.mrSegmentationNode.GetSegmentation().GetBounds(bounds)
+    roiBounds = VolumeResampler.computeStructureRoiBounds(bounds)
+
+    # With a scratch scene, crop in-process so that no ROI and crop parameters nodes are added to the scene (only
+    # if the MR volume is not transformed, in which case voxel based cropping does not depend on the transform)
+    if self.scratchScene is not None and self.mrVolumeNode.GetParentTransformNode() is None:
+      self.mrCroppedVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      self.mrCroppedVolumeNode.SetName(self.scratchScene.GenerateUniqueName(self.mrVolumeNode.GetName() + ' cropped'))
+      self.scratchScene.AddNode(self.mrCroppedVolumeNode)
+      if not self.volumeResampler.crop(self.mrVolumeNode, self.mrCroppedVolumeNode, roiBounds):
+        logging.error('Unable to crop MR volume')
+        return False
       return
 
     # Create ROI
     roiNode = slicer.vtkMRMLMarkupsROINode()
     roiNode.SetName('CropROI_' + self.mrVolumeNode.GetName())
+    self.hideIntermediateNode(roiNode)
     slicer.mrmlScene.AddNode(roiNode)
-
-    # Determine ROI position
-    bounds = [0]*6
-    self.mrSegmentationNode.GetSegmentation().GetBounds(bounds)
-    center = [(bounds[0]+bounds[1])/2, (bounds[2]+bounds[3])/2, (bounds[4]+bounds[5])/2]
-    roiNode.SetXYZ(center[0], center[1], center[2])
-
-    # Determine ROI size (add prostate width along RL axis, square slice, add height/2 along IS)
-    #TODO: Support tilted volumes
-    prostateLR3 = (bounds[1]-bounds[0]) * 3
-    prostateIS2 = (bounds[5]-bounds[4]) * 2
-    radius = [prostateLR3/2, prostateLR3/2, prostateIS2/2]
-    roiNode.SetRadiusXYZ(radius[0], radius[1], radius[2])
+    roiNode.SetXYZ((roiBounds[0]+roiBounds[1])/2, (roiBounds[2]+roiBounds[3])/2, (roiBounds[4]+roiBounds[5])/2)
+    roiNode.SetRadiusXYZ((roiBounds[1]-roiBounds[0])/2, (roiBounds[3]-roiBounds[2])/2, (roiBounds[5]-roiBounds[4])/2)
 
     # Crop MRI volume
     cropParams = slicer.vtkMRMLCropVolumeParametersNode()
@@ -638,22 +908,25 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     self.mrCroppedVolumeNode = cropParams.GetOutputVolumeNode()
     if self.mrCroppedVolumeNode is None:
       logging.error('Unable to access cropped MR volume')
-      return
+      return False
+    self.hideIntermediateNode(self.mrCroppedVolumeNode)
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     mrStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.mrVolumeNode))
-    croppedMrShItemID = shNode.GetItemByDataNode(self.mrCroppedVolumeNode)
-    if not croppedMrShItemID:
-      logging.error('Unable to access cropped MR subject hierarchy item')
-      return
-    shNode.SetItemParent(croppedMrShItemID, mrStudyItemID)
+    if not self.mrCroppedVolumeNode.GetHideFromEditors():
+      croppedMrShItemID = shNode.GetItemByDataNode(self.mrCroppedVolumeNode)
+      if not croppedMrShItemID:
+        logging.error('Unable to access cropped MR subject hierarchy item')
+        return False
+      shNode.SetItemParent(croppedMrShItemID, mrStudyItemID)
 
     if not self.keepIntermediateNodes:
+      slicer.mrmlScene.RemoveNode(cropParams)
       slicer.mrmlScene.RemoveNode(roiNode)
     else:
       roiShItemID = shNode.GetItemByDataNode(roiNode)
       if not roiShItemID:
         logging.error('Unable to access crop ROI subject hierarchy item')
-        return
+        return False
       shNode.SetItemParent(roiShItemID, mrStudyItemID)
 
       # Hide ROI by default
@@ -664,7 +937,27 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     logging.info('Pre-aligning segmentations')
     if self.mrSegmentationNode is None or self.mrVolumeNode is None or self.mrCroppedVolumeNode is None or self.usSegmentationNode is None:
       logging.error('Invalid data selection')
-      return
+      return False
+    if self.preAlignmentMode == 'Moments':
+      mri2UsMatrix = self.computeMomentBasedPreAlignmentMatrix()
+    else:
+      mri2UsMatrix = self.computeBoundingBoxPreAlignmentMatrix()
+    if mri2UsMatrix is None:
+      return False
+
+    # Create alignment transform. It is not applied on (hardened into) the MR volume and segmentation, but the US prostate
+    # labelmap is created in the pre-aligned frame of the MR volume, and the pre-alignment is used as initial transform
+    # of the registration. This way the inputs are not modified, and the registration results include the pre-alignment
+    self.preAlignmentMri2UsLinearTransform = slicer.vtkMRMLLinearTransformNode()
+    self.preAlignmentMri2UsLinearTransform.SetName(slicer.mrmlScene.GenerateUniqueName('PreAlignmentMri2UsLinearTransform'))
+    slicer.mrmlScene.AddNode(self.preAlignmentMri2UsLinearTransform)
+    self.preAlignmentMri2UsLinearTransform.SetAndObserveMatrixTransformToParent(mri2UsMatrix)
+
+  #------------------------------------------------------------------------------
+  def computeBoundingBoxPreAlignmentMatrix(self):
+    """Compute pre-alignment as the translation between the centers of the prostate bounding boxes
+    :return: MRI to US matrix, None on failure
+    """
     # Get center of segmentation bounding boxes
     usBounds = [0]*6
     usProstateSegmentID = self.usSegmentationNode.GetSegmentation().GetSegmentIdBySegmentName(self.usProstateSegmentName)
@@ -685,17 +978,12 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     mrProstateCenter = [(mrBounds[1]+mrBounds[0])/2, (mrBounds[3]+mrBounds[2])/2, (mrBounds[5]+mrBounds[4])/2]
     logging.info('MRI prostate bounds: ' + repr(mrBounds))
 
-    # Create alignment transform
     mri2UsTranslation = [usProstateCenter[0]-mrProstateCenter[0], usProstateCenter[1]-mrProstateCenter[1], usProstateCenter[2]-mrProstateCenter[2]]
     logging.info('MRI to US prostate translation: ' + repr(mri2UsTranslation))
-    self.preAlignmentMri2UsLinearTransform = slicer.vtkMRMLLinearTransformNode()
-    self.preAlignmentMri2UsLinearTransform.SetName(slicer.mrmlScene.GenerateUniqueName('PreAlignmentMri2UsLinearTransform'))
-    slicer.mrmlScene.AddNode(self.preAlignmentMri2UsLinearTransform)
     mri2UsMatrix = vtk.vtkMatrix4x4()
     mri2UsMatrix.SetElement(0,3,mri2UsTranslation[0])
     mri2UsMatrix.SetElement(1,3,mri2UsTranslation[1])
     mri2UsMatrix.SetElement(2,3,mri2UsTranslation[2])
-    self.preAlignmentMri2UsLinearTransform.SetAndObserveMatrixTransformToParent(mri2UsMatrix)
 
     #TODO: This snippet shows both ROIs for testing purposes
     # roi1Node = slicer.vtkMRMLAnnotationROINode()
@@ -710,27 +998,62 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     # roi2Node.SetRadiusXYZ((mrBounds[1]-mrBounds[0])/2, (mrBounds[3]-mrBounds[2])/2, (mrBounds[5]-mrBounds[4])/2)
     # return
 
-    # Apply transform to US image and segmentation
-    self.mrVolumeNode.SetAndObserveTransformNodeID(self.preAlignmentMri2UsLinearTransform.GetID())
-    self.mrSegmentationNode.SetAndObserveTransformNodeID(self.preAlignmentMri2UsLinearTransform.GetID())
-    self.mrCroppedVolumeNode.SetAndObserveTransformNodeID(self.preAlignmentMri2UsLinearTransform.GetID())
+    return mri2UsMatrix
 
-    # Harden transform
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.mrVolumeNode)
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.mrSegmentationNode)
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.mrCroppedVolumeNode)
+  #------------------------------------------------------------------------------
+  def computeMomentBasedPreAlignmentMatrix(self):
+    """Compute pre-alignment as the rigid transform aligning the centroids and principal axes of the prostates.
+    The moments are computed on the grid of the US volume and of the cropped MR volume, respectively.
+    :return: MRI to US matrix, None on failure
+    """
+    usMoments = MomentAlignment.computeSegmentMoments(self.usSegmentationNode, [self.usProstateSegmentName], self.usVolumeNode)
+    if usMoments is None:
+      logging.error('Failed to compute moments of US prostate segment')
+      return None
+    mrMoments = MomentAlignment.computeSegmentMoments(self.mrSegmentationNode, [self.mrProstateSegmentName], self.mrCroppedVolumeNode)
+    if mrMoments is None:
+      logging.error('Failed to compute moments of MR prostate segment')
+      return None
+    logging.info('US prostate centroid: ' + repr(list(usMoments[0])) + ', MRI prostate centroid: ' + repr(list(mrMoments[0])))
+    return MomentAlignment.computeMoving2FixedMatrix(usMoments, mrMoments)
 
   #------------------------------------------------------------------------------
-  def resampleUS(self):
+  def resampleUS(self, waitForCompletion=True):
+    """Resample US volume to 1x1x1mm spacing.
+    :return: If not waiting for completion, the running CLI node if the CLI is used, otherwise the background task
+      resampling in-process (in both cases the resampled volume is not yet added to the study, see addResampledUSToStudy)
+    """
     logging.info('Resampling US volume')
     if not self.usVolumeNode:
       logging.error('Unable to access US volume')
-      return
+      return False
 
     # Create output volume
     self.usResampledVolumeNode = slicer.vtkMRMLScalarVolumeNode()
     self.usResampledVolumeNode.SetName(self.usVolumeNode.GetName() + '_Resampled_1x1x1mm')
-    slicer.mrmlScene.AddNode(self.usResampledVolumeNode)
+    self.hideIntermediateNode(self.usResampledVolumeNode)
+    # The CLI can only resample volumes of the main scene
+    if self.useCliResampling:
+      slicer.mrmlScene.AddNode(self.usResampledVolumeNode)
+    else:
+      self.getIntermediateScene().AddNode(self.usResampledVolumeNode)
+
+    if not self.useCliResampling:
+      outputBounds = None
+      if self.restrictUsResamplingToRoi:
+        outputBounds = self.computeUsProstateRoiBounds()
+        if outputBounds is None:
+          return False
+      # Resample in-process, applying the parent transform of the US volume (no hardened clone is needed)
+      result = self.volumeResampler.resample(self.usVolumeNode, self.usResampledVolumeNode, [1.0,1.0,1.0], 'lanczos', outputBounds,
+        waitForCompletion=waitForCompletion)
+      if result is False:
+        logging.error('Failed to resample US volume')
+        return False
+      if not waitForCompletion:
+        return result
+      self.addResampledUSToStudy()
+      return
 
     # Clone input volume and harden transform if any (the CLI does not handle parent transforms)
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
@@ -739,19 +1062,45 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     usVolumeHardenedShItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, usVolumeShItemID, usVolumeNodeCloneName)
     shNode.SetItemParent(usVolumeHardenedShItemID, shNode.GetItemParent(usVolumeShItemID))
     self.usVolumeHardenedNode = shNode.GetItemDataNode(usVolumeHardenedShItemID)
+    self.hideIntermediateNode(self.usVolumeHardenedNode)
     slicer.vtkSlicerTransformLogic.hardenTransform(self.usVolumeHardenedNode)
 
     # Resample
     resampleParameters = {'outputPixelSpacing':'1,1,1', 'interpolationType':'lanczos', 'InputVolume':self.usVolumeHardenedNode.GetID(), 'OutputVolume':self.usResampledVolumeNode.GetID()}
-    slicer.cli.run(slicer.modules.resamplescalarvolume, None, resampleParameters, wait_for_completion=True)
+    cliNode = slicer.cli.run(slicer.modules.resamplescalarvolume, None, resampleParameters, wait_for_completion=waitForCompletion)
+    if not waitForCompletion:
+      return cliNode
+    slicer.mrmlScene.RemoveNode(cliNode)
+
+    self.addResampledUSToStudy()
 
+  #------------------------------------------------------------------------------
+  def computeUsProstateRoiBounds(self):
+    """Get world bounds of the region around the US prostate segment used for restricting resampling
+    """
+    if not self.usSegmentationNode:
+      logging.error('Unable to access US segmentation')
+      return None
+    usProstateSegment = self.usSegmentationNode.GetSegmentation().GetSegment(
+      self.usSegmentationNode.GetSegmentation().GetSegmentIdBySegmentName(self.usProstateSegmentName))
+    if usProstateSegment is None:
+      logging.error('Failed to get US prostate segment')
+      return None
+    bounds = [0]*6
+    usProstateSegment.GetBounds(bounds)
+    return VolumeResampler.computeStructureRoiBounds(VolumeResampler.transformBoundsToWorld(bounds, self.usSegmentationNode))
+
+  #------------------------------------------------------------------------------
+  def addResampledUSToStudy(self):
     # Add resampled US volume to the same study as the original US
+    if self.usResampledVolumeNode.GetHideFromEditors() or self.usResampledVolumeNode.GetScene() is not slicer.mrmlScene:
+      return
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     usStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.usVolumeNode))
     resampledUsShItemID = shNode.GetItemByDataNode(self.usResampledVolumeNode)
     if not resampledUsShItemID:
       logging.error('Unable to access resampled US subject hierarchy item')
-      return
+      return False
     shNode.SetItemParent(resampledUsShItemID, usStudyItemID)
 
   #------------------------------------------------------------------------------
@@ -759,7 +1108,64 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     logging.info('Creating prostate contour labelmaps')
     if self.mrSegmentationNode is None or self.usSegmentationNode is None:
       logging.error('Unable to access segmentations')
+      return False
+
+    # Export segment binary labelmaps to labelmap nodes
+    self.usProstateLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
+    self.usProstateLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('US_Prostate_Padded'))
+    self.mrProstateLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
+    self.mrProstateLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('MRI_Prostate_Padded'))
+    for labelmapNode in [self.usProstateLabelmap, self.mrProstateLabelmap]:
+      self.hideIntermediateNode(labelmapNode)
+      self.getIntermediateScene().AddNode(labelmapNode)
+      if not self.hideIntermediateNodes:
+        labelmapNode.CreateDefaultDisplayNodes()
+
+    if self.useFastSegmentRasterization:
+      # Rasterize only the prostate segments directly on the (pre-aligned) cropped MR volume grid, in a single pass (no clones)
+      for labelmapNode, segmentationNode, segmentName, referenceVolumeNode in [
+          (self.usProstateLabelmap, self.usSegmentationNode, self.usProstateSegmentName, self.getUsLabelmapReferenceVolumeNode()),
+          (self.mrProstateLabelmap, self.mrSegmentationNode, self.mrProstateSegmentName, self.mrCroppedVolumeNode)]:
+        if not SegmentRasterizer.createLabelmapFromSegments([(segmentationNode, segmentName, 1)], referenceVolumeNode,
+            labelmapNode, self.cropLabelmapsToSegmentExtent):
+          logging.error('Failed to create prostate labelmap nodes')
+          return False
+    elif self.createProstateContourLabelmapsFromHardenedCopies() is False:
+      return False
+
+    # Add labelmaps to the corresponding studies in subject hierarchy
+    if self.hideIntermediateNodes or self.scratchScene is not None:
+      return
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    usStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.usVolumeNode))
+    mrStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.mrVolumeNode))
+    usLabelmapShItemID = shNode.GetItemByDataNode(self.usProstateLabelmap)
+    mrLabelmapShItemID = shNode.GetItemByDataNode(self.mrProstateLabelmap)
+    if not usLabelmapShItemID or not mrLabelmapShItemID:
+      logging.error('Unable to access subject hierarchy items for the prostate labelmaps')
+      return False
+    shNode.SetItemParent(usLabelmapShItemID, usStudyItemID)
+    shNode.SetItemParent(mrLabelmapShItemID, mrStudyItemID)
+
+  #------------------------------------------------------------------------------
+  def getUsLabelmapReferenceVolumeNode(self):
+    """Get volume defining the grid of the US prostate labelmap. With fast segment rasterization and US distance map
+    caching, it is the resampled US volume (so that the labelmap does not depend on the MR inputs), otherwise the grid
+    of the cropped MR volume mapped by the pre-alignment transform (geometry only)
+    """
+    if self.useFastSegmentRasterization and self.usDistanceMapCache and self.usResampledVolumeNode:
+      return self.usResampledVolumeNode
+    mri2UsMatrix = vtk.vtkMatrix4x4()
+    if self.preAlignmentMri2UsLinearTransform is not None:
+      self.preAlignmentMri2UsLinearTransform.GetMatrixTransformToParent(mri2UsMatrix)
+    return SegmentRasterizer.createReferenceGeometryNode(self.mrCroppedVolumeNode, mri2UsMatrix)
 
+  #------------------------------------------------------------------------------
+  def createProstateContourLabelmapsFromHardenedCopies(self):
+    """Create prostate labelmaps by cloning the segmentations, hardening their transforms, and converting
+    all their segments to binary labelmap
+    :return: False on failure
+    """
     # Clone segmentations and harden transform if any (so that the labelmap geometry is correct)
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     mrSegmentationShItemID = shNode.GetItemByDataNode(self.mrSegmentationNode)
@@ -767,12 +1173,14 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     mrSegmentationHardenedShItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, mrSegmentationShItemID, mrSegmentationNodeCloneName)
     shNode.SetItemParent(mrSegmentationHardenedShItemID, shNode.GetItemParent(mrSegmentationShItemID))
     self.mrSegmentationHardenedNode = shNode.GetItemDataNode(mrSegmentationHardenedShItemID)
+    self.hideIntermediateNode(self.mrSegmentationHardenedNode)
     slicer.vtkSlicerTransformLogic.hardenTransform(self.mrSegmentationHardenedNode)
     usSegmentationShItemID = shNode.GetItemByDataNode(self.usSegmentationNode)
     usSegmentationNodeCloneName = self.usSegmentationNode.GetName() + '_HardenedCopy'
     usSegmentationHardenedShItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, usSegmentationShItemID, usSegmentationNodeCloneName)
     shNode.SetItemParent(usSegmentationHardenedShItemID, shNode.GetItemParent(usSegmentationShItemID))
     self.usSegmentationHardenedNode = shNode.GetItemDataNode(usSegmentationHardenedShItemID)
+    self.hideIntermediateNode(self.usSegmentationHardenedNode)
     slicer.vtkSlicerTransformLogic.hardenTransform(self.usSegmentationHardenedNode)
 
     # Make sure the prostate segmentations have the labelmaps
@@ -786,96 +1194,74 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     usProstateSegmentID = self.usSegmentationHardenedNode.GetSegmentation().GetSegmentIdBySegmentName(self.usProstateSegmentName)
     usProstateOrientedImageData.DeepCopy(self.usSegmentationHardenedNode.GetSegmentation().GetSegment(usProstateSegmentID).GetRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()))
 
-    # Get MR volume geometry
+    # Get MR volume geometry, and its pre-aligned geometry for the US prostate
     mrOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(self.mrCroppedVolumeNode)
     mrOrientedImageData.UnRegister(None)
+    usReferenceOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(self.getUsLabelmapReferenceVolumeNode())
+    usReferenceOrientedImageData.UnRegister(None)
 
     # Ensure same geometry of oriented image data
     if not slicer.vtkOrientedImageDataResample.DoGeometriesMatch(mrProstateOrientedImageData, mrOrientedImageData) \
         or not slicer.vtkOrientedImageDataResample.DoExtentsMatch(mrProstateOrientedImageData, mrOrientedImageData):
       slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(mrProstateOrientedImageData, mrOrientedImageData, mrProstateOrientedImageData)
-    if not slicer.vtkOrientedImageDataResample.DoGeometriesMatch(usProstateOrientedImageData, mrOrientedImageData) \
-        or not slicer.vtkOrientedImageDataResample.DoExtentsMatch(usProstateOrientedImageData, mrOrientedImageData):
-      slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(usProstateOrientedImageData, mrOrientedImageData, usProstateOrientedImageData)
-
-    # Export segment binary labelmaps to labelmap nodes
-    self.usProstateLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
-    self.usProstateLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('US_Prostate_Padded'))
-    slicer.mrmlScene.AddNode(self.usProstateLabelmap)
-    self.usProstateLabelmap.CreateDefaultDisplayNodes()
-
-    self.mrProstateLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
-    self.mrProstateLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('MRI_Prostate_Padded'))
-    slicer.mrmlScene.AddNode(self.mrProstateLabelmap)
-    self.mrProstateLabelmap.CreateDefaultDisplayNodes()
+    if not slicer.vtkOrientedImageDataResample.DoGeometriesMatch(usProstateOrientedImageData, usReferenceOrientedImageData) \
+        or not slicer.vtkOrientedImageDataResample.DoExtentsMatch(usProstateOrientedImageData, usReferenceOrientedImageData):
+      slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(usProstateOrientedImageData, usReferenceOrientedImageData, usProstateOrientedImageData)
 
     ret1 = slicer.vtkSlicerSegmentationsModuleLogic.CreateLabelmapVolumeFromOrientedImageData(usProstateOrientedImageData, self.usProstateLabelmap)
     ret2 = slicer.vtkSlicerSegmentationsModuleLogic.CreateLabelmapVolumeFromOrientedImageData(mrProstateOrientedImageData, self.mrProstateLabelmap)
     if ret1 is False or ret2 is False:
       logging.error('Failed to create prostate labelmap nodes')
-
-    # Add labelmaps to the corresponding studies in subject hierarchy
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    usStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.usVolumeNode))
-    mrStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.mrVolumeNode))
-    usLabelmapShItemID = shNode.GetItemByDataNode(self.usProstateLabelmap)
-    mrLabelmapShItemID = shNode.GetItemByDataNode(self.mrProstateLabelmap)
-    if not usLabelmapShItemID or not mrLabelmapShItemID:
-      logging.error('Unable to access subject hierarchy items for the prostate labelmaps')
-      return
-    shNode.SetItemParent(usLabelmapShItemID, usStudyItemID)
-    shNode.SetItemParent(mrLabelmapShItemID, mrStudyItemID)
+      return False
 
   #------------------------------------------------------------------------------
   def performDistanceBasedRegistration(self):
     logging.info('Performing distance based registration')
+    if not self.prepareDistanceBasedRegistration():
+      logging.error('Distance map based registration failed')
+      return False
 
-    # Register using Distance Map Based Registration
-    slicer.modules.distancemapbasedregistration.createNewWidgetRepresentation()
-    distMapRegModuleWidget = slicer.modules.DistanceMapBasedRegistrationWidget
-    distMapRegModuleWidget.fixedImageSelector.setCurrentNode(self.usVolumeNode)
-    distMapRegModuleWidget.fixedImageLabelSelector.setCurrentNode(self.usProstateLabelmap)
-    distMapRegModuleWidget.movingImageSelector.setCurrentNode(self.mrVolumeNode)
-    distMapRegModuleWidget.movingImageLabelSelector.setCurrentNode(self.mrProstateLabelmap)
-    self.affineTransformNode = distMapRegModuleWidget.affineTransformSelector.addNode()
-    self.bsplineTransformNode = distMapRegModuleWidget.bsplineTransformSelector.addNode()
-    success = True
-    try:
-      distMapRegModuleWidget.applyButton.click()
-    except:
-      success = False
+    success = self.distanceMapRegistrationLogic.startAffineRegistration(self.affineTransformNode, initialTransformNode=self.preAlignmentMri2UsLinearTransform) \
+      and self.distanceMapRegistrationLogic.startDeformableRegistration(self.affineTransformNode, self.bsplineTransformNode)
+    if not success:
       logging.error('Distance map based registration failed')
-      return
 
-    if not self.keepIntermediateNodes:
-      qt.QTimer.singleShot(250, self.removeIntermedateNodes) # Otherwise Slicer crashes
-    else:
+    self.finalizeDistanceBasedRegistration()
+    return success
+
+  #------------------------------------------------------------------------------
+  def prepareDistanceBasedRegistration(self, waitForCompletion=True):
+    """Create output transforms and compute the distance maps to register
+    :return: Success if waiting for completion, the background task computing the distance maps otherwise
+    """
+    # Create output transforms
+    self.affineTransformNode = slicer.vtkMRMLLinearTransformNode()
+    self.affineTransformNode.SetName(slicer.mrmlScene.GenerateUniqueName('Affine Transform'))
+    slicer.mrmlScene.AddNode(self.affineTransformNode)
+    self.bsplineTransformNode = slicer.vtkMRMLBSplineTransformNode()
+    self.bsplineTransformNode.SetName(slicer.mrmlScene.GenerateUniqueName('Deformable Transform'))
+    slicer.mrmlScene.AddNode(self.bsplineTransformNode)
+
+    # Register using distance map based registration directly on the labelmaps (no widget is needed)
+    self.distanceMapRegistrationLogic.fixedDistanceMapCache = self.usDistanceMapCache
+    return self.distanceMapRegistrationLogic.computeDistanceMaps(self.usProstateLabelmap, self.mrProstateLabelmap, waitForCompletion)
+
+  #------------------------------------------------------------------------------
+  def finalizeDistanceBasedRegistration(self):
+    if self.keepIntermediateNodes:
       # Move nodes created by the distance map based registration ot the proper subject hierarchy branches
       pass #TODO
-
-    return success
+    elif self.nodeRegistry is None:
+      # Within performRegistration the intermediate nodes are removed by the node registry at the end of the run
+      self.removeIntermedateNodes()
 
   #------------------------------------------------------------------------------
   def removeIntermedateNodes(self):
-    # Remove nodes created during preprocessing for the distance based registration
-    slicer.mrmlScene.RemoveNode(self.mrCroppedVolumeNode)
-    slicer.mrmlScene.RemoveNode(self.usResampledVolumeNode)
-    slicer.mrmlScene.RemoveNode(self.usProstateLabelmap)
-    slicer.mrmlScene.RemoveNode(self.mrProstateLabelmap)
-    slicer.mrmlScene.RemoveNode(self.usVolumeHardenedNode)
-    slicer.mrmlScene.RemoveNode(self.mrSegmentationHardenedNode)
-    slicer.mrmlScene.RemoveNode(self.usSegmentationHardenedNode)
-
-    # Remove nodes created by distance based registration
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('US_Prostate_Padded-Cropped'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('US_Prostate_Padded-Smoothed'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('US_Prostate_Padded-DistanceMap'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('US_Prostate_Padded-surface'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('MRI_Prostate_Padded-Cropped'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('MRI_Prostate_Padded-Smoothed'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('MRI_Prostate_Padded-DistanceMap'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('MRI_Prostate_Padded-surface'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('MovingImageCopy'))
+    # Remove nodes created during preprocessing and by the distance based registration
+    for node in self.getIntermediateNodes():
+      if node is not None and node.GetScene() is not None:
+        node.GetScene().RemoveNode(node)
+    self.distanceMapRegistrationLogic.intermediateNodes = []
 
   #------------------------------------------------------------------------------
   def createFiducialLists(self):
@@ -896,9 +1282,10 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
   def applyNoTransformation(self):
     if self.mrVolumeNode is None or self.mrSegmentationNode is None:
       logging.error('Failed to apply transformation on MR volume and segmentation')
-    # Apply transform on MR volume and segmentation
-    self.mrVolumeNode.SetAndObserveTransformNodeID(None)
-    self.mrSegmentationNode.SetAndObserveTransformNodeID(None)
+    # The pre-alignment (shown as the rigid result) is not hardened into the MR volume and segmentation, so apply it
+    preAlignmentTransformNodeID = self.preAlignmentMri2UsLinearTransform.GetID() if self.preAlignmentMri2UsLinearTransform else None
+    self.mrVolumeNode.SetAndObserveTransformNodeID(preAlignmentTransformNodeID)
+    self.mrSegmentationNode.SetAndObserveTransformNodeID(preAlignmentTransformNodeID)
 
   #------------------------------------------------------------------------------
   def applyRigidTransformation(self):
@@ -913,11 +1300,32 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     if self.mrVolumeNode is None or self.mrSegmentationNode is None:
       logging.error('Failed to apply transformation on MR volume and segmentation')
     # Apply transform on MR volume and segmentation
-    self.mrVolumeNode.SetAndObserveTransformNodeID(self.bsplineTransformNode.GetID())
-    self.mrSegmentationNode.SetAndObserveTransformNodeID(self.bsplineTransformNode.GetID())
+    deformableTransformNode = self.getDeformableResultTransformNode()
+    self.mrVolumeNode.SetAndObserveTransformNodeID(deformableTransformNode.GetID())
+    self.mrSegmentationNode.SetAndObserveTransformNodeID(deformableTransformNode.GetID())
+
+  #------------------------------------------------------------------------------
+  def getDeformableResultTransformNode(self):
+    """Get transform node to apply as deformable result: the B-spline transform, or its cached displacement field
+    if useDisplacementFieldCache is enabled. The displacement field is recomputed only if the B-spline transform
+    was modified since it was last sampled
+    """
+    if not self.useDisplacementFieldCache:
+      return self.bsplineTransformNode
+    roiBounds = self.computeUsProstateRoiBounds()
+    if roiBounds is None:
+      return self.bsplineTransformNode
+    gridTransformNode = self.displacementFieldCache.getGridTransformNode(self.bsplineTransformNode, roiBounds)
+    if gridTransformNode is None:
+      return self.bsplineTransformNode
+    return gridTransformNode
 
   #------------------------------------------------------------------------------
-  def exportDeformedMrStudyToDicom(self):
+  def exportDeformedMrStudyToDicom(self, outputDirectory=None):
+    """Create study containing the deformed MR volume and segmentation, and export it to DICOM
+    :param outputDirectory: Directory to export to without user interaction. If None, then the DICOM export dialog is opened
+    :return: List of the exported SOP Instance UIDs if exported to a directory, None otherwise
+    """
     if not self.mrPatientShItemID or self.mrVolumeNode is None or self.mrSegmentationNode is None:
       logging.error('Unable to access MRI data for DICOM export')
       return
@@ -951,19 +1359,24 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
       if self.resampleMrToUsGeometryForExport:
         # Create resampled MR volume in US reference frame so that the exported structure set is smoother
         # (more fidelity to the original segmentation, in the granularity of the reference US image where the procedure is done)
-        mrVolumeNodeCurrentTransformNode = self.mrVolumeNode.GetParentTransformNode() # So that we can set restore it later
-        self.mrVolumeNode.SetAndObserveTransformNodeID(self.bsplineTransformNode.GetID()) # Make sure the deformable transform is the parent when copying
-        mrOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(self.mrVolumeNode)
-        slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(mrOrientedImageData, usOrientedImageData, mrOrientedImageData, True, True)
-        mrImageToWorldMatrix = vtk.vtkMatrix4x4()
-        mrOrientedImageData.GetImageToWorldMatrix(mrImageToWorldMatrix)
-        self.mrVolumeNodeForExport.SetIJKToRASMatrix(mrImageToWorldMatrix)
-        identityMatrix = vtk.vtkMatrix4x4()
-        identityMatrix.Identity()
-        mrOrientedImageData.SetGeometryFromImageToWorldMatrix(identityMatrix)
-        slicer.vtkMRMLSegmentationNode.ShiftVolumeNodeExtentToZeroStart(self.mrVolumeNodeForExport)
-        self.mrVolumeNodeForExport.SetAndObserveImageData(mrOrientedImageData)
-        self.mrVolumeNode.SetAndObserveTransformNodeID(mrVolumeNodeCurrentTransformNode)
+        mrVolumeNodeCurrentTransformNodeID = self.mrVolumeNode.GetTransformNodeID() # So that we can set restore it later
+        self.mrVolumeNode.SetAndObserveTransformNodeID(self.getDeformableResultTransformNode().GetID()) # Make sure the deformable transform is the parent when copying
+        if self.useSlabResamplingForExport:
+          if not self.volumeResampler.resampleToReferenceGeometry(self.mrVolumeNode, self.usVolumeNode, self.mrVolumeNodeForExport):
+            logging.error('Failed to resample MR volume to US geometry for export')
+        else:
+          usOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(self.usVolumeNode)
+          mrOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(self.mrVolumeNode)
+          slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(mrOrientedImageData, usOrientedImageData, mrOrientedImageData, True, True)
+          mrImageToWorldMatrix = vtk.vtkMatrix4x4()
+          mrOrientedImageData.GetImageToWorldMatrix(mrImageToWorldMatrix)
+          self.mrVolumeNodeForExport.SetIJKToRASMatrix(mrImageToWorldMatrix)
+          identityMatrix = vtk.vtkMatrix4x4()
+          identityMatrix.Identity()
+          mrOrientedImageData.SetGeometryFromImageToWorldMatrix(identityMatrix)
+          slicer.vtkMRMLSegmentationNode.ShiftVolumeNodeExtentToZeroStart(self.mrVolumeNodeForExport)
+          self.mrVolumeNodeForExport.SetAndObserveImageData(mrOrientedImageData)
+        self.mrVolumeNode.SetAndObserveTransformNodeID(mrVolumeNodeCurrentTransformNodeID)
       else:
         self.mrVolumeNodeForExport.Copy(self.mrVolumeNode)
         self.mrVolumeNodeForExport.SetAndObserveTransformNodeID(self.bsplineTransformNode.GetID())
@@ -984,13 +1397,14 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
         return
       deformedMrStudyShItemID = shNode.GetItemParent(mrSegmentationForMrExportShItemID)
 
-    # Open DICOM export dialog, selecting the study to export
-    exportDicomDialog = slicer.qSlicerDICOMExportDialog(None)
-    exportDicomDialog.setMRMLScene(slicer.mrmlScene)
-    exportDicomDialog.execDialog(deformedMrStudyShItemID)
+    return self.exportStudyToDicom(deformedMrStudyShItemID, outputDirectory)
 
   #------------------------------------------------------------------------------
-  def exportDeformedUsStudyToDicom(self):
+  def exportDeformedUsStudyToDicom(self, outputDirectory=None):
+    """Create study containing the US volume and the deformed MR segmentation, and export it to DICOM
+    :param outputDirectory: Directory to export to without user interaction. If None, then the DICOM export dialog is opened
+    :return: List of the exported SOP Instance UIDs if exported to a directory, None otherwise
+    """
     if not self.usPatientShItemID or self.usVolumeNode is None or self.mrSegmentationNode is None:
       logging.error('Unable to access US data for DICOM export')
       return
@@ -1046,10 +1460,26 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
         return
       usStudyWithMrStructuresShItemID = shNode.GetItemParent(mrSegmentationForUsExportShItemID)
 
-    # Open DICOM export dialog, selecting the study to export
-    exportDicomDialog = slicer.qSlicerDICOMExportDialog(None)
-    exportDicomDialog.setMRMLScene(slicer.mrmlScene)
-    exportDicomDialog.execDialog(usStudyWithMrStructuresShItemID)
+    return self.exportStudyToDicom(usStudyWithMrStructuresShItemID, outputDirectory)
+
+  #------------------------------------------------------------------------------
+  def exportStudyToDicom(self, studyShItemID, outputDirectory=None):
+    """Export study to DICOM files in the output directory, or open the DICOM export dialog if no directory is given
+    :return: List of the exported SOP Instance UIDs if exported to a directory, None otherwise
+    """
+    if outputDirectory is None:
+      # Open DICOM export dialog, selecting the study to export
+      exportDicomDialog = slicer.qSlicerDICOMExportDialog(None)
+      exportDicomDialog.setMRMLScene(slicer.mrmlScene)
+      exportDicomDialog.execDialog(studyShItemID)
+      return None
+
+    sopInstanceUids = self.dicomStudyExporter.exportStudy(studyShItemID, outputDirectory)
+    if sopInstanceUids is None:
+      logging.error('Failed to export study to ' + outputDirectory)
+      return None
+    logging.info('Exported %d DICOM instances to %s' % (len(sopInstanceUids), outputDirectory))
+    return sopInstanceUids
 
   #------------------------------------------------------------------------------
   def setupResultVisualization(self):
@@ -1088,6 +1518,31 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
       logging.error('Failed to get segmentations')
       return False
 
+    # Calculate overlap and surface distance metrics of all matching segment pairs in one table
+    if self.similarityMetricsTableNode is None or self.similarityMetricsTableNode.GetScene() is None:
+      self.similarityMetricsTableNode = slicer.vtkMRMLTableNode()
+      self.similarityMetricsTableNode.SetName(slicer.mrmlScene.GenerateUniqueName('Similarity metrics table'))
+      slicer.mrmlScene.AddNode(self.similarityMetricsTableNode)
+    segmentNamePairs = self.getSimilaritySegmentNamePairs()
+    metrics = OverlapMetrics.computeOverlapMetrics(self.usSegmentationNode, self.mrSegmentationNode,
+      segmentNamePairs, self.getSimilarityReferenceVolumeNode())
+    if metrics is None:
+      logging.error('Failed to calculate overlap metrics')
+      return False
+    metricColumns = list(OverlapMetrics.metricColumns)
+    if self.computeSurfaceDistanceMetrics:
+      surfaceDistanceMetrics = SurfaceDistanceMetrics.computeSurfaceDistanceMetrics(self.usSegmentationNode, self.mrSegmentationNode, segmentNamePairs)
+      if surfaceDistanceMetrics is None:
+        logging.error('Failed to calculate surface distance metrics')
+        return False
+      for pairMetrics, pairSurfaceDistanceMetrics in zip(metrics, surfaceDistanceMetrics):
+        pairMetrics.update(pairSurfaceDistanceMetrics)
+      metricColumns += SurfaceDistanceMetrics.metricColumns
+    OverlapMetrics.writeMetricsTable(metrics, self.similarityMetricsTableNode, metricColumns)
+
+    if not self.computeSegmentComparisonTables:
+      return True
+
     # Calculate Dice, Hausdorff
     if self.segmentComparisonNode is None or self.segmentComparisonNode.GetScene() is None:
       self.segmentComparisonNode = slicer.vtkMRMLSegmentComparisonNode()
@@ -1125,6 +1580,30 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
 
     return True
 
+  #------------------------------------------------------------------------------
+  def getSimilaritySegmentNamePairs(self):
+    """Get (US segment name, MR segment name) pairs to compare: the prostate segments, and the segments
+    with the same name in both segmentations
+    """
+    segmentNamePairs = [(self.usProstateSegmentName, self.mrProstateSegmentName)]
+    usSegmentation = self.usSegmentationNode.GetSegmentation()
+    mrSegmentation = self.mrSegmentationNode.GetSegmentation()
+    for segmentIndex in range(usSegmentation.GetNumberOfSegments()):
+      segmentName = usSegmentation.GetNthSegment(segmentIndex).GetName()
+      if segmentName in [self.usProstateSegmentName, self.mrProstateSegmentName]:
+        continue
+      if mrSegmentation.GetSegmentIdBySegmentName(segmentName):
+        segmentNamePairs.append((segmentName, segmentName))
+    return segmentNamePairs
+
+  #------------------------------------------------------------------------------
+  def getSimilarityReferenceVolumeNode(self):
+    """Get volume on whose grid the segments are compared: the resampled US volume if available, the US volume otherwise
+    """
+    if self.usResampledVolumeNode is not None and self.usResampledVolumeNode.GetScene() is not None:
+      return self.usResampledVolumeNode
+    return self.usVolumeNode
+
   #------------------------------------------------------------------------------
   def calculateFiducialErrors(self):
     logging.info('Calculating fiducial errors')
@@ -1151,30 +1630,29 @@ class ProstateMRIUSContourPropagationLogic(ScriptedLoadableModuleLogic):
     self.fiducialErrorsTableNode.SetUseColumnNameAsColumnHeader(True)
     slicer.mrmlScene.AddNode(self.fiducialErrorsTableNode)
 
-    # Row headers
-    header = self.fiducialErrorsTableNode.AddColumn()
-    header.InsertNextValue("3D")
-    header.InsertNextValue("2D R-L")
-    header.InsertNextValue("2D A-P")
-    header.InsertNextValue("2D I-S")
-
-    # Calculate error metrics
-    for index in range(self.usFiducialsNode.GetNumberOfFiducials()):
-      usPos = [0,0,0]
-      self.usFiducialsNode.GetNthFiducialPosition(index,usPos)
-      mrPos = [0,0,0]
-      self.mrFiducialsNode.GetNthFiducialPosition(index,mrPos)
-      column = self.fiducialErrorsTableNode.AddColumn()
-      column.SetName(self.usFiducialsNode.GetNthFiducialLabel(index)[13:])
-      import math
-      threeDDist = math.sqrt((usPos[0]-mrPos[0])**2 + (usPos[1]-mrPos[1])**2 + (usPos[2]-mrPos[2])**2)
-      column.SetValue(0, str( threeDDist ))
-      column.SetValue(1, str( abs(usPos[0]-mrPos[0]) ))
-      column.SetValue(2, str( abs(usPos[1]-mrPos[1]) ))
-      column.SetValue(3, str( abs(usPos[2]-mrPos[2]) ))
-
+    # Calculate 3D TRE and distances along each axis (one row per fiducial), followed by the summary rows
+    errors = FiducialErrors.calculateFiducialErrors(self.usFiducialsNode, self.mrFiducialsNode, self.fiducialErrorsTableNode)
+    if errors is None:
+      logging.error('Failed to calculate fiducial errors')
+      return False
+    logging.info('Mean TRE of %d fiducials: %.2fmm' % (len(errors), errors[:,0].mean()))
     return True
 
+  #------------------------------------------------------------------------------
+  def calculateCohortFiducialErrors(self, cases):
+    """Calculate fiducial errors of multiple cases into one table, with summary rows over all cases
+    :param cases: List of (case ID, US fiducials node, MRI fiducials node) tuples
+    :return: Table node, None on failure
+    """
+    logging.info('Calculating fiducial errors of %d cases' % len(cases))
+    cohortFiducialErrorsTableNode = slicer.vtkMRMLTableNode()
+    cohortFiducialErrorsTableNode.SetName(slicer.mrmlScene.GenerateUniqueName('Cohort fiducial errors table'))
+    if FiducialErrors.calculateCohortFiducialErrors(cases, cohortFiducialErrorsTableNode) is None:
+      logging.error('Failed to calculate cohort fiducial errors')
+      return None
+    slicer.mrmlScene.AddNode(cohortFiducialErrorsTableNode)
+    return cohortFiducialErrorsTableNode
+
 #
 # -----------------------------------------------------------------------------
 # ProstateMRIUSContourPropagationTest
@@ -1204,6 +1682,7 @@ class ProstateMRIUSContourPropagationTest(ScriptedLoadableModuleTest):
       self.TestSection_01D_SelectLoadablesAndLoad()
       self.TestSection_02_PerformRegistration()
       self.TestSection_03_CalculateSimilarity()
+      self.TestSection_04_ExportDeformedStudies()
       self.TestUtility_ClearDatabase()
 
     except Exception as e:
@@ -1416,6 +1895,8 @@ class ProstateMRIUSContourPropagationTest(ScriptedLoadableModuleTest):
       self.assertIsNotNone(affineTransformNode)
       deformableTransformNode = slicer.util.getNode('Deformable Transform')
       self.assertIsNotNone(deformableTransformNode)
+      # Pre-alignment is included in the registration result instead of being hardened into the inputs
+      self.assertIsNone(mrSegmentationNode.GetParentTransformNode())
 
       # Set transforms and visualization
       moduleWidget.onRegistrationSuccessful()
@@ -1425,6 +1906,15 @@ class ProstateMRIUSContourPropagationTest(ScriptedLoadableModuleTest):
       self.assertIsNotNone(mrVolumeNode)
       self.assertIsNotNone(mrVolumeNode.GetParentTransformNode())
 
+      # Switch between the results. The pre-alignment is not hardened into the inputs, so it is applied when no
+      # registration result is shown
+      for radioButton, transformNode in [(moduleWidget.noRegistrationRadioButton, preAlignmentTransformNode),
+          (moduleWidget.rigidRegistrationRadioButton, affineTransformNode),
+          (moduleWidget.deformableRegistrationRadioButton, moduleWidget.logic.getDeformableResultTransformNode())]:
+        radioButton.click()
+        self.assertEqual(mrVolumeNode.GetTransformNodeID(), transformNode.GetID())
+        self.assertEqual(mrSegmentationNode.GetTransformNodeID(), transformNode.GetID())
+
     except Exception as e:
       import traceback
       traceback.print_exc()
@@ -1437,6 +1927,7 @@ class ProstateMRIUSContourPropagationTest(ScriptedLoadableModuleTest):
 
     try:
       moduleWidget = slicer.modules.prostatemriuscontourpropagation.widgetRepresentation().self()
+      moduleWidget.logic.computeSegmentComparisonTables = True
       moduleWidget.onCalculateSegmentSimilarity()
 
       layoutManager = slicer.app.layoutManager()
@@ -1468,6 +1959,48 @@ class ProstateMRIUSContourPropagationTest(ScriptedLoadableModuleTest):
       self.assertLess(hausdorffTable.GetValue(5,1).ToDouble(), 1)
       self.assertLess(hausdorffTable.GetValue(6,1).ToDouble(), 2.5)
 
+      # Check overlap and surface distance metrics of the prostate pair (first row), consistent with the Dice and Hausdorff tables
+      self.assertIsNotNone(moduleWidget.logic.similarityMetricsTableNode)
+      similarityTable = moduleWidget.logic.similarityMetricsTableNode.GetTable()
+      self.assertGreater(similarityTable.GetValue(0,2).ToDouble(), 0.9)
+      self.assertAlmostEqual(similarityTable.GetValue(0,2).ToDouble(), diceTable.GetValue(4,1).ToDouble(), 1)
+      self.assertLess(similarityTable.GetValue(0,3).ToDouble(), similarityTable.GetValue(0,2).ToDouble())
+      self.assertLess(similarityTable.GetValue(0,9).ToDouble(), 5)
+      self.assertLessEqual(similarityTable.GetValue(0,10).ToDouble(), similarityTable.GetValue(0,9).ToDouble())
+      self.assertLess(similarityTable.GetValue(0,11).ToDouble(), 1.5)
+
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.delayDisplay('Test caused exception!\n' + str(e),self.delayMs*2)
+      raise Exception("Exception occurred, handled, thrown further to workflow level")
+
+  #------------------------------------------------------------------------------
+  def TestSection_04_ExportDeformedStudies(self):
+    self.delayDisplay("Export deformed studies to DICOM",self.delayMs)
+
+    try:
+      logic = slicer.modules.prostatemriuscontourpropagation.widgetRepresentation().self().logic
+      import shutil
+      exportDir = self.tempDir + '/DicomExport'
+      if os.access(exportDir, os.F_OK):
+        shutil.rmtree(exportDir)
+
+      mrSopInstanceUids = logic.exportDeformedMrStudyToDicom(exportDir + '/MR')
+      self.assertIsNotNone(mrSopInstanceUids)
+      self.assertGreater(len(mrSopInstanceUids), 1)
+      usSopInstanceUids = logic.exportDeformedUsStudyToDicom(exportDir + '/US')
+      self.assertIsNotNone(usSopInstanceUids)
+      self.assertGreater(len(usSopInstanceUids), 1)
+      self.assertEqual(len(set(mrSopInstanceUids + usSopInstanceUids)), len(mrSopInstanceUids) + len(usSopInstanceUids))
+
+      # Re-exporting into the same directory overwrites the files of the first export, and reports all instances again
+      usReexportedSopInstanceUids = logic.exportDeformedUsStudyToDicom(exportDir + '/US')
+      self.assertIsNotNone(usReexportedSopInstanceUids)
+      self.assertEqual(len(usReexportedSopInstanceUids), len(usSopInstanceUids))
+      # The temporary export directory is removed
+      self.assertFalse([name for name in os.listdir(exportDir + '/US') if name.startswith('Export_')])
+
     except Exception as e:
       import traceback
       traceback.print_exc()
@@ -3,7 +3,10 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from DICOMLib import DICOMUtils
+from SegmentRegistrationLib import StageCache, StageProfiler, VolumeResampler, SegmentRasterizer, MomentAlignment, NodeRegistry, SceneEventCounter, RegistrationContext, addContextProperties, contextStage
 import logging
+import numpy as np
+from vtk.util import numpy_support
 
 invalidShItemID = slicer.vtkMRMLSubjectHierarchyNode.GetInvalidItemID()
 
@@ -338,63 +341,225 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
   """
 
   def __init__(self):
-    self.fixedSegmentName = None
-    self.fixedVolumeNode = None
-    self.fixedVolumeHardenedNode = None
-    self.fixedSegmentationNode = None
-    self.fixedSegmentationHardenedNode = None
-    self.fixedResampledVolumeNode = None
-    self.fixedLabelmap = None
-
-    self.movingSegmentName = None
-    self.movingVolumeNode = None
-    self.movingSegmentationNode = None
-    self.movingSegmentationHardenedNode = None
-    self.movingCroppedVolumeNode = None
-    self.movingLabelmap = None
-    self.movingVolumeNodeForExport = None
-    self.movingSegmentationNodeForExport = None
-
-    self.affineTransformNode = None
-    self.bsplineTransformNode = None
+    # Per-case state (inputs, intermediate and result nodes, reports) used when no context is given to the stages.
+    # The per-case attributes of the logic (such as fixedVolumeNode) refer to the current context (see RegistrationContext)
+    self.defaultContext = RegistrationContext()
+
+    # If enabled, then all segment pairs are registered together (one registration of all structures, each pair
+    # contributing its own distance map, see DistanceMapRegistrationLogic). Voxels shared by several segments belong
+    # to the later pair in the labelmaps. Otherwise each pair is registered separately, and the results are stored in pairTransformNodes
+    self.multiStructureRegistration = True
 
     # Flag determining whether to keep temporary intermediate nodes in the scene
     # such as ROI, models, distance maps, smoothed volumes
     self.keepIntermediateNodes = False
 
+    # Volumes are resampled in-process by default (see the volumeResampler of the context).
+    # If enabled, the Resample Scalar Volume CLI is used instead
+    self.useCliResampling = False
+    # If enabled, then only the region around the fixed segment (determined the same way as the region for
+    # cropping the moving volume) is resampled instead of the whole fixed volume. Only for in-process resampling
+    self.restrictFixedResamplingToRoi = False
+    # If enabled, then only the registered segments are rasterized, directly into the labelmap geometry.
+    # Otherwise the segmentations are cloned, hardened, and all their segments are converted to labelmap
+    self.useFastSegmentRasterization = True
+    # If enabled, then the labelmaps only cover the extent of the segments on the cropped moving volume grid
+    # (only the voxels of the segments are rasterized). Only for fast segment rasterization
+    self.cropLabelmapsToSegmentExtent = True
+
+    # Pre-alignment of the moving segments to the fixed segments before registration:
+    # - 'BoundingBox': translation between the centers of the segment bounding boxes
+    # - 'Moments': rigid transform aligning the centroids and principal axes of the segments (see MomentAlignment)
+    self.preAlignmentMode = 'BoundingBox'
+
+    # Cache for the outputs of the preprocessing stages (cropping, resampling, labelmap creation).
+    # If set to a StageCache object, then stages with unchanged inputs and parameters are not recomputed
+    self.stageCache = None
+    # Cache (StageCache) for the smoothed labelmap and distance map of the fixed structure, for registering many moving
+    # structures to the same fixed structure. If set, then the fixed labelmap is created on the grid of the resampled
+    # fixed volume (instead of the cropped moving volume), so that it only depends on the fixed inputs
+    self.fixedDistanceMapCache = None
+
+    # Flag determining whether the deformable result is applied as a displacement field sampled from the B-spline
+    # transform around the fixed structures (see DisplacementFieldCache), which is much faster to evaluate when
+    # reslicing and converting the moving nodes. The B-spline transform node is kept as the registration result.
+    # The displacement field is cached in the context of the case (see RegistrationContext.displacementFieldCache)
+    self.useDisplacementFieldCache = False
+
+    # If enabled, then performRegistration runs in the batch processing state of the scene, so that observers (views,
+    # node selectors, subject hierarchy) are updated once at the end of the run instead of after each change of the
+    # scene. Unless intermediate nodes are kept, they are also hidden from the user interface and have no display nodes
+    self.useSceneBatchProcessing = True
+    # If enabled, then the MRML events invoked during performRegistration are counted (see sceneEventReport). Counting
+    # observes every node of the scene from Python, which is expensive on large scenes, so it is only meant for benchmarking
+    self.countSceneEvents = False
+
+    # If enabled, then performRegistration computes the intermediate data that is not processed by CLIs (resampled fixed
+    # volume, labelmaps, cropped and smoothed labelmaps) in a private scratch scene, which is not observed by the user
+    # interface, and the moving volume is cropped in-process (no ROI and crop parameters nodes). Only the result
+    # transforms, the cropped moving volume, and the distance maps registered by BRAINSFit are added to the main scene.
+    # Not used if intermediate nodes are kept
+    self.useScratchScene = True
+
   #------------------------------------------------------------------------------
-  def performRegistration(self):
+  @contextStage
+  def performRegistration(self, caseId=None):
+    """Perform registration workflow and record timing report (see timingReport)
+    :param caseId: Identifier of the registered case stored in the timing report
+    :return: Success, or the context if given (see contextStage)
+    """
     logging.info('Performing registration workflow')
-    self.cropMovingVolume()
-    self.preAlignSegmentations()
-    self.resampleFixedVolume()
-    self.createContourLabelmaps()
-    return self.performDistanceBasedRegistration()
+    self.caseId = caseId
+    profiler = StageProfiler('SegmentRegistration', caseId)
+    self.nodeRegistry = NodeRegistry('SegmentRegistration', caseId)
+    self.nodeRegistry.start()
+    sceneEventCounter = SceneEventCounter() if self.countSceneEvents else None
+    if sceneEventCounter is not None:
+      sceneEventCounter.start()
+    self.hideIntermediateNodes = self.useSceneBatchProcessing and not self.keepIntermediateNodes
+    self.distanceMapRegistrationLogic.hideIntermediateNodes = self.hideIntermediateNodes
+    if self.useScratchScene and not self.keepIntermediateNodes:
+      self.scratchScene = slicer.vtkMRMLScene()
+    self.distanceMapRegistrationLogic.scratchScene = self.scratchScene
+    if self.useSceneBatchProcessing:
+      slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      # Stages report failure by returning False
+      with profiler.measureStage('CropMovingVolume', [self.movingVolumeNode]) as stage:
+        stage.setSuccess(self.cropMovingVolume() is not False)
+        stage.setOutputNodes([self.movingCroppedVolumeNode])
+      with profiler.measureStage('PreAlignSegmentations', [self.movingSegmentationNode, self.fixedSegmentationNode]) as stage:
+        stage.setSuccess(self.preAlignSegmentations() is not False)
+      with profiler.measureStage('ResampleFixedVolume', [self.fixedVolumeNode]) as stage:
+        stage.setSuccess(self.resampleFixedVolume() is not False)
+        stage.setOutputNodes([self.fixedResampledVolumeNode])
+      with profiler.measureStage('CreateContourLabelmaps', [self.fixedSegmentationNode, self.movingSegmentationNode]) as stage:
+        stage.setSuccess(self.createContourLabelmaps() is not False)
+        stage.setOutputNodes([self.fixedLabelmap, self.movingLabelmap])
+      with profiler.measureStage('DistanceBasedRegistration', [self.fixedLabelmap, self.movingLabelmap]) as stage:
+        success = self.performDistanceBasedRegistration()
+        stage.setSuccess(success)
+    finally:
+      self.leakReport = self.nodeRegistry.finish(self.getResultNodes(), self.getIntermediateNodes(), not self.keepIntermediateNodes)
+      self.nodeRegistry = None
+      if not self.keepIntermediateNodes:
+        self.pairLabelmaps = []
+        self.distanceMapRegistrationLogic.intermediateNodes = []
+      # Observers are updated once when the batch processing ends
+      if self.useSceneBatchProcessing:
+        slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+      self.hideIntermediateNodes = False
+      self.distanceMapRegistrationLogic.hideIntermediateNodes = False
+      if self.scratchScene is not None:
+        self.scratchScene.Clear(1)
+        self.scratchScene = None
+        self.distanceMapRegistrationLogic.scratchScene = None
+      if sceneEventCounter is not None:
+        sceneEventCounter.stop()
+        self.sceneEventReport = sceneEventCounter.getReport()
+      else:
+        self.sceneEventReport = None
+      # Also reported if a stage raised an exception, so that the report of a previous case is not kept
+      self.timingReport = profiler.getReport()
+    self.success = success
+    return success
+
+  #------------------------------------------------------------------------------
+  def getResultNodes(self):
+    """Get nodes created by the registration workflow that are kept in the scene
+    """
+    resultNodes = [self.movingCroppedVolumeNode, self.preAlignmentMoving2FixedLinearTransform, self.affineTransformNode, self.bsplineTransformNode]
+    for pairTransformNodes in self.pairTransformNodes:
+      resultNodes.extend(pairTransformNodes)
+    return resultNodes
+
+  #------------------------------------------------------------------------------
+  def getIntermediateNodes(self):
+    """Get temporary nodes created by the registration workflow
+    """
+    return [self.fixedResampledVolumeNode, self.fixedLabelmap, self.movingLabelmap, self.fixedVolumeHardenedNode,
+      self.movingSegmentationHardenedNode, self.fixedSegmentationHardenedNode] + self.pairLabelmaps \
+      + self.distanceMapRegistrationLogic.intermediateNodes
 
   #------------------------------------------------------------------------------
+  def getIntermediateScene(self):
+    """Get scene for the intermediate nodes that are not processed by CLIs: the scratch scene of the running
+    registration if any, otherwise the main scene
+    """
+    return self.scratchScene if self.scratchScene is not None else slicer.mrmlScene
+
+  #------------------------------------------------------------------------------
+  def hideIntermediateNode(self, node):
+    """Hide intermediate node from the user interface and remove its display nodes if hideIntermediateNodes is set.
+    Hidden nodes are not added to subject hierarchy
+    """
+    if not self.hideIntermediateNodes:
+      return
+    node.SetHideFromEditors(True)
+    if node.IsA('vtkMRMLDisplayableNode'):
+      displayNodes = [node.GetNthDisplayNode(index) for index in range(node.GetNumberOfDisplayNodes())]
+      node.RemoveAllDisplayNodeIDs()
+      for displayNode in displayNodes:
+        if displayNode is not None and displayNode.GetScene() is not None:
+          displayNode.GetScene().RemoveNode(displayNode)
+
+  #------------------------------------------------------------------------------
+  def getSegmentNamePairs(self):
+    """Get list of (fixed segment name, moving segment name) tuples to register
+    """
+    if self.segmentNamePairs:
+      return list(self.segmentNamePairs)
+    return [(self.fixedSegmentName, self.movingSegmentName)]
+
+  #------------------------------------------------------------------------------
+  @contextStage
   def cropMovingVolume(self):
     logging.info('Cropping moving volume')
     if not self.movingVolumeNode or not self.movingSegmentationNode:
       logging.error('Unable to access MR volume or segmentation')
+      return False
+
+    bounds = [0]*6
+    self.movingSegmentationNode.GetSegmentation().GetBounds(bounds)
+
+    # Use cropped volume from the cache if the same volume has been cropped with the same ROI before
+    cacheKey = None
+    cachedArrays = None
+    if self.stageCache:
+      cacheKey = self.stageCache.computeKey('CropMovingVolume', volumeNodes=[self.movingVolumeNode], parameters={'bounds':bounds, 'voxelBased':True})
+      cachedArrays = self.stageCache.get(cacheKey)
+    # With a scratch scene, crop in-process so that no ROI and crop parameters nodes are added to the scene (only
+    # if the moving volume is not transformed, in which case voxel based cropping does not depend on the transform)
+    cropInProcess = self.scratchScene is not None and self.movingVolumeNode.GetParentTransformNode() is None
+    if cachedArrays or cropInProcess:
+      self.movingCroppedVolumeNode = slicer.mrmlScene.AddNewNodeByClass(self.movingVolumeNode.GetClassName(),
+        slicer.mrmlScene.GenerateUniqueName(self.movingVolumeNode.GetName() + ' cropped'))
+      if cachedArrays:
+        StageCache.updateVolumeNodeFromArrays(self.movingCroppedVolumeNode, cachedArrays)
+      else:
+        if not self.volumeResampler.crop(self.movingVolumeNode, self.movingCroppedVolumeNode, VolumeResampler.computeStructureRoiBounds(bounds)):
+          logging.error('Unable to crop moving volume')
+          return False
+        if self.stageCache:
+          self.stageCache.put(cacheKey, StageCache.arraysFromVolumeNode(self.movingCroppedVolumeNode))
+      self.movingCroppedVolumeNode.CreateDefaultDisplayNodes()
+      shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+      movingStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.movingVolumeNode))
+      if movingStudyItemID:
+        shNode.SetItemParent(shNode.GetItemByDataNode(self.movingCroppedVolumeNode), movingStudyItemID)
       return
 
     # Create ROI
     roiNode = slicer.vtkMRMLMarkupsROINode()
     roiNode.SetName('CropROI_' + self.movingVolumeNode.GetName())
+    self.hideIntermediateNode(roiNode)
     slicer.mrmlScene.AddNode(roiNode)
 
-    # Determine ROI position
-    bounds = [0]*6
-    self.movingSegmentationNode.GetSegmentation().GetBounds(bounds)
-    center = [(bounds[0]+bounds[1])/2, (bounds[2]+bounds[3])/2, (bounds[4]+bounds[5])/2]
-    roiNode.SetXYZ(center[0], center[1], center[2])
-
-    # Determine ROI size (add structure width along RL axis, square slice, add height/2 along IS)
+    # Determine ROI position and size (add structure width along RL axis, square slice, add height/2 along IS)
     #TODO: Support tilted volumes
-    structureLR3 = (bounds[1]-bounds[0]) * 3
-    structureIS2 = (bounds[5]-bounds[4]) * 2
-    radius = [structureLR3/2, structureLR3/2, structureIS2/2]
-    roiNode.SetRadiusXYZ(radius[0], radius[1], radius[2])
+    roiBounds = VolumeResampler.computeStructureRoiBounds(bounds)
+    roiNode.SetXYZ((roiBounds[0]+roiBounds[1])/2, (roiBounds[2]+roiBounds[3])/2, (roiBounds[4]+roiBounds[5])/2)
+    roiNode.SetRadiusXYZ((roiBounds[1]-roiBounds[0])/2, (roiBounds[3]-roiBounds[2])/2, (roiBounds[5]-roiBounds[4])/2)
 
     # Crop moving volume
     cropParams = slicer.vtkMRMLCropVolumeParametersNode()
@@ -409,7 +574,9 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
     self.movingCroppedVolumeNode = cropParams.GetOutputVolumeNode()
     if self.movingCroppedVolumeNode is None:
       logging.error('Unable to access cropped moving volume')
-      return
+      return False
+    if self.stageCache:
+      self.stageCache.put(cacheKey, StageCache.arraysFromVolumeNode(self.movingCroppedVolumeNode))
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     movingStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.movingVolumeNode))
     croppedMovingVolumeShItemID = shNode.GetItemByDataNode(self.movingCroppedVolumeNode)
@@ -417,54 +584,66 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
       shNode.SetItemParent(croppedMovingVolumeShItemID, movingStudyItemID)
 
     if not self.keepIntermediateNodes:
+      slicer.mrmlScene.RemoveNode(cropParams)
       slicer.mrmlScene.RemoveNode(roiNode)
     else:
       roiShItemID = shNode.GetItemByDataNode(roiNode)
       if not roiShItemID:
         logging.error('Unable to access crop ROI subject hierarchy item')
-        return
+        return False
       shNode.SetItemParent(roiShItemID, movingStudyItemID)
 
       # Hide ROI by default
       shNode.SetDisplayVisibilityForBranch(roiShItemID, 0)
 
   #------------------------------------------------------------------------------
+  @contextStage
   def preAlignSegmentations(self):
     logging.info('Pre-aligning segmentations')
     if self.movingSegmentationNode is None or self.movingVolumeNode is None or self.movingCroppedVolumeNode is None or self.fixedSegmentationNode is None:
       logging.error('Invalid data selection')
-      return
-    # Get center of segmentation bounding boxes
-    fixedBounds = [0]*6
-    fixedSegmentID = self.fixedSegmentationNode.GetSegmentation().GetSegmentIdBySegmentName(self.fixedSegmentName)
-    fixedSegment = self.fixedSegmentationNode.GetSegmentation().GetSegment(fixedSegmentID)
-    if fixedSegment is None:
+      return False
+    segmentNamePairs = self.getSegmentNamePairs()
+    if self.preAlignmentMode == 'Moments':
+      moving2FixedMatrix = self.computeMomentBasedPreAlignmentMatrix(segmentNamePairs)
+    else:
+      moving2FixedMatrix = self.computeBoundingBoxPreAlignmentMatrix(segmentNamePairs)
+    if moving2FixedMatrix is None:
+      return False
+
+    # Create alignment transform. It is not applied on (hardened into) the moving volume and segmentation, but the fixed
+    # labelmap is created in the pre-aligned frame of the moving volume, and the pre-alignment is used as initial transform
+    # of the registration. This way the inputs are not modified, and the registration results include the pre-alignment
+    self.preAlignmentMoving2FixedLinearTransform = slicer.vtkMRMLLinearTransformNode()
+    self.preAlignmentMoving2FixedLinearTransform.SetName(slicer.mrmlScene.GenerateUniqueName('PreAlignmentMoving2FixedLinearTransform'))
+    slicer.mrmlScene.AddNode(self.preAlignmentMoving2FixedLinearTransform)
+    self.preAlignmentMoving2FixedLinearTransform.SetAndObserveMatrixTransformToParent(moving2FixedMatrix)
+
+  #------------------------------------------------------------------------------
+  def computeBoundingBoxPreAlignmentMatrix(self, segmentNamePairs):
+    """Compute pre-alignment as the translation between the centers of the segment bounding boxes
+    :return: Moving to fixed matrix, None on failure
+    """
+    # Get center of segmentation bounding boxes (of all registered segments)
+    fixedBounds = self.getSegmentsBounds(self.fixedSegmentationNode, [pair[0] for pair in segmentNamePairs])
+    if fixedBounds is None:
       logging.error('Failed to get fixed segment')
       return
-    fixedSegment.GetBounds(fixedBounds)
     fixedCenter = [(fixedBounds[1]+fixedBounds[0])/2, (fixedBounds[3]+fixedBounds[2])/2, (fixedBounds[5]+fixedBounds[4])/2]
     logging.info('Fixed segment bounds: ' + repr(fixedBounds))
-    movingBounds = [0]*6
-    movingSegmentID = self.movingSegmentationNode.GetSegmentation().GetSegmentIdBySegmentName(self.movingSegmentName)
-    movingSegment = self.movingSegmentationNode.GetSegmentation().GetSegment(movingSegmentID)
-    if movingSegment is None:
+    movingBounds = self.getSegmentsBounds(self.movingSegmentationNode, [pair[1] for pair in segmentNamePairs])
+    if movingBounds is None:
       logging.error('Failed to get moving segment')
       return
-    movingSegment.GetBounds(movingBounds)
     movingCenter = [(movingBounds[1]+movingBounds[0])/2, (movingBounds[3]+movingBounds[2])/2, (movingBounds[5]+movingBounds[4])/2]
     logging.info('Moving segment bounds: ' + repr(movingBounds))
 
-    # Create alignment transform
     moving2FixedTranslation = [fixedCenter[0]-movingCenter[0], fixedCenter[1]-movingCenter[1], fixedCenter[2]-movingCenter[2]]
     logging.info('Moving to fixed segment translation: ' + repr(moving2FixedTranslation))
-    self.preAlignmentMoving2FixedLinearTransform = slicer.vtkMRMLLinearTransformNode()
-    self.preAlignmentMoving2FixedLinearTransform.SetName(slicer.mrmlScene.GenerateUniqueName('PreAlignmentMoving2FixedLinearTransform'))
-    slicer.mrmlScene.AddNode(self.preAlignmentMoving2FixedLinearTransform)
     moving2FixedMatrix = vtk.vtkMatrix4x4()
     moving2FixedMatrix.SetElement(0,3,moving2FixedTranslation[0])
     moving2FixedMatrix.SetElement(1,3,moving2FixedTranslation[1])
     moving2FixedMatrix.SetElement(2,3,moving2FixedTranslation[2])
-    self.preAlignmentMoving2FixedLinearTransform.SetAndObserveMatrixTransformToParent(moving2FixedMatrix)
 
     #TODO: This snippet shows both ROIs for testing purposes
     # roi1Node = slicer.vtkMRMLAnnotationROINode()
@@ -479,28 +658,107 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
     # roi2Node.SetRadiusXYZ((movingBounds[1]-movingBounds[0])/2, (movingBounds[3]-movingBounds[2])/2, (movingBounds[5]-movingBounds[4])/2)
     # return
 
-    # Apply transform to fixed image and segmentation
-    self.movingVolumeNode.SetAndObserveTransformNodeID(self.preAlignmentMoving2FixedLinearTransform.GetID())
-    self.movingSegmentationNode.SetAndObserveTransformNodeID(self.preAlignmentMoving2FixedLinearTransform.GetID())
-    self.movingCroppedVolumeNode.SetAndObserveTransformNodeID(self.preAlignmentMoving2FixedLinearTransform.GetID())
+    return moving2FixedMatrix
+
+  #------------------------------------------------------------------------------
+  def computeMomentBasedPreAlignmentMatrix(self, segmentNamePairs):
+    """Compute pre-alignment as the rigid transform aligning the centroids and principal axes of the segments.
+    The moments are computed on the grid of the fixed volume and of the cropped moving volume, respectively.
+    :return: Moving to fixed matrix, None on failure
+    """
+    fixedMoments = MomentAlignment.computeSegmentMoments(self.fixedSegmentationNode, [pair[0] for pair in segmentNamePairs], self.fixedVolumeNode)
+    if fixedMoments is None:
+      logging.error('Failed to compute moments of fixed segment')
+      return None
+    movingMoments = MomentAlignment.computeSegmentMoments(self.movingSegmentationNode, [pair[1] for pair in segmentNamePairs], self.movingCroppedVolumeNode)
+    if movingMoments is None:
+      logging.error('Failed to compute moments of moving segment')
+      return None
+    logging.info('Fixed segment centroid: ' + repr(list(fixedMoments[0])) + ', moving segment centroid: ' + repr(list(movingMoments[0])))
+    return MomentAlignment.computeMoving2FixedMatrix(fixedMoments, movingMoments)
 
-    # Harden transform
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.movingVolumeNode)
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.movingSegmentationNode)
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.movingCroppedVolumeNode)
+  #------------------------------------------------------------------------------
+  def getSegmentsBounds(self, segmentationNode, segmentNames):
+    """Get union of the bounds of the given segments, None if any of the segments is missing
+    """
+    unionBounds = None
+    for segmentName in segmentNames:
+      segment = segmentationNode.GetSegmentation().GetSegment(segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(segmentName))
+      if segment is None:
+        return None
+      bounds = [0]*6
+      segment.GetBounds(bounds)
+      if unionBounds is None:
+        unionBounds = bounds
+      else:
+        unionBounds = [min(unionBounds[0],bounds[0]), max(unionBounds[1],bounds[1]), min(unionBounds[2],bounds[2]),
+          max(unionBounds[3],bounds[3]), min(unionBounds[4],bounds[4]), max(unionBounds[5],bounds[5])]
+    return unionBounds
 
   #------------------------------------------------------------------------------
+  @contextStage
   def resampleFixedVolume(self):
     logging.info('Resampling fixed volume')
     if not self.fixedVolumeNode:
       logging.error('Unable to access fixed volume')
-      return
+      return False
 
     # Create output volume
     self.fixedResampledVolumeNode = slicer.vtkMRMLScalarVolumeNode()
     self.fixedResampledVolumeNode.SetName(self.fixedVolumeNode.GetName() + '_Resampled_1x1x1mm')
-    slicer.mrmlScene.AddNode(self.fixedResampledVolumeNode)
+    self.hideIntermediateNode(self.fixedResampledVolumeNode)
+    # The CLI can only resample volumes of the main scene
+    if self.useCliResampling:
+      slicer.mrmlScene.AddNode(self.fixedResampledVolumeNode)
+    else:
+      self.getIntermediateScene().AddNode(self.fixedResampledVolumeNode)
+
+    resampleParameters = {'outputPixelSpacing':'1,1,1', 'interpolationType':'lanczos'}
+    outputBounds = None
+    if self.restrictFixedResamplingToRoi and not self.useCliResampling:
+      fixedSegmentBounds = self.getSegmentsBounds(self.fixedSegmentationNode, [pair[0] for pair in self.getSegmentNamePairs()])
+      if fixedSegmentBounds is None:
+        logging.error('Failed to get fixed segment')
+        return False
+      outputBounds = VolumeResampler.computeStructureRoiBounds(
+        VolumeResampler.transformBoundsToWorld(fixedSegmentBounds, self.fixedSegmentationNode))
+      resampleParameters['outputBounds'] = outputBounds
+
+    # Use resampled volume from the cache if the same volume has been resampled with the same parameters before
+    cacheKey = None
+    cachedArrays = None
+    if self.stageCache:
+      cacheKey = self.stageCache.computeKey('ResampleFixedVolume', volumeNodes=[self.fixedVolumeNode],
+        parameters=dict(resampleParameters, useCliResampling=self.useCliResampling))
+      cachedArrays = self.stageCache.get(cacheKey)
+    if cachedArrays:
+      StageCache.updateVolumeNodeFromArrays(self.fixedResampledVolumeNode, cachedArrays)
+    elif not self.useCliResampling:
+      # Resample in-process, applying the parent transform of the fixed volume (no hardened clone is needed)
+      if not self.volumeResampler.resample(self.fixedVolumeNode, self.fixedResampledVolumeNode,
+          VolumeResampler.parseSpacing(resampleParameters['outputPixelSpacing']), resampleParameters['interpolationType'], outputBounds):
+        logging.error('Failed to resample fixed volume')
+        return False
+      if self.stageCache:
+        self.stageCache.put(cacheKey, StageCache.arraysFromVolumeNode(self.fixedResampledVolumeNode))
+    else:
+      self.resampleFixedVolumeUsingCli(resampleParameters)
+      if self.stageCache:
+        self.stageCache.put(cacheKey, StageCache.arraysFromVolumeNode(self.fixedResampledVolumeNode))
 
+    # Add resampled fixed volume to the same study as the original fixed volume
+    if self.fixedResampledVolumeNode.GetHideFromEditors() or self.fixedResampledVolumeNode.GetScene() is not slicer.mrmlScene:
+      return
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    fixedStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.fixedVolumeNode))
+    resampledFixedVolumeShItemID = shNode.GetItemByDataNode(self.fixedResampledVolumeNode)
+    if not resampledFixedVolumeShItemID:
+      logging.error('Unable to access resampled US subject hierarchy item')
+      return False
+    shNode.SetItemParent(resampledFixedVolumeShItemID, fixedStudyItemID)
+
+  #------------------------------------------------------------------------------
+  def resampleFixedVolumeUsingCli(self, resampleParameters):
     # Clone input volume and harden transform if any (the CLI does not handle parent transforms)
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     fixedVolumeShItemID = shNode.GetItemByDataNode(self.fixedVolumeNode)
@@ -508,27 +766,140 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
     fixedVolumeHardenedShItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, fixedVolumeShItemID, fixedVolumeNodeCloneName)
     shNode.SetItemParent(fixedVolumeHardenedShItemID, shNode.GetItemParent(fixedVolumeShItemID))
     self.fixedVolumeHardenedNode = shNode.GetItemDataNode(fixedVolumeHardenedShItemID)
+    self.hideIntermediateNode(self.fixedVolumeHardenedNode)
     slicer.vtkSlicerTransformLogic.hardenTransform(self.fixedVolumeHardenedNode)
 
     # Resample
-    resampleParameters = {'outputPixelSpacing':'1,1,1', 'interpolationType':'lanczos', 'InputVolume':self.fixedVolumeHardenedNode.GetID(), 'OutputVolume':self.fixedResampledVolumeNode.GetID()}
-    slicer.cli.run(slicer.modules.resamplescalarvolume, None, resampleParameters, wait_for_completion=True)
-
-    # Add resampled fixed volume to the same study as the original fixed volume
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    fixedStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.fixedVolumeNode))
-    resampledFixedVolumeShItemID = shNode.GetItemByDataNode(self.fixedResampledVolumeNode)
-    if not resampledFixedVolumeShItemID:
-      logging.error('Unable to access resampled US subject hierarchy item')
-      return
-    shNode.SetItemParent(resampledFixedVolumeShItemID, fixedStudyItemID)
+    cliParameters = dict(resampleParameters)
+    cliParameters['InputVolume'] = self.fixedVolumeHardenedNode.GetID()
+    cliParameters['OutputVolume'] = self.fixedResampledVolumeNode.GetID()
+    slicer.cli.run(slicer.modules.resamplescalarvolume, None, cliParameters, wait_for_completion=True)
 
   #------------------------------------------------------------------------------
+  @contextStage
   def createContourLabelmaps(self):
     logging.info('Creating contour labelmaps')
     if self.movingSegmentationNode is None or self.fixedSegmentationNode is None:
       logging.error('Unable to access segmentations')
+      return False
+
+    # Export segment binary labelmaps to labelmap nodes
+    self.fixedLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
+    self.fixedLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('Fixed_Structure_Padded'))
+    self.movingLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
+    self.movingLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('Moving_Structure_Padded'))
+    for labelmapNode in [self.fixedLabelmap, self.movingLabelmap]:
+      self.hideIntermediateNode(labelmapNode)
+      self.getIntermediateScene().AddNode(labelmapNode)
+      if not self.hideIntermediateNodes:
+        labelmapNode.CreateDefaultDisplayNodes()
+
+    # Use labelmaps from the cache if the same segments have been rasterized on the same reference geometry before
+    cacheKey = None
+    cachedArrays = None
+    if self.stageCache:
+      segmentNamePairs = self.getSegmentNamePairs()
+      segments = [(self.fixedSegmentationNode, pair[0]) for pair in segmentNamePairs] + [(self.movingSegmentationNode, pair[1]) for pair in segmentNamePairs]
+      referenceVolumeNodes = [self.movingCroppedVolumeNode]
+      if self.isFixedLabelmapOnFixedGrid():
+        referenceVolumeNodes.append(self.fixedResampledVolumeNode)
+      cacheKey = self.stageCache.computeKey('CreateContourLabelmaps', volumeNodes=referenceVolumeNodes,
+        segments=segments, parameters={'segmentNamePairs':segmentNamePairs,
+        'useFastSegmentRasterization':self.useFastSegmentRasterization, 'cropToSegmentExtent':self.cropLabelmapsToSegmentExtent,
+        'preAlignmentMatrix':slicer.util.arrayFromVTKMatrix(self.getPreAlignmentMatrix()).tolist()})
+      cachedArrays = self.stageCache.get(cacheKey)
+    if cachedArrays:
+      StageCache.updateVolumeNodeFromArrays(self.fixedLabelmap, cachedArrays, 'fixed')
+      StageCache.updateVolumeNodeFromArrays(self.movingLabelmap, cachedArrays, 'moving')
+    else:
+      if self.createContourLabelmapImages() is False:
+        return False
+      if self.stageCache:
+        cachedArrays = StageCache.arraysFromVolumeNode(self.fixedLabelmap, 'fixed')
+        cachedArrays.update(StageCache.arraysFromVolumeNode(self.movingLabelmap, 'moving'))
+        self.stageCache.put(cacheKey, cachedArrays)
 
+    # Add labelmaps to the corresponding studies in subject hierarchy
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    fixedStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.fixedVolumeNode))
+    movingStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.movingVolumeNode))
+    fixedLabelmapShItemID = shNode.GetItemByDataNode(self.fixedLabelmap)
+    movingLabelmapShItemID = shNode.GetItemByDataNode(self.movingLabelmap)
+    if fixedLabelmapShItemID and self.movingLabelmap:
+      shNode.SetItemParent(movingLabelmapShItemID, fixedStudyItemID)
+      shNode.SetItemParent(fixedLabelmapShItemID, movingStudyItemID)
+
+  #------------------------------------------------------------------------------
+  def createContourLabelmapImages(self):
+    """Rasterize the registered segments into the fixed and moving labelmaps
+    :return: False on failure
+    """
+    segmentNamePairs = self.getSegmentNamePairs()
+    if self.useFastSegmentRasterization:
+      # Rasterize only the registered segments directly on the (pre-aligned) cropped moving volume grid, in a single pass
+      # (pair i has label value i+1)
+      fixedSegments = [(self.fixedSegmentationNode, pair[0], pairIndex+1) for pairIndex, pair in enumerate(segmentNamePairs)]
+      movingSegments = [(self.movingSegmentationNode, pair[1], pairIndex+1) for pairIndex, pair in enumerate(segmentNamePairs)]
+      if not SegmentRasterizer.createLabelmapFromSegments(fixedSegments, self.getFixedLabelmapReferenceVolumeNode(), self.fixedLabelmap, self.cropLabelmapsToSegmentExtent) \
+          or not SegmentRasterizer.createLabelmapFromSegments(movingSegments, self.movingCroppedVolumeNode, self.movingLabelmap, self.cropLabelmapsToSegmentExtent):
+        logging.error('Failed to create labelmap nodes')
+        return False
+      return True
+
+    movingAnatomyOrientedImageData = self.createHardenedSegmentationCopies()
+    fixedReferenceVolumeNode = self.getFixedLabelmapReferenceVolumeNode()
+    fixedReferenceOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(fixedReferenceVolumeNode)
+    fixedReferenceOrientedImageData.UnRegister(None)
+
+    # Rasterize all segment pairs into one labelmap per side (pair i has label value i+1)
+    dimensions = self.movingCroppedVolumeNode.GetImageData().GetDimensions()
+    fixedLabelArray = np.zeros(dimensions[::-1], dtype=np.uint8)
+    movingLabelArray = np.zeros(dimensions[::-1], dtype=np.uint8)
+    for pairIndex, (fixedSegmentName, movingSegmentName) in enumerate(segmentNamePairs):
+      fixedSegmentArray = self.getSegmentLabelArray(self.fixedSegmentationHardenedNode, fixedSegmentName, fixedReferenceOrientedImageData)
+      movingSegmentArray = self.getSegmentLabelArray(self.movingSegmentationHardenedNode, movingSegmentName, movingAnatomyOrientedImageData)
+      if fixedSegmentArray is None or movingSegmentArray is None:
+        logging.error('Failed to create labelmap nodes')
+        return False
+      fixedLabelArray[fixedSegmentArray] = pairIndex + 1
+      movingLabelArray[movingSegmentArray] = pairIndex + 1
+
+    for labelmapNode, labelArray, referenceVolumeNode in [(self.fixedLabelmap, fixedLabelArray, fixedReferenceVolumeNode),
+        (self.movingLabelmap, movingLabelArray, self.movingCroppedVolumeNode)]:
+      labelmapNode.CopyOrientation(referenceVolumeNode)
+      slicer.util.updateVolumeFromArray(labelmapNode, labelArray)
+
+  #------------------------------------------------------------------------------
+  def isFixedLabelmapOnFixedGrid(self):
+    """With fast segment rasterization and fixed distance map caching, the fixed labelmap is created on the grid of
+    the resampled fixed volume, so that it does not depend on the moving inputs
+    """
+    return bool(self.useFastSegmentRasterization and self.fixedDistanceMapCache and self.fixedResampledVolumeNode)
+
+  #------------------------------------------------------------------------------
+  def getFixedLabelmapReferenceVolumeNode(self):
+    """Get volume defining the grid of the fixed labelmap: the resampled fixed volume (see isFixedLabelmapOnFixedGrid)
+    or the grid of the cropped moving volume mapped by the pre-alignment transform (geometry only, see
+    SegmentRasterizer.createReferenceGeometryNode)
+    """
+    if self.isFixedLabelmapOnFixedGrid():
+      return self.fixedResampledVolumeNode
+    return SegmentRasterizer.createReferenceGeometryNode(self.movingCroppedVolumeNode, self.getPreAlignmentMatrix())
+
+  #------------------------------------------------------------------------------
+  def getPreAlignmentMatrix(self):
+    """Get moving to fixed pre-alignment matrix (identity if there is no pre-alignment)
+    """
+    moving2FixedMatrix = vtk.vtkMatrix4x4()
+    if self.preAlignmentMoving2FixedLinearTransform is not None:
+      self.preAlignmentMoving2FixedLinearTransform.GetMatrixTransformToParent(moving2FixedMatrix)
+    return moving2FixedMatrix
+
+  #------------------------------------------------------------------------------
+  def createHardenedSegmentationCopies(self):
+    """Clone segmentations, harden their transforms, and convert all segments to binary labelmap
+    :return: Oriented image data with the geometry of the cropped moving volume
+    """
     # Clone segmentations and harden transform if any (so that the labelmap geometry is correct)
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     movingSegmentationShItemID = shNode.GetItemByDataNode(self.movingSegmentationNode)
@@ -536,122 +907,136 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
     movingSegmentationHardenedShItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, movingSegmentationShItemID, movingSegmentationNodeCloneName)
     shNode.SetItemParent(movingSegmentationHardenedShItemID, shNode.GetItemParent(movingSegmentationShItemID))
     self.movingSegmentationHardenedNode = shNode.GetItemDataNode(movingSegmentationHardenedShItemID)
+    self.hideIntermediateNode(self.movingSegmentationHardenedNode)
     slicer.vtkSlicerTransformLogic.hardenTransform(self.movingSegmentationHardenedNode)
     fixedSegmentationShItemID = shNode.GetItemByDataNode(self.fixedSegmentationNode)
     fixedSegmentationNodeCloneName = self.fixedSegmentationNode.GetName() + '_HardenedCopy'
     fixedSegmentationHardenedShItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, fixedSegmentationShItemID, fixedSegmentationNodeCloneName)
     shNode.SetItemParent(fixedSegmentationHardenedShItemID, shNode.GetItemParent(fixedSegmentationShItemID))
     self.fixedSegmentationHardenedNode = shNode.GetItemDataNode(fixedSegmentationHardenedShItemID)
+    self.hideIntermediateNode(self.fixedSegmentationHardenedNode)
     slicer.vtkSlicerTransformLogic.hardenTransform(self.fixedSegmentationHardenedNode)
 
     # Make sure the segmentations have the labelmaps
     self.movingSegmentationHardenedNode.GetSegmentation().CreateRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName())
     self.fixedSegmentationHardenedNode.GetSegmentation().CreateRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName())
-    # Get labelmap oriented image data
-    movingOrientedImageData = slicer.vtkOrientedImageData()
-    movingSegmentID = self.movingSegmentationHardenedNode.GetSegmentation().GetSegmentIdBySegmentName(self.movingSegmentName)
-    movingOrientedImageData.DeepCopy(self.movingSegmentationHardenedNode.GetSegmentation().GetSegment(movingSegmentID).GetRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()))
-    fixedOrientedImageData = slicer.vtkOrientedImageData()
-    fixedSegmentID = self.fixedSegmentationHardenedNode.GetSegmentation().GetSegmentIdBySegmentName(self.fixedSegmentName)
-    fixedOrientedImageData.DeepCopy(self.fixedSegmentationHardenedNode.GetSegmentation().GetSegment(fixedSegmentID).GetRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()))
 
     # Get moving anatomy volume geometry
     movingAnatomyOrientedImageData = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(self.movingCroppedVolumeNode)
     movingAnatomyOrientedImageData.UnRegister(None)
+    return movingAnatomyOrientedImageData
 
-    # Ensure same geometry of oriented image data
-    if not slicer.vtkOrientedImageDataResample.DoGeometriesMatch(movingOrientedImageData, movingAnatomyOrientedImageData) \
-        or not slicer.vtkOrientedImageDataResample.DoExtentsMatch(movingOrientedImageData, movingAnatomyOrientedImageData):
-      slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(movingOrientedImageData, movingAnatomyOrientedImageData, movingOrientedImageData)
-    if not slicer.vtkOrientedImageDataResample.DoGeometriesMatch(fixedOrientedImageData, movingAnatomyOrientedImageData) \
-        or not slicer.vtkOrientedImageDataResample.DoExtentsMatch(fixedOrientedImageData, movingAnatomyOrientedImageData):
-      slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(fixedOrientedImageData, movingAnatomyOrientedImageData, fixedOrientedImageData)
-
-    # Export segment binary labelmaps to labelmap nodes
-    self.fixedLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
-    self.fixedLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('Fixed_Structure_Padded'))
-    slicer.mrmlScene.AddNode(self.fixedLabelmap)
-    self.fixedLabelmap.CreateDefaultDisplayNodes()
-
-    self.movingLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
-    self.movingLabelmap.SetName(slicer.mrmlScene.GenerateUniqueName('Moving_Structure_Padded'))
-    slicer.mrmlScene.AddNode(self.movingLabelmap)
-    self.movingLabelmap.CreateDefaultDisplayNodes()
+  #------------------------------------------------------------------------------
+  def getSegmentLabelArray(self, segmentationNode, segmentName, referenceOrientedImageData):
+    """Get binary labelmap of a segment resampled to the reference geometry
+    :return: Boolean NumPy array (KJI), None if the segment is not found
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    segment = segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(segmentName))
+    if segment is None:
+      logging.error('Failed to get segment ' + segmentName)
+      return None
+    segmentOrientedImageData = slicer.vtkOrientedImageData()
+    segmentOrientedImageData.DeepCopy(segment.GetRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()))
 
-    ret1 = slicer.vtkSlicerSegmentationsModuleLogic.CreateLabelmapVolumeFromOrientedImageData(fixedOrientedImageData, self.fixedLabelmap)
-    ret2 = slicer.vtkSlicerSegmentationsModuleLogic.CreateLabelmapVolumeFromOrientedImageData(movingOrientedImageData, self.movingLabelmap)
-    if ret1 is False or ret2 is False:
-      logging.error('Failed to create labelmap nodes')
+    # Ensure same geometry of oriented image data
+    if not slicer.vtkOrientedImageDataResample.DoGeometriesMatch(segmentOrientedImageData, referenceOrientedImageData) \
+        or not slicer.vtkOrientedImageDataResample.DoExtentsMatch(segmentOrientedImageData, referenceOrientedImageData):
+      slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(segmentOrientedImageData, referenceOrientedImageData, segmentOrientedImageData)
 
-    # Add labelmaps to the corresponding studies in subject hierarchy
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    fixedStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.fixedVolumeNode))
-    movingStudyItemID = shNode.GetItemParent(shNode.GetItemByDataNode(self.movingVolumeNode))
-    fixedLabelmapShItemID = shNode.GetItemByDataNode(self.fixedLabelmap)
-    movingLabelmapShItemID = shNode.GetItemByDataNode(self.movingLabelmap)
-    if fixedLabelmapShItemID and self.movingLabelmap:
-      shNode.SetItemParent(movingLabelmapShItemID, fixedStudyItemID)
-      shNode.SetItemParent(fixedLabelmapShItemID, movingStudyItemID)
+    # Segments may share the labelmap with other segments, in which case they are distinguished by label value
+    dimensions = segmentOrientedImageData.GetDimensions()
+    segmentArray = numpy_support.vtk_to_numpy(segmentOrientedImageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+    return segmentArray == segment.GetLabelValue()
 
   #------------------------------------------------------------------------------
+  @contextStage
   def performDistanceBasedRegistration(self):
     logging.info('Performing distance based registration')
 
-    # Register using Distance Map Based Registration
-    slicer.modules.distancemapbasedregistration.createNewWidgetRepresentation()
-    distMapRegModuleWidget = slicer.modules.DistanceMapBasedRegistrationWidget
-    distMapRegModuleWidget.fixedImageSelector.setCurrentNode(self.fixedVolumeNode)
-    distMapRegModuleWidget.fixedImageLabelSelector.setCurrentNode(self.fixedLabelmap)
-    distMapRegModuleWidget.movingImageSelector.setCurrentNode(self.movingVolumeNode)
-    distMapRegModuleWidget.movingImageLabelSelector.setCurrentNode(self.movingLabelmap)
-    self.affineTransformNode = distMapRegModuleWidget.affineTransformSelector.addNode()
-    self.bsplineTransformNode = distMapRegModuleWidget.bsplineTransformSelector.addNode()
-    success = True
-    try:
-      distMapRegModuleWidget.applyButton.click()
-    except:
-      success = False
+    # Create output transforms
+    self.affineTransformNode = slicer.vtkMRMLLinearTransformNode()
+    self.affineTransformNode.SetName(slicer.mrmlScene.GenerateUniqueName('Affine Transform'))
+    slicer.mrmlScene.AddNode(self.affineTransformNode)
+    self.bsplineTransformNode = slicer.vtkMRMLBSplineTransformNode()
+    self.bsplineTransformNode.SetName(slicer.mrmlScene.GenerateUniqueName('Deformable Transform'))
+    slicer.mrmlScene.AddNode(self.bsplineTransformNode)
+
+    # Register using distance map based registration directly on the labelmaps (no widget is needed).
+    # In case of multiple segment pairs, all structures are registered together, unless separate registration is requested
+    self.pairTransformNodes = []
+    segmentNamePairs = self.getSegmentNamePairs()
+    self.distanceMapRegistrationLogic.fixedDistanceMapCache = self.fixedDistanceMapCache
+    if self.multiStructureRegistration or len(segmentNamePairs) == 1:
+      success = self.distanceMapRegistrationLogic.run(self.fixedLabelmap, self.movingLabelmap, self.affineTransformNode, self.bsplineTransformNode,
+        self.preAlignmentMoving2FixedLinearTransform)
+    else:
+      success = self.performPairwiseDistanceBasedRegistration(segmentNamePairs)
+    if not success:
       logging.error('Distance map based registration failed')
-      return
 
-    if not self.keepIntermediateNodes:
-      qt.QTimer.singleShot(250, self.removeIntermedateNodes) # Otherwise Slicer crashes
-    else:
+    if self.keepIntermediateNodes:
       # Move nodes created by the distance map based registration ot the proper subject hierarchy branches
       pass #TODO
+    elif self.nodeRegistry is None:
+      # Within performRegistration the intermediate nodes are removed by the node registry at the end of the run
+      self.removeIntermedateNodes()
 
     return success
 
+  #------------------------------------------------------------------------------
+  def performPairwiseDistanceBasedRegistration(self, segmentNamePairs):
+    """Register each segment pair separately using the common labelmaps. The first pair is registered
+    into affineTransformNode and bsplineTransformNode, the others into new transform nodes
+    """
+    fixedLabelArray = slicer.util.arrayFromVolume(self.fixedLabelmap)
+    movingLabelArray = slicer.util.arrayFromVolume(self.movingLabelmap)
+    for pairIndex, (fixedSegmentName, movingSegmentName) in enumerate(segmentNamePairs):
+      pairLabelmaps = []
+      for sourceLabelmap, labelArray, segmentName in [(self.fixedLabelmap, fixedLabelArray, fixedSegmentName), (self.movingLabelmap, movingLabelArray, movingSegmentName)]:
+        pairLabelmap = slicer.vtkMRMLLabelMapVolumeNode()
+        pairLabelmap.SetName(self.getIntermediateScene().GenerateUniqueName(sourceLabelmap.GetName() + '_' + segmentName))
+        self.hideIntermediateNode(pairLabelmap)
+        self.getIntermediateScene().AddNode(pairLabelmap)
+        pairLabelmap.CopyOrientation(sourceLabelmap)
+        slicer.util.updateVolumeFromArray(pairLabelmap, (labelArray == pairIndex + 1).astype(np.uint8))
+        pairLabelmaps.append(pairLabelmap)
+      self.pairLabelmaps.extend(pairLabelmaps)
+
+      if pairIndex == 0:
+        affineTransformNode, bsplineTransformNode = self.affineTransformNode, self.bsplineTransformNode
+      else:
+        affineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', slicer.mrmlScene.GenerateUniqueName('Affine Transform ' + movingSegmentName))
+        bsplineTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLBSplineTransformNode', slicer.mrmlScene.GenerateUniqueName('Deformable Transform ' + movingSegmentName))
+      self.pairTransformNodes.append((affineTransformNode, bsplineTransformNode))
+
+      logging.info('Registering segment pair %s - %s' % (fixedSegmentName, movingSegmentName))
+      if not self.distanceMapRegistrationLogic.run(pairLabelmaps[0], pairLabelmaps[1], affineTransformNode, bsplineTransformNode,
+          self.preAlignmentMoving2FixedLinearTransform):
+        return False
+    return True
+
   #------------------------------------------------------------------------------
   def removeIntermedateNodes(self):
-    # Remove nodes created during preprocessing for the distance based registration
-    slicer.mrmlScene.RemoveNode(self.fixedResampledVolumeNode)
-    slicer.mrmlScene.RemoveNode(self.fixedLabelmap)
-    slicer.mrmlScene.RemoveNode(self.movingLabelmap)
-    slicer.mrmlScene.RemoveNode(self.fixedVolumeHardenedNode)
-    slicer.mrmlScene.RemoveNode(self.movingSegmentationHardenedNode)
-    slicer.mrmlScene.RemoveNode(self.fixedSegmentationHardenedNode)
-
-    # Remove nodes created by distance based registration
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Fixed_Structure_Padded-Cropped'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Fixed_Structure_Padded-Smoothed'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Fixed_Structure_Padded-DistanceMap'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Fixed_Structure_Padded-surface'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Moving_Structure_Padded-Cropped'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Moving_Structure_Padded-Smoothed'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Moving_Structure_Padded-DistanceMap'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('Moving_Structure_Padded-surface'))
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode('MovingImageCopy'))
+    # Remove nodes created during preprocessing and by the distance based registration
+    for node in self.getIntermediateNodes():
+      if node is not None and node.GetScene() is not None:
+        node.GetScene().RemoveNode(node)
+    self.pairLabelmaps = []
+    self.distanceMapRegistrationLogic.intermediateNodes = []
 
   #------------------------------------------------------------------------------
+  @contextStage
   def applyNoTransformation(self):
     if self.movingVolumeNode is None or self.movingSegmentationNode is None:
       logging.error('Failed to apply transformation on moving volume and segmentation')
-    # Apply transform on moving volume and segmentation
-    self.movingVolumeNode.SetAndObserveTransformNodeID(None)
-    self.movingSegmentationNode.SetAndObserveTransformNodeID(None)
+    # The pre-alignment is not hardened into the moving volume and segmentation, so show them pre-aligned
+    preAlignmentTransformNodeID = self.preAlignmentMoving2FixedLinearTransform.GetID() if self.preAlignmentMoving2FixedLinearTransform else None
+    self.movingVolumeNode.SetAndObserveTransformNodeID(preAlignmentTransformNodeID)
+    self.movingSegmentationNode.SetAndObserveTransformNodeID(preAlignmentTransformNodeID)
 
   #------------------------------------------------------------------------------
+  @contextStage
   def applyRigidTransformation(self):
     if self.movingVolumeNode is None or self.movingSegmentationNode is None:
       logging.error('Failed to apply transformation on moving volume and segmentation')
@@ -660,12 +1045,33 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
     self.movingSegmentationNode.SetAndObserveTransformNodeID(self.affineTransformNode.GetID())
 
   #------------------------------------------------------------------------------
+  @contextStage
   def applyDeformableTransformation(self):
     if self.movingVolumeNode is None or self.movingSegmentationNode is None:
       logging.error('Failed to apply transformation on moving volume and segmentation')
     # Apply transform on moving volume and segmentation
-    self.movingVolumeNode.SetAndObserveTransformNodeID(self.bsplineTransformNode.GetID())
-    self.movingSegmentationNode.SetAndObserveTransformNodeID(self.bsplineTransformNode.GetID())
+    deformableTransformNode = self.getDeformableResultTransformNode()
+    self.movingVolumeNode.SetAndObserveTransformNodeID(deformableTransformNode.GetID())
+    self.movingSegmentationNode.SetAndObserveTransformNodeID(deformableTransformNode.GetID())
+
+  #------------------------------------------------------------------------------
+  def getDeformableResultTransformNode(self):
+    """Get transform node to apply as deformable result: the B-spline transform, or its cached displacement field
+    if useDisplacementFieldCache is enabled. The displacement field is recomputed only if the B-spline transform
+    was modified since it was last sampled
+    """
+    if not self.useDisplacementFieldCache:
+      return self.bsplineTransformNode
+    fixedSegmentNames = [fixedSegmentName for fixedSegmentName, movingSegmentName in self.getSegmentNamePairs()]
+    fixedBounds = self.getSegmentsBounds(self.fixedSegmentationNode, fixedSegmentNames)
+    if fixedBounds is None:
+      logging.error('Failed to get fixed segment bounds for the displacement field')
+      return self.bsplineTransformNode
+    roiBounds = VolumeResampler.computeStructureRoiBounds(VolumeResampler.transformBoundsToWorld(fixedBounds, self.fixedSegmentationNode))
+    gridTransformNode = self.displacementFieldCache.getGridTransformNode(self.bsplineTransformNode, roiBounds)
+    if gridTransformNode is None:
+      return self.bsplineTransformNode
+    return gridTransformNode
 
   #------------------------------------------------------------------------------
   def setupResultVisualization(self):
@@ -697,6 +1103,9 @@ class SegmentRegistrationLogic(ScriptedLoadableModuleLogic):
       return
     movingSegmentationDisplayNode.SetSegmentOpacity(movingSegmentID, 0.5)
 
+# Per-case attributes of the logic refer to its current context
+addContextProperties(SegmentRegistrationLogic, RegistrationContext)
+
 
 #
 # -----------------------------------------------------------------------------
@@ -830,6 +1239,8 @@ class SegmentRegistrationTest(ScriptedLoadableModuleTest):
       self.assertIsNotNone(affineTransformNode)
       deformableTransformNode = slicer.util.getNode('Deformable Transform')
       self.assertIsNotNone(deformableTransformNode)
+      # Pre-alignment is included in the registration result instead of being hardened into the inputs
+      self.assertIsNone(mrSegmentationNode.GetParentTransformNode())
 
       # Set transforms and visualization
       moduleWidget.onRegistrationSuccessful()
@@ -839,12 +1250,625 @@ class SegmentRegistrationTest(ScriptedLoadableModuleTest):
       self.assertIsNotNone(mrVolumeNode)
       self.assertIsNotNone(mrVolumeNode.GetParentTransformNode())
 
+      # Switch between the results. The pre-alignment is not hardened into the inputs, so it is applied when no
+      # registration result is shown
+      for radioButton, transformNode in [(moduleWidget.noRegistrationRadioButton, preAlignmentTransformNode),
+          (moduleWidget.rigidRegistrationRadioButton, affineTransformNode),
+          (moduleWidget.deformableRegistrationRadioButton, moduleWidget.logic.getDeformableResultTransformNode())]:
+        radioButton.click()
+        self.assertEqual(mrVolumeNode.GetTransformNodeID(), transformNode.GetID())
+        self.assertEqual(mrSegmentationNode.GetTransformNodeID(), transformNode.GetID())
+
     except Exception as e:
       import traceback
       traceback.print_exc()
       self.delayDisplay('Test caused exception!\n' + str(e),self.delayMs*2)
       raise Exception("Exception occurred, handled, thrown further to workflow level")
 
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_SyntheticPhantom(self):
+    # Register synthetic phantoms with known ground truth transform (no data download needed)
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Register synthetic phantoms",self.delayMs)
+
+    record = RegistrationBenchmark.runConfiguration('small', 'affine')
+    self.assertTrue(record['success'])
+    self.assertIsNotNone(record['timing'])
+    stageNames = [stage['name'] for stage in record['timing']['stages']]
+    for stageName in ['CropMovingVolume', 'ResampleFixedVolume', 'CreateContourLabelmaps', 'DistanceBasedRegistration']:
+      self.assertIn(stageName, stageNames)
+    self.assertTrue(all([stage['success'] for stage in record['timing']['stages']]))
+    self.assertLess(record['tre']['meanMm'], record['initialTre']['meanMm'])
+    self.assertGreater(record['overlap']['dice'], 0.8)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_StageCache(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Stage cache",self.delayMs)
+
+    volumeNode, segmentationNode, _ = RegistrationBenchmark.createPhantomNodes('CachePhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    cache = StageCache(os.path.join(slicer.app.temporaryPath, 'SegmentRegistrationTestStageCache'))
+    cache.clear()
+    key = cache.computeKey('Test', volumeNodes=[volumeNode], segments=[(segmentationNode, 'Structure')], parameters={'spacing': '1,1,1'})
+    self.assertIsNotNone(key)
+    self.assertIsNone(cache.get(key))
+
+    # Hit after put
+    cache.put(key, {'output': np.arange(10, dtype=np.int16)})
+    cachedArrays = cache.get(key)
+    self.assertIsNotNone(cachedArrays)
+    np.testing.assert_array_equal(cachedArrays['output'], np.arange(10, dtype=np.int16))
+    self.assertEqual(cache.computeKey('Test', volumeNodes=[volumeNode], segments=[(segmentationNode, 'Structure')], parameters={'spacing': '1,1,1'}), key)
+
+    # Changed parameters, segments, or voxels give a different key
+    self.assertNotEqual(cache.computeKey('Test', volumeNodes=[volumeNode], segments=[(segmentationNode, 'Structure')], parameters={'spacing': '2,2,2'}), key)
+    self.assertNotEqual(cache.computeKey('Test', volumeNodes=[volumeNode], parameters={'spacing': '1,1,1'}), key)
+    voxels = slicer.util.arrayFromVolume(volumeNode)
+    voxels[0,0,0] += 1
+    slicer.util.arrayFromVolumeModified(volumeNode)
+    self.assertNotEqual(cache.computeKey('Test', volumeNodes=[volumeNode], segments=[(segmentationNode, 'Structure')], parameters={'spacing': '1,1,1'}), key)
+    cache.clear()
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_StageProfiler(self):
+    from SegmentRegistrationLib.StageProfiler import aggregateTimingReports
+    self.delayDisplay("Stage profiler",self.delayMs)
+
+    # Stages fail if they raise or report failure, and are recorded in both cases
+    profiler = StageProfiler('Test', 'Case1')
+    with profiler.measureStage('Succeeding') as stage:
+      stage.setOutputNodes([None])
+    with profiler.measureStage('Failing') as stage:
+      stage.setSuccess(False)
+    with self.assertRaises(ValueError):
+      with profiler.measureStage('Raising'):
+        raise ValueError('Stage error')
+    measurement = profiler.measureStage('Stopped')
+    measurement.start()
+    measurement.stop(False)
+    report = profiler.getReport()
+    self.assertEqual([stage['name'] for stage in report['stages']], ['Succeeding', 'Failing', 'Raising', 'Stopped'])
+    self.assertEqual([stage['success'] for stage in report['stages']], [True, False, False, False])
+
+    aggregatedReport = aggregateTimingReports([report, report])
+    self.assertEqual(aggregatedReport['numberOfCases'], 2)
+    self.assertEqual([stage['numberOfFailures'] for stage in aggregatedReport['stages']], [0, 2, 2, 2])
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_DistanceMaps(self):
+    from SegmentRegistrationLib import DistanceMapRegistrationLogic
+    self.delayDisplay("Distance maps",self.delayMs)
+
+    # Two adjacent structures with different labels
+    labelArray = np.zeros([20, 30, 40], dtype=np.uint8)
+    labelArray[5:15, 5:25, 5:20] = 1
+    labelArray[5:15, 5:25, 20:35] = 2
+    logic = DistanceMapRegistrationLogic()
+    arrays = logic.computeDistanceMapArrays(labelArray, [1.0, 1.0, 1.0])
+    self.assertEqual(arrays['cropped'].shape, tuple([extent + 2 * logic.labelmapPaddingVoxels for extent in [10, 20, 30]]))
+    self.assertEqual(set(np.unique(arrays['smoothed'])), set([0, 1, 2]))
+    # Each structure contributes a distance map, so the boundary between the structures is kept (it would be
+    # deep inside the union of the structures if they were merged into one binary labelmap)
+    unionArrays = logic.computeDistanceMapArrays((labelArray > 0).astype(np.uint8), [1.0, 1.0, 1.0])
+    boundaryIndex = (10-arrays['lower'][0], 15-arrays['lower'][1], 20-arrays['lower'][2])
+    self.assertGreater(arrays['distanceMap'][boundaryIndex] - unionArrays['distanceMap'][boundaryIndex], 2.0)
+    self.assertIsNone(logic.computeDistanceMapArrays(np.zeros([5, 5, 5], dtype=np.uint8), [1.0, 1.0, 1.0]))
+
+    # Labelmaps with different labels are rejected, because their summed distance maps do not correspond
+    fixedLabelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'FixedLabels')
+    slicer.util.updateVolumeFromArray(fixedLabelmapNode, labelArray)
+    movingLabelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'MovingLabels')
+    slicer.util.updateVolumeFromArray(movingLabelmapNode, (labelArray == 1).astype(np.uint8))
+    self.assertFalse(logic.computeDistanceMaps(fixedLabelmapNode, movingLabelmapNode))
+    self.assertEqual(len(logic.intermediateNodes), 0)
+    slicer.util.updateVolumeFromArray(movingLabelmapNode, labelArray)
+    self.assertTrue(logic.computeDistanceMaps(fixedLabelmapNode, movingLabelmapNode))
+    self.assertIsNotNone(logic.fixedDistanceMapNode)
+    self.assertIsNotNone(logic.movingDistanceMapNode)
+    logic.removeIntermediateNodes()
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_VolumeResampler(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Volume resampler",self.delayMs)
+
+    volumeNode, _, _ = RegistrationBenchmark.createPhantomNodes('ResamplePhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    resampler = VolumeResampler()
+
+    # In-process resampling gives the same geometry and nearly the same voxels as the CLI
+    cliOutputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledByCli')
+    cliNode = slicer.cli.run(slicer.modules.resamplescalarvolume, None, {'outputPixelSpacing':'2,2,2', 'interpolationType':'linear',
+      'InputVolume':volumeNode.GetID(), 'OutputVolume':cliOutputNode.GetID()}, wait_for_completion=True)
+    slicer.mrmlScene.RemoveNode(cliNode)
+    outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledInProcess')
+    self.assertTrue(resampler.resample(volumeNode, outputNode, [2.0, 2.0, 2.0], 'linear'))
+    self.assertEqual(outputNode.GetImageData().GetDimensions(), cliOutputNode.GetImageData().GetDimensions())
+    for axis in range(3):
+      self.assertAlmostEqual(outputNode.GetSpacing()[axis], cliOutputNode.GetSpacing()[axis], places=4)
+      self.assertAlmostEqual(outputNode.GetOrigin()[axis], cliOutputNode.GetOrigin()[axis], places=3)
+    outputArray = slicer.util.arrayFromVolume(outputNode).astype(np.float64)
+    cliOutputArray = slicer.util.arrayFromVolume(cliOutputNode).astype(np.float64)
+    self.assertLess(np.abs(outputArray - cliOutputArray).mean(), 1.0)
+
+    # Resampling on a worker thread gives the same result, and the output is only updated when the task is applied
+    taskOutputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledInBackground')
+    task = resampler.resample(volumeNode, taskOutputNode, [2.0, 2.0, 2.0], 'linear', waitForCompletion=False)
+    task.start()
+    task.thread.join()
+    self.assertIsNone(taskOutputNode.GetImageData())
+    self.assertTrue(task.apply())
+    np.testing.assert_array_equal(slicer.util.arrayFromVolume(taskOutputNode), slicer.util.arrayFromVolume(outputNode))
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_RoiRestrictedResampling(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("ROI restricted resampling",self.delayMs)
+
+    volumeNode, _, _ = RegistrationBenchmark.createPhantomNodes('RoiResamplePhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    resampler = VolumeResampler()
+    fullOutputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledFull')
+    self.assertTrue(resampler.resample(volumeNode, fullOutputNode, [2.0, 2.0, 2.0], 'linear'))
+    roiOutputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledRoi')
+    roiBounds = [-10.0, 10.0, -12.0, 8.0, -6.0, 14.0]
+    self.assertTrue(resampler.resample(volumeNode, roiOutputNode, [2.0, 2.0, 2.0], 'linear', roiBounds))
+
+    # Same spacing and axes, and the region covers the bounds with at most one voxel margin
+    roiDimensions = roiOutputNode.GetImageData().GetDimensions()
+    self.assertTrue(all([roiDimensions[axis] < fullOutputNode.GetImageData().GetDimensions()[axis] for axis in range(3)]))
+    for axis in range(3):
+      self.assertAlmostEqual(roiOutputNode.GetSpacing()[axis], fullOutputNode.GetSpacing()[axis], places=4)
+    roiVolumeBounds = [0.0]*6
+    roiOutputNode.GetRASBounds(roiVolumeBounds)
+    for axis in range(3):
+      spacing = roiOutputNode.GetSpacing()[axis]
+      self.assertLessEqual(roiVolumeBounds[2*axis], roiBounds[2*axis] + 0.5*spacing)
+      self.assertGreaterEqual(roiVolumeBounds[2*axis], roiBounds[2*axis] - 1.5*spacing)
+      self.assertGreaterEqual(roiVolumeBounds[2*axis+1], roiBounds[2*axis+1] - 0.5*spacing)
+      self.assertLessEqual(roiVolumeBounds[2*axis+1], roiBounds[2*axis+1] + 1.5*spacing)
+
+    # The voxels are those of the corresponding block of the full resampled volume
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    fullOutputNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    lower = [int(round(index)) for index in rasToIjkMatrix.MultiplyPoint(list(roiOutputNode.GetOrigin()) + [1.0])[:3]]
+    fullArray = slicer.util.arrayFromVolume(fullOutputNode)
+    np.testing.assert_array_equal(slicer.util.arrayFromVolume(roiOutputNode), fullArray[lower[2]:lower[2]+roiDimensions[2],
+      lower[1]:lower[1]+roiDimensions[1], lower[0]:lower[0]+roiDimensions[0]])
+
+    # Region outside the volume
+    self.assertFalse(resampler.resample(volumeNode, roiOutputNode, [2.0, 2.0, 2.0], 'linear', [500.0, 510.0, 500.0, 510.0, 500.0, 510.0]))
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_SegmentRasterizer(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Segment rasterizer",self.delayMs)
+
+    volumeNode, segmentationNode, labelArray = RegistrationBenchmark.createPhantomNodes('RasterizePhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    numberOfSegmentationNodes = slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLSegmentationNode')
+    segmentArray, extent = SegmentRasterizer.getSegmentLabelArray(segmentationNode, 'Structure', volumeNode)
+    # The segment was imported from a labelmap on the same grid, so the voxels are the same
+    np.testing.assert_array_equal(segmentArray, labelArray > 0)
+    self.assertEqual(list(extent), [0, 31, 0, 31, 0, 23])
+    # The segmentation is not cloned
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLSegmentationNode'), numberOfSegmentationNodes)
+    self.assertEqual(SegmentRasterizer.getSegmentLabelArray(segmentationNode, 'Missing', volumeNode), (None, None))
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_SegmentExtentLabelmap(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Labelmap cropped to segment extent",self.delayMs)
+
+    volumeNode, segmentationNode, labelArray = RegistrationBenchmark.createPhantomNodes('ExtentPhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    labelmapArrays = {}
+    for cropToSegmentExtent in [True, False]:
+      labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+      self.assertTrue(SegmentRasterizer.createLabelmapFromSegments([(segmentationNode, 'Structure', 2)], volumeNode, labelmapNode, cropToSegmentExtent))
+      rasterizedArray = slicer.util.arrayFromVolume(labelmapNode)
+      # The segment was imported from a labelmap on the same grid, so the voxels are the same
+      self.assertEqual(np.count_nonzero(rasterizedArray == 2), np.count_nonzero(labelArray))
+      self.assertEqual(rasterizedArray.shape == labelArray.shape, not cropToSegmentExtent)
+      labelmapArrays[cropToSegmentExtent] = (rasterizedArray, labelmapNode)
+
+    # The cropped labelmap is the block of the full labelmap at its origin
+    croppedArray, croppedLabelmapNode = labelmapArrays[True]
+    fullArray, fullLabelmapNode = labelmapArrays[False]
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    fullLabelmapNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    lower = [int(round(index)) for index in rasToIjkMatrix.MultiplyPoint(list(croppedLabelmapNode.GetOrigin()) + [1.0])[:3]]
+    np.testing.assert_array_equal(croppedArray, fullArray[lower[2]:lower[2]+croppedArray.shape[0],
+      lower[1]:lower[1]+croppedArray.shape[1], lower[0]:lower[0]+croppedArray.shape[2]])
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_MomentAlignment(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Moment alignment",self.delayMs)
+
+    volumeNode, segmentationNode, _ = RegistrationBenchmark.createPhantomNodes('MomentPhantom', [48, 48, 32], [2.0, 2.0, 3.0])
+    fixedMoments = MomentAlignment.computeSegmentMoments(segmentationNode, ['Structure'], volumeNode)
+    self.assertIsNotNone(fixedMoments)
+    # The phantom is centered at the origin
+    np.testing.assert_allclose(fixedMoments[0], [0.0, 0.0, 0.0], atol=0.5)
+
+    # Translated copy of the phantom is aligned back by the translation only
+    translationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+    translationMatrix = vtk.vtkMatrix4x4()
+    translationMatrix.SetElement(0, 3, 6.0)
+    translationMatrix.SetElement(1, 3, -4.0)
+    translationNode.SetMatrixTransformToParent(translationMatrix)
+    segmentationNode.SetAndObserveTransformNodeID(translationNode.GetID())
+    movingMoments = MomentAlignment.computeSegmentMoments(segmentationNode, ['Structure'], volumeNode)
+    self.assertIsNotNone(movingMoments)
+    moving2FixedMatrix = MomentAlignment.computeMoving2FixedMatrix(fixedMoments, movingMoments)
+    moving2FixedArray = slicer.util.arrayFromVTKMatrix(moving2FixedMatrix)
+    np.testing.assert_allclose(moving2FixedArray[:3,:3], np.eye(3), atol=0.02)
+    np.testing.assert_allclose(moving2FixedArray[:3,3], [-6.0, 4.0, 0.0], atol=0.5)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_FixedDistanceMapCache(self):
+    from SegmentRegistrationLib import DistanceMapRegistrationLogic
+    self.delayDisplay("Fixed distance map cache",self.delayMs)
+
+    labelArray = np.zeros([20, 30, 40], dtype=np.uint8)
+    labelArray[5:15, 5:25, 5:35] = 1
+    fixedLabelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'CachedFixed')
+    slicer.util.updateVolumeFromArray(fixedLabelmapNode, labelArray)
+    movingLabelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'CachedMoving')
+    slicer.util.updateVolumeFromArray(movingLabelmapNode, np.roll(labelArray, 2, axis=2))
+
+    logic = DistanceMapRegistrationLogic()
+    logic.fixedDistanceMapCache = StageCache(os.path.join(slicer.app.temporaryPath, 'SegmentRegistrationTestDistanceMapCache'))
+    logic.fixedDistanceMapCache.clear()
+    # Count the labelmaps processed by the distance map computation
+    computedLabelArrays = []
+    computeDistanceMapArrays = logic.computeDistanceMapArrays
+    def countingComputeDistanceMapArrays(labelArray, spacing):
+      computedLabelArrays.append(labelArray)
+      return computeDistanceMapArrays(labelArray, spacing)
+    logic.computeDistanceMapArrays = countingComputeDistanceMapArrays
+
+    # First run computes both sides and stores the fixed side
+    self.assertTrue(logic.computeDistanceMaps(fixedLabelmapNode, movingLabelmapNode))
+    self.assertEqual(len(computedLabelArrays), 2)
+    fixedDistanceArray = slicer.util.arrayFromVolume(logic.fixedDistanceMapNode).copy()
+    logic.removeIntermediateNodes()
+
+    # Second run with the same fixed labelmap only computes the moving side
+    self.assertTrue(logic.computeDistanceMaps(fixedLabelmapNode, movingLabelmapNode))
+    self.assertEqual(len(computedLabelArrays), 3)
+    np.testing.assert_array_equal(computedLabelArrays[-1], slicer.util.arrayFromVolume(movingLabelmapNode))
+    np.testing.assert_array_equal(slicer.util.arrayFromVolume(logic.fixedDistanceMapNode), fixedDistanceArray)
+    logic.removeIntermediateNodes()
+
+    # Modified fixed labelmap is not found in the cache
+    slicer.util.updateVolumeFromArray(fixedLabelmapNode, np.roll(labelArray, 1, axis=1))
+    self.assertTrue(logic.computeDistanceMaps(fixedLabelmapNode, movingLabelmapNode))
+    self.assertEqual(len(computedLabelArrays), 5)
+    logic.removeIntermediateNodes()
+    logic.fixedDistanceMapCache.clear()
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_TransformationModes(self):
+    # Switch the applied result after registering synthetic phantoms (no data download needed)
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Switch applied registration result",self.delayMs)
+
+    fixedVolumeNode, fixedSegmentationNode, _ = RegistrationBenchmark.createPhantomNodes('ModesFixed', [32, 32, 24], [3.0, 3.0, 4.0])
+    groundTruthTransform = RegistrationBenchmark.GroundTruthTransform(**RegistrationBenchmark.deformations['affine'])
+    movingVolumeNode, movingSegmentationNode, _ = RegistrationBenchmark.createPhantomNodes('ModesMoving', [32, 32, 24], [3.0, 3.0, 4.0], groundTruthTransform)
+
+    slicer.util.selectModule('SegmentRegistration')
+    moduleWidget = slicer.modules.segmentregistration.widgetRepresentation().self()
+    logic = moduleWidget.logic
+    logic.fixedVolumeNode = fixedVolumeNode
+    logic.fixedSegmentationNode = fixedSegmentationNode
+    logic.fixedSegmentName = 'Structure'
+    logic.movingVolumeNode = movingVolumeNode
+    logic.movingSegmentationNode = movingSegmentationNode
+    logic.movingSegmentName = 'Structure'
+    self.assertTrue(logic.performRegistration())
+    moduleWidget.onRegistrationSuccessful()
+
+    # The pre-alignment is not hardened into the moving inputs, so it is applied when no registration result is shown
+    self.assertIsNotNone(logic.preAlignmentMoving2FixedLinearTransform)
+    for radioButton, transformNode in [(moduleWidget.noRegistrationRadioButton, logic.preAlignmentMoving2FixedLinearTransform),
+        (moduleWidget.rigidRegistrationRadioButton, logic.affineTransformNode),
+        (moduleWidget.deformableRegistrationRadioButton, logic.getDeformableResultTransformNode())]:
+      radioButton.click()
+      self.assertEqual(movingVolumeNode.GetTransformNodeID(), transformNode.GetID())
+      self.assertEqual(movingSegmentationNode.GetTransformNodeID(), transformNode.GetID())
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_DisplacementFieldCache(self):
+    from SegmentRegistrationLib import DisplacementFieldCache
+    self.delayDisplay("Displacement field cache",self.delayMs)
+
+    sourceTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'CacheSource')
+    translationMatrix = vtk.vtkMatrix4x4()
+    translationMatrix.SetElement(0, 3, 5.0)
+    sourceTransformNode.SetMatrixTransformToParent(translationMatrix)
+    cache = DisplacementFieldCache()
+    # Count the samplings of the source transform
+    computedBounds = []
+    computeGridTransform = cache.computeGridTransform
+    def countingComputeGridTransform(bounds):
+      computedBounds.append(bounds)
+      return computeGridTransform(bounds)
+    cache.computeGridTransform = countingComputeGridTransform
+
+    def assertSameResampling(gridTransformNode):
+      for point in [[0.0, 0.0, 0.0], [4.0, -6.0, 2.0]]:
+        expectedPoint = sourceTransformNode.GetTransformFromParent().TransformPoint(point)
+        gridPoint = gridTransformNode.GetTransformFromParent().TransformPoint(point)
+        for axis in range(3):
+          self.assertAlmostEqual(gridPoint[axis], expectedPoint[axis], places=3)
+
+    # Computed on the first request only
+    bounds = [-10.0, 10.0, -10.0, 10.0, -10.0, 10.0]
+    gridTransformNode = cache.getGridTransformNode(sourceTransformNode, bounds)
+    self.assertIsNotNone(gridTransformNode)
+    assertSameResampling(gridTransformNode)
+    self.assertIs(cache.getGridTransformNode(sourceTransformNode, bounds), gridTransformNode)
+    self.assertEqual(len(computedBounds), 1)
+
+    # Modifying the source transform invalidates the cache (TransformModifiedEvent), and the grid is recomputed
+    translationMatrix.SetElement(1, 3, -3.0)
+    sourceTransformNode.SetMatrixTransformToParent(translationMatrix)
+    self.assertFalse(cache.valid)
+    self.assertIs(cache.getGridTransformNode(sourceTransformNode, bounds), gridTransformNode)
+    self.assertEqual(len(computedBounds), 2)
+    assertSameResampling(gridTransformNode)
+
+    # Changed bounds are recomputed too
+    cache.getGridTransformNode(sourceTransformNode, [-20.0, 20.0, -10.0, 10.0, -10.0, 10.0])
+    self.assertEqual(len(computedBounds), 3)
+    cache.removeGridTransformNode()
+    self.assertIsNone(gridTransformNode.GetScene())
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_OverlapMetrics(self):
+    from SegmentRegistrationLib import OverlapMetrics, RegistrationBenchmark
+    self.delayDisplay("Overlap metrics",self.delayMs)
+
+    # Identical, disjoint, and half overlapping masks
+    mask = np.zeros([4, 4, 4], dtype=bool)
+    mask[0:2] = True
+    extent = [0, 3, 0, 3, 0, 3]
+    identicalMetrics = OverlapMetrics.computeMaskMetrics((mask, extent), (mask.copy(), extent), 0.001)
+    self.assertEqual(identicalMetrics['dice'], 1.0)
+    self.assertEqual(identicalMetrics['jaccard'], 1.0)
+    self.assertEqual(identicalMetrics['falsePositiveVolumeCc'], 0.0)
+    self.assertAlmostEqual(identicalMetrics['referenceVolumeCc'], 0.032)
+    disjointMetrics = OverlapMetrics.computeMaskMetrics((mask, extent), (mask.copy(), [0, 3, 0, 3, 10, 13]), 0.001)
+    self.assertEqual(disjointMetrics['dice'], 0.0)
+    self.assertAlmostEqual(disjointMetrics['falseNegativeVolumeCc'], 0.032)
+    shiftedMask = np.zeros([4, 4, 4], dtype=bool)
+    shiftedMask[1:3] = True
+    self.assertAlmostEqual(OverlapMetrics.computeMaskMetrics((mask, extent), (shiftedMask, extent), 0.001)['dice'], 0.5)
+
+    # Masks with partially overlapping extents give the same metrics as the masks placed on a common grid
+    compareMask = np.ones([2, 3, 3], dtype=bool)
+    compareExtent = [2, 4, 1, 3, 1, 2]
+    commonReference = np.zeros([5, 5, 5], dtype=bool)
+    commonReference[0:4, 0:4, 0:4] = mask
+    commonCompare = np.zeros([5, 5, 5], dtype=bool)
+    commonCompare[1:3, 1:4, 2:5] = compareMask
+    metrics = OverlapMetrics.computeMaskMetrics((mask, extent), (compareMask, compareExtent), 0.001)
+    self.assertAlmostEqual(metrics['dice'], 2.0 * np.count_nonzero(commonReference & commonCompare)
+      / (np.count_nonzero(commonReference) + np.count_nonzero(commonCompare)))
+    self.assertAlmostEqual(metrics['falsePositiveVolumeCc'], np.count_nonzero(commonCompare & ~commonReference) * 0.001)
+
+    # Empty masks
+    emptyMetrics = OverlapMetrics.computeMaskMetrics((mask, extent), (None, None), 0.001)
+    self.assertEqual(emptyMetrics['dice'], 0.0)
+    self.assertEqual(OverlapMetrics.computeMaskMetrics((None, None), (None, None), 0.001)['dice'], 1.0)
+
+    # Segment compared to itself
+    volumeNode, segmentationNode, _ = RegistrationBenchmark.createPhantomNodes('MetricsPhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    overlapMetrics = OverlapMetrics.computeOverlapMetrics(segmentationNode, segmentationNode, [('Structure', 'Structure')], volumeNode)
+    self.assertEqual(len(overlapMetrics), 1)
+    self.assertEqual(overlapMetrics[0]['dice'], 1.0)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_SurfaceDistanceMetrics(self):
+    from SegmentRegistrationLib import SurfaceDistanceMetrics, RegistrationBenchmark
+    self.delayDisplay("Surface distance metrics",self.delayMs)
+
+    # Segment compared to itself
+    _, segmentationNode, _ = RegistrationBenchmark.createPhantomNodes('SurfaceDistancePhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    surfaceDistanceMetrics = SurfaceDistanceMetrics.computeSurfaceDistanceMetrics(segmentationNode, segmentationNode, [('Structure', 'Structure')])
+    self.assertEqual(len(surfaceDistanceMetrics), 1)
+    self.assertAlmostEqual(surfaceDistanceMetrics[0]['maximumDistanceMm'], 0.0)
+
+    # Symmetric statistics of directed distances
+    statistics = SurfaceDistanceMetrics.computeDistanceStatistics(np.array([0.0, 1.0, 2.0]), np.array([3.0]))
+    self.assertEqual(statistics['maximumDistanceMm'], 3.0)
+    self.assertAlmostEqual(statistics['meanDistanceMm'], 1.5)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_FiducialErrors(self):
+    from SegmentRegistrationLib import FiducialErrors
+    self.delayDisplay("Fiducial errors",self.delayMs)
+
+    referenceFiducialsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'Reference')
+    compareFiducialsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'Compare')
+    for position, offset in [([0,0,0], [3,4,0]), ([10,0,0], [0,0,2]), ([0,10,0], [0,0,0])]:
+      referenceFiducialsNode.AddFiducial(*position)
+      compareFiducialsNode.AddFiducial(*[coordinate + delta for coordinate, delta in zip(position, offset)])
+    tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+    errors = FiducialErrors.calculateFiducialErrors(referenceFiducialsNode, compareFiducialsNode, tableNode)
+    np.testing.assert_allclose(errors[:,0], [5.0, 2.0, 0.0])
+    np.testing.assert_allclose(errors[0,1:], [3.0, 4.0, 0.0])
+
+    # One row per fiducial followed by the summary rows
+    summaryNames = [name for name, _ in FiducialErrors.computeSummaryStatistics(errors)]
+    self.assertEqual(summaryNames[:3], ['Mean', 'RMS', 'Max'])
+    table = tableNode.GetTable()
+    self.assertEqual(table.GetNumberOfRows(), 3 + len(summaryNames))
+    self.assertEqual(table.GetColumn(0).GetValue(3), 'Mean')
+    self.assertAlmostEqual(table.GetColumnByName('3D').GetValue(3), 7.0 / 3.0)
+    self.assertAlmostEqual(table.GetColumnByName('3D').GetValue(5), 5.0)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_SlabResampling(self):
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Slab-wise resampling",self.delayMs)
+
+    volumeNode, _, _ = RegistrationBenchmark.createPhantomNodes('SlabPhantom', [32, 32, 24], [3.0, 3.0, 4.0])
+    resampler = VolumeResampler()
+    # Several slabs, the last one thinner than the others
+    resampler.slabThicknessSlices = 5
+    resampler.numberOfSlabWorkers = 3
+
+    # The output of one-shot resampling defines the reference geometry
+    oneShotNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledOneShot')
+    self.assertTrue(resampler.resample(volumeNode, oneShotNode, [2.0, 2.0, 2.0], 'linear'))
+    self.assertNotEqual(oneShotNode.GetImageData().GetDimensions()[2] % resampler.slabThicknessSlices, 0)
+    oneShotArray = slicer.util.arrayFromVolume(oneShotNode).astype(np.float64)
+
+    # Slab-wise resampling into a volume node
+    slabNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ResampledInSlabs')
+    self.assertTrue(resampler.resampleToReferenceGeometry(volumeNode, oneShotNode, slabNode, 'linear'))
+    self.assertEqual(slabNode.GetImageData().GetDimensions(), oneShotNode.GetImageData().GetDimensions())
+    for axis in range(3):
+      self.assertAlmostEqual(slabNode.GetOrigin()[axis], oneShotNode.GetOrigin()[axis], places=4)
+      self.assertAlmostEqual(slabNode.GetSpacing()[axis], oneShotNode.GetSpacing()[axis], places=4)
+    np.testing.assert_allclose(slicer.util.arrayFromVolume(slabNode).astype(np.float64), oneShotArray, atol=1e-3)
+
+    # Slab-wise resampling into a memory mapped NRRD file
+    outputFilePath = os.path.join(slicer.app.temporaryPath, 'SegmentRegistrationTestSlabResampling.nrrd')
+    self.assertTrue(resampler.resampleToReferenceGeometry(volumeNode, oneShotNode, outputFilePath=outputFilePath, interpolationType='linear'))
+    fileNode = slicer.util.loadVolume(outputFilePath)
+    self.assertIsNotNone(fileNode)
+    for axis in range(3):
+      self.assertAlmostEqual(fileNode.GetOrigin()[axis], oneShotNode.GetOrigin()[axis], places=4)
+      self.assertAlmostEqual(fileNode.GetSpacing()[axis], oneShotNode.GetSpacing()[axis], places=4)
+    np.testing.assert_allclose(slicer.util.arrayFromVolume(fileNode).astype(np.float64), oneShotArray, atol=1e-3)
+    slicer.mrmlScene.RemoveNode(fileNode)
+    os.remove(outputFilePath)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_NodeRegistry(self):
+    self.delayDisplay("Node registry leak report",self.delayMs)
+
+    def createImageData(dimension):
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(dimension, dimension, dimension)
+      imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+      return imageData
+
+    existingNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ExistingVolume')
+    nodeRegistry = NodeRegistry('Test', 'Case1')
+    nodeRegistry.start()
+    resultNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ResultTransform')
+    intermediateNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'IntermediateVolume')
+    intermediateNode.SetAndObserveImageData(createImageData(10))
+    intermediateNode.CreateDefaultDisplayNodes()
+    leakedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'LeakedVolume')
+    leakedNode.SetAndObserveImageData(createImageData(20))
+    # Nodes of other scenes are not tracked
+    scratchScene = slicer.vtkMRMLScene()
+    scratchScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ScratchVolume')
+    report = nodeRegistry.finish([resultNode], [intermediateNode, None])
+    scratchScene.Clear(1)
+
+    # The intermediate volume, its display node, and the leaked volume are released, the leaked volume is reported
+    self.assertEqual(report['run'], 'Test')
+    self.assertEqual(report['runId'], 'Case1')
+    self.assertEqual(report['releasedNodes'], 3)
+    self.assertEqual(report['leakedNodes'], 1)
+    self.assertEqual(report['leakedNodeNames'], ['LeakedVolume'])
+    self.assertGreaterEqual(report['leakedBytes'], 20*20*20*2)
+    self.assertGreaterEqual(report['releasedBytes'], report['leakedBytes'] + 10*10*10*2)
+    self.assertIsNone(intermediateNode.GetScene())
+    self.assertIsNone(leakedNode.GetScene())
+    self.assertIs(resultNode.GetScene(), slicer.mrmlScene)
+    self.assertIs(existingNode.GetScene(), slicer.mrmlScene)
+
+    # Nodes are kept (and still reported as leaked) if release is disabled
+    nodeRegistry.start()
+    leakedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'KeptVolume')
+    report = nodeRegistry.finish([], [], releaseNodes=False)
+    self.assertEqual(report['releasedNodes'], 0)
+    self.assertEqual(report['leakedNodes'], 1)
+    self.assertIs(leakedNode.GetScene(), slicer.mrmlScene)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_ScratchScene(self):
+    # Register synthetic phantoms (no data download needed) and check that only the results are left in the main scene
+    from SegmentRegistrationLib import RegistrationBenchmark
+    self.delayDisplay("Intermediate nodes in scratch scene",self.delayMs)
+
+    fixedVolumeNode, fixedSegmentationNode, _ = RegistrationBenchmark.createPhantomNodes('ScratchFixed', [32, 32, 24], [3.0, 3.0, 4.0])
+    groundTruthTransform = RegistrationBenchmark.GroundTruthTransform(**RegistrationBenchmark.deformations['affine'])
+    movingVolumeNode, movingSegmentationNode, _ = RegistrationBenchmark.createPhantomNodes('ScratchMoving', [32, 32, 24], [3.0, 3.0, 4.0], groundTruthTransform)
+
+    # The moving volume is cropped in-process to the voxels within the bounds
+    resampler = VolumeResampler()
+    croppedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ScratchCropped')
+    self.assertTrue(resampler.crop(movingVolumeNode, croppedNode, [-10.0, 10.0, -10.0, 10.0, -10.0, 10.0]))
+    croppedDimensions = croppedNode.GetImageData().GetDimensions()
+    self.assertTrue(all([croppedDimensions[axis] < movingVolumeNode.GetImageData().GetDimensions()[axis] for axis in range(3)]))
+    slicer.mrmlScene.RemoveNode(croppedNode)
+
+    logic = SegmentRegistrationLogic()
+    logic.keepIntermediateNodes = False
+    logic.useScratchScene = True
+    logic.fixedVolumeNode = fixedVolumeNode
+    logic.fixedSegmentationNode = fixedSegmentationNode
+    logic.fixedSegmentName = 'Structure'
+    logic.movingVolumeNode = movingVolumeNode
+    logic.movingSegmentationNode = movingSegmentationNode
+    logic.movingSegmentName = 'Structure'
+    def getSceneNodeIDs():
+      return set([slicer.mrmlScene.GetNthNode(index).GetID() for index in range(slicer.mrmlScene.GetNumberOfNodes())])
+    nodeIDsBefore = getSceneNodeIDs()
+    self.assertTrue(logic.performRegistration())
+
+    # No intermediate nodes are left in the main scene, and the scratch scene is released
+    self.assertIsNone(logic.scratchScene)
+    self.assertIsNone(logic.distanceMapRegistrationLogic.scratchScene)
+    addedNodeIDs = getSceneNodeIDs() - nodeIDsBefore
+    resultNodeIDs = NodeRegistry.getNodeIDsWithDisplayAndStorageNodes(logic.getResultNodes())
+    self.assertTrue(addedNodeIDs.issubset(resultNodeIDs), 'Nodes left in the scene: ' + str(sorted(addedNodeIDs - resultNodeIDs)))
+    self.assertIsNotNone(logic.movingCroppedVolumeNode)
+    self.assertIs(logic.movingCroppedVolumeNode.GetScene(), slicer.mrmlScene)
+    self.assertIs(logic.bsplineTransformNode.GetScene(), slicer.mrmlScene)
+
+  #------------------------------------------------------------------------------
+  def test_SegmentRegistration_SubjectHierarchyPatientIndex(self):
+    from SegmentRegistrationLib import SubjectHierarchyPatientIndex
+    self.delayDisplay("Subject hierarchy patient index",self.delayMs)
+
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    modalityAttributeName = slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMSeriesModalityAttributeName()
+    patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), 'IndexPatient')
+    studyItemID = shNode.CreateStudyItem(patientItemID, 'IndexStudy')
+    mrVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'IndexMR')
+    mrItemID = shNode.GetItemByDataNode(mrVolumeNode)
+    shNode.SetItemParent(mrItemID, studyItemID)
+    shNode.SetItemAttribute(mrItemID, modalityAttributeName, 'MR')
+
+    patientIndex = SubjectHierarchyPatientIndex()
+    patientIndex.start()
+    try:
+      self.assertIn(patientItemID, patientIndex.getPatientItemIDs())
+      self.assertEqual(patientIndex.getVolumeNode(patientItemID, 'MR'), mrVolumeNode)
+      self.assertIsNone(patientIndex.getVolumeNode(patientItemID, 'US'))
+      self.assertIsNone(patientIndex.getSegmentationNode(patientItemID))
+
+      # Index is updated when items are added, modified, and removed
+      segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'IndexSegmentation')
+      shNode.SetItemParent(shNode.GetItemByDataNode(segmentationNode), studyItemID)
+      self.assertEqual(patientIndex.getSegmentationNode(patientItemID), segmentationNode)
+      shNode.SetItemAttribute(mrItemID, modalityAttributeName, 'US')
+      self.assertIsNone(patientIndex.getVolumeNode(patientItemID, 'MR'))
+      self.assertEqual(patientIndex.getVolumeNode(patientItemID, 'US'), mrVolumeNode)
+      slicer.mrmlScene.RemoveNode(segmentationNode)
+      self.assertIsNone(patientIndex.getSegmentationNode(patientItemID))
+      shNode.RemoveItem(patientItemID)
+      self.assertNotIn(patientItemID, patientIndex.getPatientItemIDs())
+    finally:
+      patientIndex.stop()
+
   #------------------------------------------------------------------------------
   # Mandatory functions
   #------------------------------------------------------------------------------
@@ -864,4 +1888,23 @@ class SegmentRegistrationTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
 
+    self.test_SegmentRegistration_StageCache()
+    self.test_SegmentRegistration_StageProfiler()
+    self.test_SegmentRegistration_DistanceMaps()
+    self.test_SegmentRegistration_VolumeResampler()
+    self.test_SegmentRegistration_RoiRestrictedResampling()
+    self.test_SegmentRegistration_SegmentRasterizer()
+    self.test_SegmentRegistration_SegmentExtentLabelmap()
+    self.test_SegmentRegistration_MomentAlignment()
+    self.test_SegmentRegistration_FixedDistanceMapCache()
+    self.test_SegmentRegistration_TransformationModes()
+    self.test_SegmentRegistration_DisplacementFieldCache()
+    self.test_SegmentRegistration_OverlapMetrics()
+    self.test_SegmentRegistration_SurfaceDistanceMetrics()
+    self.test_SegmentRegistration_FiducialErrors()
+    self.test_SegmentRegistration_SlabResampling()
+    self.test_SegmentRegistration_NodeRegistry()
+    self.test_SegmentRegistration_ScratchScene()
+    self.test_SegmentRegistration_SubjectHierarchyPatientIndex()
+    self.test_SegmentRegistration_SyntheticPhantom()
     self.test_SegmentRegistration_FullTest()
@@ -0,0 +1,273 @@
+import logging
+import threading
+import vtk, qt, slicer
+
+#
+# -----------------------------------------------------------------------------
+# AsyncPipeline
+# -----------------------------------------------------------------------------
+#
+
+class AsyncPipeline(object):
+  """Run a sequence of processing stages without blocking the application event loop.
+
+  Each stage is a (name, function) tuple. The function either finishes its work synchronously (returning
+  anything but a CLI node, a background task, or False), starts a CLI module in the background and returns
+  its CLI node, or returns a BackgroundTask computing on a worker thread. In the latter two cases the next stage
+  starts when the CLI or the task finishes. Control is returned to the event loop between stages, so the user
+  interface stays responsive.
+
+  Cancellation is cooperative: a synchronous stage is never interrupted, but no further stage is started,
+  a running CLI is cancelled, and the result of a running background task is discarded.
+
+  If a StageProfiler is given, then each stage is measured from calling its function until its CLI or
+  background task finished, and is reported as failed if it failed or was cancelled.
+  """
+
+  Completed = 'Completed'
+  Cancelled = 'Cancelled'
+  Failed = 'Failed'
+
+  # Interval of checking whether the worker thread of a background task finished
+  taskPollingIntervalMs = 50
+
+  def __init__(self, stages, progressCallback=None, finishedCallback=None, profiler=None):
+    """
+    :param stages: List of (stage name, function) tuples
+    :param progressCallback: Called as progressCallback(stageName, stageIndex, numberOfStages, overallProgress)
+      where overall progress is between 0 and 1
+    :param finishedCallback: Called as finishedCallback(status) with status Completed, Cancelled, or Failed
+    :param profiler: StageProfiler measuring the stages (optional)
+    """
+    self.stages = stages
+    self.progressCallback = progressCallback
+    self.finishedCallback = finishedCallback
+    self.profiler = profiler
+    self.activeStageMeasurement = None
+
+    self.currentStageIndex = -1
+    self.activeCliNode = None
+    self.activeCliNodeObserver = None
+    self.activeTask = None
+    self.activeTaskTimer = None
+    self.cancelRequested = False
+    self.running = False
+
+  #------------------------------------------------------------------------------
+  def start(self):
+    if self.running:
+      logging.error('Pipeline is already running')
+      return
+    self.running = True
+    self.cancelRequested = False
+    self.currentStageIndex = -1
+    qt.QTimer.singleShot(0, self.runNextStage)
+
+  #------------------------------------------------------------------------------
+  def cancel(self):
+    if not self.running:
+      return
+    logging.info('Cancelling pipeline')
+    self.cancelRequested = True
+    if self.activeCliNode is not None:
+      self.activeCliNode.Cancel()
+    if self.activeTask is not None:
+      # The worker thread cannot be interrupted, but its result is not applied
+      self.releaseActiveTask()
+      self.finish(self.Cancelled)
+
+  #------------------------------------------------------------------------------
+  def isRunning(self):
+    return self.running
+
+  #------------------------------------------------------------------------------
+  def runNextStage(self):
+    if self.cancelRequested:
+      self.finish(self.Cancelled)
+      return
+
+    self.currentStageIndex += 1
+    if self.currentStageIndex >= len(self.stages):
+      self.reportProgress(1.0)
+      self.finish(self.Completed)
+      return
+
+    stageName, stageFunction = self.stages[self.currentStageIndex]
+    logging.info('Pipeline stage %d/%d: %s' % (self.currentStageIndex+1, len(self.stages), stageName))
+    self.reportProgress(0.0)
+    if self.profiler is not None:
+      self.activeStageMeasurement = self.profiler.measureStage(stageName)
+      self.activeStageMeasurement.start()
+    try:
+      result = stageFunction()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      logging.error('Pipeline stage %s failed: %s' % (stageName, str(e)))
+      self.finish(self.Failed)
+      return
+
+    if result is False:
+      logging.error('Pipeline stage %s failed' % stageName)
+      self.finish(self.Failed)
+    elif isinstance(result, slicer.vtkMRMLCommandLineModuleNode):
+      # Wait for the CLI to finish
+      self.activeCliNode = result
+      self.activeCliNodeObserver = self.activeCliNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onActiveCliNodeModified)
+      self.onActiveCliNodeModified(self.activeCliNode, None)
+    elif isinstance(result, BackgroundTask):
+      # Poll the task from the event loop until its worker thread finishes
+      self.activeTask = result
+      self.activeTask.start()
+      self.activeTaskTimer = qt.QTimer()
+      self.activeTaskTimer.setInterval(self.taskPollingIntervalMs)
+      self.activeTaskTimer.connect('timeout()', self.onActiveTaskTimeout)
+      self.activeTaskTimer.start()
+    else:
+      self.stopStageMeasurement(True)
+      # Return to the event loop before starting the next stage
+      qt.QTimer.singleShot(0, self.runNextStage)
+
+  #------------------------------------------------------------------------------
+  def onActiveCliNodeModified(self, cliNode, event):
+    if cliNode is not self.activeCliNode:
+      return
+    status = cliNode.GetStatus()
+    if status & cliNode.ErrorsMask:
+      logging.error('Pipeline stage %s failed: %s' % (self.stages[self.currentStageIndex][0], cliNode.GetErrorText()))
+      self.releaseActiveCliNode()
+      self.finish(self.Failed)
+    elif status == cliNode.Cancelled:
+      self.releaseActiveCliNode()
+      self.finish(self.Cancelled)
+    elif status == cliNode.Completed:
+      self.releaseActiveCliNode()
+      self.stopStageMeasurement(True)
+      qt.QTimer.singleShot(0, self.runNextStage)
+    else:
+      self.reportProgress(cliNode.GetProgress() / 100.0)
+
+  #------------------------------------------------------------------------------
+  def onActiveTaskTimeout(self):
+    if self.activeTask is None or self.activeTask.isRunning():
+      return
+    task = self.activeTask
+    self.releaseActiveTask()
+    try:
+      success = task.apply()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      logging.error('Pipeline stage %s failed: %s' % (self.stages[self.currentStageIndex][0], str(e)))
+      success = False
+    if success is False:
+      logging.error('Pipeline stage %s failed' % self.stages[self.currentStageIndex][0])
+      self.finish(self.Failed)
+    else:
+      self.stopStageMeasurement(True)
+      qt.QTimer.singleShot(0, self.runNextStage)
+
+  #------------------------------------------------------------------------------
+  def stopStageMeasurement(self, success):
+    if self.activeStageMeasurement is None:
+      return
+    self.activeStageMeasurement.stop(success)
+    self.activeStageMeasurement = None
+
+  #------------------------------------------------------------------------------
+  def releaseActiveTask(self):
+    self.activeTaskTimer.stop()
+    self.activeTaskTimer = None
+    self.activeTask = None
+
+  #------------------------------------------------------------------------------
+  def releaseActiveCliNode(self):
+    self.activeCliNode.RemoveObserver(self.activeCliNodeObserver)
+    slicer.mrmlScene.RemoveNode(self.activeCliNode)
+    self.activeCliNode = None
+    self.activeCliNodeObserver = None
+
+  #------------------------------------------------------------------------------
+  def reportProgress(self, stageProgress):
+    if self.progressCallback is None:
+      return
+    numberOfStages = len(self.stages)
+    stageIndex = min(self.currentStageIndex, numberOfStages-1)
+    overallProgress = (stageIndex + stageProgress) / numberOfStages
+    self.progressCallback(self.stages[stageIndex][0], stageIndex, numberOfStages, overallProgress)
+
+  #------------------------------------------------------------------------------
+  def finish(self, status):
+    logging.info('Pipeline finished with status ' + status)
+    # A stage still being measured failed or was cancelled
+    self.stopStageMeasurement(False)
+    self.running = False
+    if self.finishedCallback is not None:
+      self.finishedCallback(status)
+
+#
+# -----------------------------------------------------------------------------
+# BackgroundTask
+# -----------------------------------------------------------------------------
+#
+
+class BackgroundTask(object):
+  """Computation of a pipeline stage running on a worker thread.
+
+  MRML is not thread safe, so the work is split in two: the compute function only processes data that was
+  copied out of the scene (NumPy arrays, SimpleITK images, VTK data objects not observed by any node) and runs
+  on the worker thread, then the apply function stores its result in the scene from the main thread.
+  The task can also be run synchronously (see run), in which case both functions run in the calling thread.
+  """
+
+  def __init__(self, computeFunction, applyFunction=None):
+    """
+    :param computeFunction: Called without arguments on the worker thread, returns the result
+    :param applyFunction: Called as applyFunction(result) on the main thread, returns False on failure
+    """
+    self.computeFunction = computeFunction
+    self.applyFunction = applyFunction
+    self.thread = None
+    self.result = None
+    self.error = None
+
+  #------------------------------------------------------------------------------
+  def start(self):
+    """Start computing on a worker thread
+    """
+    self.thread = threading.Thread(target=self.compute)
+    self.thread.daemon = True
+    self.thread.start()
+
+  #------------------------------------------------------------------------------
+  def isRunning(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  #------------------------------------------------------------------------------
+  def compute(self):
+    try:
+      self.result = self.computeFunction()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.error = e
+
+  #------------------------------------------------------------------------------
+  def apply(self):
+    """Store the result computed by the worker thread. Must be called from the main thread after the task finished
+    :return: False on failure
+    """
+    if self.error is not None:
+      logging.error('Background task failed: ' + str(self.error))
+      return False
+    if self.applyFunction is None:
+      return self.result
+    return self.applyFunction(self.result)
+
+  #------------------------------------------------------------------------------
+  def run(self):
+    """Compute and apply the result in the calling thread
+    :return: False on failure
+    """
+    self.compute()
+    return self.apply()
@@ -0,0 +1,341 @@
+"""Headless batch registration of a cohort of cases with SegmentRegistrationLogic.
+
+The driver can be run from any Python 3 interpreter (or from Slicer). It reads a manifest of
+cases and registers each case in a separate headless Slicer process, running a pool of such
+worker processes in parallel:
+
+  python BatchRegistration.py --manifest cases.json --output-dir out --slicer /path/to/Slicer --workers 8
+
+The manifest is either a JSON file containing a list of cases (or a dictionary with a 'cases'
+list), or a CSV file with a header row. Each case contains the following fields:
+  id, fixedVolume, fixedSegmentation, fixedSegment, movingVolume, movingSegmentation, movingSegment
+where the volumes and segmentations are file paths loadable by Slicer and the segments are
+segment names. If id is omitted, then the index of the case in the manifest is used. Multiple
+segment pairs can be registered in one pass by listing the segment names separated by semicolons
+(or as lists in JSON); the fixed and moving lists are paired in order.
+
+Preprocessing stage outputs can be cached on disk (--cache-dir), so that re-running unchanged cases
+(for example with different registration settings) skips cropping, resampling and labelmap creation.
+The fixed distance maps are cached too, so cases sharing the same fixed segment (such as atlas or
+one-to-many registration) only compute the fixed distance map once.
+
+For each case a folder is created in the output directory containing the resulting transforms (the
+affine and deformable transforms map the original moving inputs to the fixed inputs, including the
+pre-alignment transform, which is saved separately for reference),
+the worker log, a status record (status.json), and a report of the time, CPU time, memory, and voxel
+counts of each registration stage (timing.json). A summary of all cases is written to cohort_status.json,
+and the per-stage statistics of all cases to cohort_timing.json in the output directory.
+
+A single case can also be registered directly in a Slicer process (this is what the driver does):
+
+  Slicer --no-splash --no-main-window --python-script BatchRegistration.py --worker --case case.json --output-dir out/case
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import logging
+import subprocess
+import concurrent.futures
+
+caseFields = ['id', 'fixedVolume', 'fixedSegmentation', 'fixedSegment', 'movingVolume', 'movingSegmentation', 'movingSegment']
+caseStatusFileName = 'status.json'
+caseDescriptionFileName = 'case.json'
+caseLogFileName = 'worker.log'
+cohortStatusFileName = 'cohort_status.json'
+caseTimingFileName = 'timing.json'
+cohortTimingFileName = 'cohort_timing.json'
+
+# -----------------------------------------------------------------------------
+# Manifest
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def readManifest(manifestPath):
+  """Read list of cases from a JSON or CSV manifest file
+  """
+  if os.path.splitext(manifestPath)[1].lower() == '.csv':
+    with open(manifestPath, newline='') as manifestFile:
+      cases = [dict(row) for row in csv.DictReader(manifestFile)]
+  else:
+    with open(manifestPath) as manifestFile:
+      cases = json.load(manifestFile)
+    if isinstance(cases, dict):
+      cases = cases.get('cases', [])
+
+  # Make relative paths relative to the manifest file and make sure each case has an identifier
+  manifestDir = os.path.dirname(os.path.abspath(manifestPath))
+  for index, case in enumerate(cases):
+    if not case.get('id'):
+      case['id'] = 'Case%04d' % index
+    case['id'] = str(case['id'])
+    for field in ['fixedVolume', 'fixedSegmentation', 'movingVolume', 'movingSegmentation']:
+      if case.get(field) and not os.path.isabs(case[field]):
+        case[field] = os.path.join(manifestDir, case[field])
+
+  return cases
+
+#------------------------------------------------------------------------------
+def validateCase(case):
+  """Return list of error messages for a case description (empty if valid)
+  """
+  errors = []
+  for field in caseFields:
+    if not case.get(field):
+      errors.append('Missing field: ' + field)
+  for field in ['fixedVolume', 'fixedSegmentation', 'movingVolume', 'movingSegmentation']:
+    if case.get(field) and not os.path.exists(case[field]):
+      errors.append('File not found: ' + case[field])
+  if case.get('fixedSegment') and case.get('movingSegment') \
+      and len(getSegmentNames(case['fixedSegment'])) != len(getSegmentNames(case['movingSegment'])):
+    errors.append('Different number of fixed and moving segments')
+  return errors
+
+#------------------------------------------------------------------------------
+def getSegmentNames(value):
+  """Get list of segment names from a manifest field (list or semicolon-separated string)
+  """
+  if isinstance(value, list):
+    return [str(name) for name in value]
+  return [name.strip() for name in value.split(';') if name.strip()]
+
+# -----------------------------------------------------------------------------
+# Driver
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def runCaseInWorkerProcess(case, outputDir, slicerExecutable, threadsPerWorker=None, timeoutSec=None, cacheDir=None):
+  """Register one case in a headless Slicer process and return its status record
+  """
+  caseDir = os.path.join(outputDir, case['id'])
+  if not os.path.exists(caseDir):
+    os.makedirs(caseDir)
+
+  record = {'id': case['id'], 'status': 'failed'}
+  errors = validateCase(case)
+  if errors:
+    record['error'] = '; '.join(errors)
+    writeJson(os.path.join(caseDir, caseStatusFileName), record)
+    return record
+
+  caseDescriptionPath = os.path.join(caseDir, caseDescriptionFileName)
+  writeJson(caseDescriptionPath, case)
+
+  # Stale status from a previous run must not be mistaken for the result of this run
+  caseStatusPath = os.path.join(caseDir, caseStatusFileName)
+  for staleFilePath in [caseStatusPath, os.path.join(caseDir, caseTimingFileName)]:
+    if os.path.exists(staleFilePath):
+      os.remove(staleFilePath)
+
+  command = [slicerExecutable, '--no-splash', '--no-main-window', '--python-script', os.path.abspath(__file__),
+    '--worker', '--case', caseDescriptionPath, '--output-dir', caseDir]
+  if cacheDir:
+    command.extend(['--cache-dir', cacheDir])
+
+  # Limit the number of threads ITK/VTK filters use in each worker so that workers do not compete for the same cores
+  environment = os.environ.copy()
+  if threadsPerWorker:
+    environment['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threadsPerWorker)
+    environment['OMP_NUM_THREADS'] = str(threadsPerWorker)
+
+  startTime = time.time()
+  returnCode = None
+  try:
+    with open(os.path.join(caseDir, caseLogFileName), 'w') as logFile:
+      returnCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT, env=environment, timeout=timeoutSec)
+  except subprocess.TimeoutExpired:
+    record['status'] = 'timeout'
+  except OSError as e:
+    record['error'] = 'Failed to start Slicer: ' + str(e)
+
+  # The worker writes its own record. If it is missing, then the worker crashed or timed out
+  if os.path.exists(caseStatusPath):
+    with open(caseStatusPath) as caseStatusFile:
+      record = json.load(caseStatusFile)
+  elif record['status'] != 'timeout' and 'error' not in record:
+    record['status'] = 'crashed'
+  record['returnCode'] = returnCode
+  record['processWallTimeSec'] = time.time() - startTime
+  writeJson(caseStatusPath, record)
+  return record
+
+#------------------------------------------------------------------------------
+def runCohort(cases, outputDir, slicerExecutable, numberOfWorkers=None, timeoutSec=None, cacheDir=None):
+  """Register all cases using a pool of worker processes and return the status records
+  """
+  if not os.path.exists(outputDir):
+    os.makedirs(outputDir)
+
+  numberOfCores = os.cpu_count() or 1
+  if not numberOfWorkers:
+    numberOfWorkers = numberOfCores
+  numberOfWorkers = max(1, min(numberOfWorkers, len(cases)))
+  threadsPerWorker = max(1, numberOfCores // numberOfWorkers)
+  logging.info('Registering %d cases using %d worker processes (%d threads each)' % (len(cases), numberOfWorkers, threadsPerWorker))
+
+  # The pool threads only wait for the worker processes, the actual work is done in the Slicer processes
+  records = []
+  startTime = time.time()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+    futures = [executor.submit(runCaseInWorkerProcess, case, outputDir, slicerExecutable, threadsPerWorker, timeoutSec, cacheDir) for case in cases]
+    for future in concurrent.futures.as_completed(futures):
+      record = future.result()
+      logging.info('Case %s finished with status %s' % (record['id'], record['status']))
+      records.append(record)
+
+  # Keep manifest order in the summary
+  caseOrder = {case['id']: index for index, case in enumerate(cases)}
+  records.sort(key=lambda record: caseOrder.get(record['id'], len(cases)))
+
+  summary = {
+    'numberOfCases': len(cases),
+    'numberOfSuccessfulCases': len([record for record in records if record['status'] == 'success']),
+    'numberOfWorkers': numberOfWorkers,
+    'wallTimeSec': time.time() - startTime,
+    'cases': records }
+  writeJson(os.path.join(outputDir, cohortStatusFileName), summary)
+  writeCohortTimingReport(cases, outputDir)
+  return records
+
+#------------------------------------------------------------------------------
+def writeCohortTimingReport(cases, outputDir):
+  """Aggregate the timing reports written by the workers into per-stage statistics of the cohort
+  """
+  # The driver may run outside Slicer, where the SegmentRegistrationLib package cannot be imported
+  try:
+    from StageProfiler import aggregateTimingReports
+  except ImportError:
+    from .StageProfiler import aggregateTimingReports
+
+  reports = []
+  for case in cases:
+    caseTimingPath = os.path.join(outputDir, case['id'], caseTimingFileName)
+    if os.path.exists(caseTimingPath):
+      with open(caseTimingPath) as caseTimingFile:
+        reports.append(json.load(caseTimingFile))
+  writeJson(os.path.join(outputDir, cohortTimingFileName), aggregateTimingReports(reports))
+
+# -----------------------------------------------------------------------------
+# Worker (runs inside Slicer)
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def registerCase(case, outputDir, cacheDir=None):
+  """Load the data of one case into the scene, register it, and save the resulting transforms
+  """
+  import slicer
+  from SegmentRegistration import SegmentRegistrationLogic
+  from SegmentRegistrationLib import StageCache, RegistrationContext
+
+  record = {'id': case['id'], 'status': 'failed'}
+  startTime = time.time()
+  try:
+    fixedVolumeNode = slicer.util.loadVolume(case['fixedVolume'])
+    fixedSegmentationNode = slicer.util.loadSegmentation(case['fixedSegmentation'])
+    movingVolumeNode = slicer.util.loadVolume(case['movingVolume'])
+    movingSegmentationNode = slicer.util.loadSegmentation(case['movingSegmentation'])
+    if None in [fixedVolumeNode, fixedSegmentationNode, movingVolumeNode, movingSegmentationNode]:
+      raise RuntimeError('Failed to load input data')
+    record['loadTimeSec'] = time.time() - startTime
+
+    logic = SegmentRegistrationLogic()
+    if cacheDir:
+      logic.stageCache = StageCache(cacheDir)
+      logic.fixedDistanceMapCache = logic.stageCache
+    segmentNamePairs = list(zip(getSegmentNames(case['fixedSegment']), getSegmentNames(case['movingSegment'])))
+    context = RegistrationContext(fixedVolumeNode=fixedVolumeNode, fixedSegmentationNode=fixedSegmentationNode,
+      movingVolumeNode=movingVolumeNode, movingSegmentationNode=movingSegmentationNode, segmentNamePairs=segmentNamePairs,
+      fixedSegmentName=segmentNamePairs[0][0], movingSegmentName=segmentNamePairs[0][1])
+
+    registrationStartTime = time.time()
+    context = logic.performRegistration(case['id'], context=context)
+    record['registrationTimeSec'] = time.time() - registrationStartTime
+    if context.timingReport is not None:
+      writeJson(os.path.join(outputDir, caseTimingFileName), context.timingReport)
+    if not context.success:
+      raise RuntimeError('Registration failed')
+
+    # Save resulting transforms
+    transformFiles = {}
+    for transformName, transformNode in [('PreAlignmentTransform', context.preAlignmentMoving2FixedLinearTransform),
+        ('AffineTransform', context.affineTransformNode), ('DeformableTransform', context.bsplineTransformNode)]:
+      transformFilePath = os.path.join(outputDir, transformName + '.h5')
+      if not slicer.util.saveNode(transformNode, transformFilePath):
+        raise RuntimeError('Failed to save ' + transformName)
+      transformFiles[transformName] = transformFilePath
+    record['transforms'] = transformFiles
+    record['status'] = 'success'
+
+  except Exception as e:
+    import traceback
+    traceback.print_exc()
+    record['error'] = str(e)
+
+  record['wallTimeSec'] = time.time() - startTime
+  writeJson(os.path.join(outputDir, caseStatusFileName), record)
+  return record['status'] == 'success'
+
+#------------------------------------------------------------------------------
+def runWorker(caseDescriptionPath, outputDir, cacheDir=None):
+  with open(caseDescriptionPath) as caseDescriptionFile:
+    case = json.load(caseDescriptionFile)
+  if not os.path.exists(outputDir):
+    os.makedirs(outputDir)
+  return registerCase(case, outputDir, cacheDir)
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def writeJson(filePath, content):
+  with open(filePath, 'w') as outputFile:
+    json.dump(content, outputFile, indent=2)
+
+#------------------------------------------------------------------------------
+def findSlicerExecutable():
+  try:
+    import slicer
+    return slicer.app.applicationFilePath()
+  except ImportError:
+    return None
+
+#------------------------------------------------------------------------------
+def main(argv):
+  parser = argparse.ArgumentParser(description='Batch segment registration of a cohort of cases')
+  parser.add_argument('--manifest', help='JSON or CSV file listing the cases to register')
+  parser.add_argument('--output-dir', required=True, help='Folder where the results are written')
+  parser.add_argument('--slicer', help='Path of the Slicer executable used for the worker processes')
+  parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of cores)')
+  parser.add_argument('--timeout', type=float, default=None, help='Maximum processing time of one case in seconds')
+  parser.add_argument('--cache-dir', help='Folder for caching preprocessing stage outputs (no caching if omitted)')
+  parser.add_argument('--worker', action='store_true', help='Register a single case in this Slicer process (internal)')
+  parser.add_argument('--case', help='Case description file for worker mode (internal)')
+  args = parser.parse_args(argv)
+
+  if args.worker:
+    # Slicer keeps running after the script is executed, so the application needs to be exited explicitly
+    import slicer
+    success = runWorker(args.case, args.output_dir, args.cache_dir)
+    slicer.util.exit(0 if success else 1)
+    return None
+
+  if not args.manifest:
+    parser.error('--manifest is required')
+  slicerExecutable = args.slicer or findSlicerExecutable()
+  if not slicerExecutable:
+    parser.error('--slicer is required when not running inside Slicer')
+
+  cases = readManifest(args.manifest)
+  cacheDir = os.path.abspath(args.cache_dir) if args.cache_dir else None
+  records = runCohort(cases, args.output_dir, slicerExecutable, args.workers, args.timeout, cacheDir)
+  return 0 if all(record['status'] == 'success' for record in records) else 1
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  exitCode = main(sys.argv[1:])
+  if exitCode is not None:
+    sys.exit(exitCode)
@@ -0,0 +1,142 @@
+import os
+import shutil
+import logging
+import tempfile
+import concurrent.futures
+import vtk, slicer
+
+#
+# -----------------------------------------------------------------------------
+# DicomStudyExporter
+# -----------------------------------------------------------------------------
+#
+
+class DicomStudyExporter(object):
+  """Export a subject hierarchy study (image series and structure sets) to DICOM files without the export dialog.
+
+  The exportables are determined the same way as in the DICOM export dialog: each series in the study is
+  examined by all DICOM plugins, and the exportables of the plugin with the highest confidence are used.
+  The exportables of each plugin are then exported together (so that for example the RTSTRUCT is written
+  with its referenced image series) into the output directory.
+
+  The files are written by the exporters of the plugins into a new temporary subdirectory of the output
+  directory, so that the written files are known even if the export overwrites files of an earlier export
+  (such as when a batch is re-run into the same directory). Afterwards the written files are read back (header
+  only) by parallel workers to collect the SOP Instance UIDs, which identify the exported instances for the
+  calling batch process, and are moved into the output directory.
+  """
+
+  def __init__(self):
+    # Number of workers reading back the exported files. Default (None) uses the concurrent.futures default
+    self.numberOfWorkers = None
+
+  #------------------------------------------------------------------------------
+  def exportStudy(self, studyShItemID, outputDirectory):
+    """Export all series of a study
+    :param studyShItemID: Subject hierarchy item ID of the study
+    :param outputDirectory: Directory to write the DICOM files into (created if it does not exist)
+    :return: List of the SOP Instance UIDs of the written files, None on failure
+    """
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    if not studyShItemID or shNode.GetItemLevel(studyShItemID) != slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMLevelStudy():
+      logging.error('Invalid study for DICOM export')
+      return None
+    if not os.path.isdir(outputDirectory):
+      os.makedirs(outputDirectory)
+
+    exportablesByPlugin = self.getExportablesByPlugin(studyShItemID)
+    if not exportablesByPlugin:
+      logging.error('No exportable series found in study ' + shNode.GetItemName(studyShItemID))
+      return None
+
+    exportDirectory = tempfile.mkdtemp(prefix='Export_', dir=outputDirectory)
+    try:
+      for pluginName, (plugin, exportables) in exportablesByPlugin.items():
+        for exportable in exportables:
+          exportable.directory = exportDirectory
+        logging.info('Exporting %d series with %s' % (len(exportables), pluginName))
+        errorMessage = plugin.export(exportables)
+        if errorMessage:
+          logging.error('DICOM export with %s failed: %s' % (pluginName, errorMessage))
+          return None
+
+      writtenFiles = self.getFilesInDirectory(exportDirectory)
+      sopInstanceUids = self.readSopInstanceUids(writtenFiles)
+      if sopInstanceUids is None:
+        return None
+      if not sopInstanceUids:
+        logging.error('No DICOM files were written by the export')
+        return None
+      # Replace the files of earlier exports with the same names
+      for filePath in writtenFiles:
+        outputFilePath = os.path.join(outputDirectory, os.path.relpath(filePath, exportDirectory))
+        if not os.path.isdir(os.path.dirname(outputFilePath)):
+          os.makedirs(os.path.dirname(outputFilePath))
+        os.replace(filePath, outputFilePath)
+      return sopInstanceUids
+    finally:
+      shutil.rmtree(exportDirectory, ignore_errors=True)
+
+  #------------------------------------------------------------------------------
+  def getExportablesByPlugin(self, studyShItemID):
+    """Examine the series of the study with all DICOM plugins, keeping the most confident exportables of each series
+    :return: Dictionary of plugin name to (plugin, list of exportables)
+    """
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    seriesShItemIDs = vtk.vtkIdList()
+    shNode.GetItemChildren(studyShItemID, seriesShItemIDs)
+
+    plugins = dict([(pluginName, pluginClass()) for pluginName, pluginClass in slicer.modules.dicomPlugins.items()])
+    exportablesByPlugin = {}
+    for index in range(seriesShItemIDs.GetNumberOfIds()):
+      seriesShItemID = seriesShItemIDs.GetId(index)
+      bestPluginName = None
+      bestExportables = []
+      for pluginName, plugin in plugins.items():
+        exportables = plugin.examineForExport(seriesShItemID)
+        if not exportables:
+          continue
+        confidence = max([exportable.confidence for exportable in exportables])
+        if bestPluginName is None or confidence > max([exportable.confidence for exportable in bestExportables]):
+          bestPluginName = pluginName
+          bestExportables = exportables
+      if bestPluginName is None:
+        logging.warning('No DICOM plugin can export ' + shNode.GetItemName(seriesShItemID))
+        continue
+      exportablesByPlugin.setdefault(bestPluginName, (plugins[bestPluginName], []))[1].extend(bestExportables)
+    return exportablesByPlugin
+
+  #------------------------------------------------------------------------------
+  def readSopInstanceUids(self, filePaths):
+    """Read SOP Instance UIDs from the headers of DICOM files in parallel. Files that are not DICOM instances
+    (such as index files written by an exporter) are skipped
+    :return: List of UIDs (in the order of the files), None if any of the files could not be read
+    """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+
+    def readSopInstanceUid(filePath):
+      try:
+        dataset = pydicom.dcmread(filePath, stop_before_pixels=True, specific_tags=['SOPInstanceUID'])
+      except InvalidDicomError:
+        logging.warning('Skipping non-DICOM file ' + filePath)
+        return None
+      if 'SOPInstanceUID' not in dataset:
+        logging.warning('Skipping DICOM file without SOP Instance UID ' + filePath)
+        return None
+      return str(dataset.SOPInstanceUID)
+
+    try:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+        return [uid for uid in executor.map(readSopInstanceUid, filePaths) if uid is not None]
+    except Exception as e:
+      logging.error('Failed to read exported DICOM files: ' + str(e))
+      return None
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getFilesInDirectory(directory):
+    filePaths = []
+    for root, dirNames, fileNames in os.walk(directory):
+      filePaths.extend([os.path.join(root, fileName) for fileName in fileNames])
+    return filePaths
@@ -0,0 +1,109 @@
+import logging
+import vtk, slicer
+
+#
+# -----------------------------------------------------------------------------
+# DisplacementFieldCache
+# -----------------------------------------------------------------------------
+#
+
+class DisplacementFieldCache(object):
+  """Cache of a deformable (such as B-spline) transform sampled into a displacement grid.
+
+  Evaluating a B-spline transform requires the sum of the weighted control point displacements around each
+  transformed point, which makes reslicing, segment conversion, and export slow. The cached grid transform is
+  computed once within a region of interest, and then evaluated with trilinear interpolation. The grid samples the
+  resampling (from parent) direction of the transform, which is what volume reslicing uses. Outside the region
+  the displacement of the nearest grid boundary point is used, so the region should contain the structures of interest.
+
+  The cache observes the source transform node, and is invalidated when the transform is modified. The grid is then
+  recomputed when it is requested the next time (see getGridTransformNode).
+  """
+
+  def __init__(self):
+    # Spacing of the displacement grid in mm
+    self.gridSpacingMm = 2.0
+
+    self.sourceTransformNode = None
+    self.gridTransformNode = None
+    self.gridGeometry = None
+    self.valid = False
+    self.sourceTransformObservation = None
+
+  #------------------------------------------------------------------------------
+  def getGridTransformNode(self, transformNode, bounds):
+    """Get grid transform node approximating the given transform within the bounds. It is recomputed only if the
+    transform, the bounds, or the spacing changed since the last call
+    :param bounds: World bounds of the region of interest
+    :return: Grid transform node, None on failure
+    """
+    if transformNode is None:
+      logging.error('Invalid transform for computing displacement field')
+      return None
+    if transformNode is not self.sourceTransformNode:
+      self.setSourceTransformNode(transformNode)
+    if self.valid and self.gridTransformNode is not None and self.gridGeometry == list(bounds) + [self.gridSpacingMm] \
+        and self.gridTransformNode.GetScene() is not None:
+      return self.gridTransformNode
+    if not self.computeGridTransform(bounds):
+      return None
+    return self.gridTransformNode
+
+  #------------------------------------------------------------------------------
+  def setSourceTransformNode(self, transformNode):
+    if self.sourceTransformObservation is not None:
+      self.sourceTransformObservation[0].RemoveObserver(self.sourceTransformObservation[1])
+      self.sourceTransformObservation = None
+    self.sourceTransformNode = transformNode
+    self.valid = False
+    if transformNode is not None:
+      observerTag = transformNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onSourceTransformModified)
+      self.sourceTransformObservation = (transformNode, observerTag)
+
+  #------------------------------------------------------------------------------
+  def onSourceTransformModified(self, caller, event):
+    self.valid = False
+
+  #------------------------------------------------------------------------------
+  def invalidate(self):
+    self.valid = False
+
+  #------------------------------------------------------------------------------
+  def computeGridTransform(self, bounds):
+    """Sample the source transform into the displacement grid covering the bounds
+    :return: True on success
+    """
+    gridDimensions = [max(2, int(round((bounds[2*axis+1] - bounds[2*axis]) / self.gridSpacingMm)) + 1) for axis in range(3)]
+    transformToGrid = vtk.vtkTransformToGrid()
+    transformToGrid.SetInput(self.sourceTransformNode.GetTransformFromParent())
+    transformToGrid.SetGridOrigin(bounds[0], bounds[2], bounds[4])
+    transformToGrid.SetGridSpacing(self.gridSpacingMm, self.gridSpacingMm, self.gridSpacingMm)
+    transformToGrid.SetGridExtent(0, gridDimensions[0]-1, 0, gridDimensions[1]-1, 0, gridDimensions[2]-1)
+    transformToGrid.SetGridScalarTypeToFloat()
+    transformToGrid.Update()
+
+    displacementGrid = vtk.vtkImageData()
+    displacementGrid.DeepCopy(transformToGrid.GetOutput())
+    gridTransform = slicer.vtkOrientedGridTransform()
+    gridTransform.SetDisplacementGridData(displacementGrid)
+    gridTransform.SetInterpolationModeToLinear()
+
+    if self.gridTransformNode is None or self.gridTransformNode.GetScene() is None:
+      self.gridTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode',
+        slicer.mrmlScene.GenerateUniqueName(self.sourceTransformNode.GetName() + ' Displacement Field'))
+    self.gridTransformNode.SetAndObserveTransformFromParent(gridTransform)
+    self.gridTransformNode.SetAndObserveTransformNodeID(self.sourceTransformNode.GetTransformNodeID())
+    self.gridGeometry = list(bounds) + [self.gridSpacingMm]
+    self.valid = True
+    logging.info('Computed displacement field of %s with %d x %d x %d grid points' % (self.sourceTransformNode.GetName(),
+      gridDimensions[0], gridDimensions[1], gridDimensions[2]))
+    return True
+
+  #------------------------------------------------------------------------------
+  def removeGridTransformNode(self):
+    """Remove cached grid transform node from the scene and stop observing the source transform
+    """
+    if self.gridTransformNode is not None and self.gridTransformNode.GetScene() is not None:
+      slicer.mrmlScene.RemoveNode(self.gridTransformNode)
+    self.gridTransformNode = None
+    self.setSourceTransformNode(None)
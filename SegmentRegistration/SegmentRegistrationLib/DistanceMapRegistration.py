@@ -0,0 +1,318 @@
+import logging
+import numpy as np
+import vtk, slicer
+
+#
+# -----------------------------------------------------------------------------
+# DistanceMapRegistrationLogic
+# -----------------------------------------------------------------------------
+#
+
+class DistanceMapRegistrationLogic(object):
+  """Distance map based registration of two labelmaps (Fedorov et al. 2015), without any GUI objects.
+
+  Both labelmaps are cropped to the bounding box of the structure (with padding), smoothed, and converted to
+  signed distance maps. Labelmaps may contain several structures (label values), in which case each structure
+  is smoothed and converted to a distance map separately, and the distance maps of the structures are summed, so
+  that all structures drive the registration (not only the outline of their union). The summed map is not a
+  distance map itself (its magnitude grows with the number of structures, and its zero level set is not the
+  boundary of any structure), it only matches between the fixed and moving side if both contain the same labels,
+  so labelmaps with different label sets are rejected. The distance maps are then registered with BRAINSFit,
+  first with an affine, then with a B-spline transform (initialized with the affine result). The steps can also be run one by one, with the
+  distance maps computed on a worker thread and the registration CLIs running in the background (see AsyncPipeline).
+
+  The intermediate nodes are named as in the Distance Map Based Registration module (labelmap name with
+  -Cropped, -Smoothed, and -DistanceMap suffixes) and are recorded in intermediateNodes.
+
+  The smoothed labelmap and distance map of the fixed labelmap can be cached (see fixedDistanceMapCache),
+  so that when many moving structures are registered to the same fixed structure (atlas or one-to-many
+  registration), the fixed side is only processed once.
+  """
+
+  def __init__(self):
+    # Padding around the structure bounding box when cropping the labelmaps (in voxels)
+    self.labelmapPaddingVoxels = 10
+    # Standard deviation of the Gaussian used for smoothing the labelmaps (in mm)
+    self.smoothingSigmaMm = 1.0
+    # B-spline grid size for the deformable stage
+    self.splineGridSize = '3,3,3'
+    # Cache (StageCache) for the smoothed labelmap and distance map of the fixed labelmap, keyed by the voxels and
+    # geometry of the fixed labelmap and the preprocessing parameters. Not cached if None
+    self.fixedDistanceMapCache = None
+
+    # If enabled, then the intermediate nodes are hidden from the user interface (views, node selectors, subject hierarchy)
+    self.hideIntermediateNodes = False
+    # Scene for the intermediate nodes that are not inputs of the registration CLIs (cropped and smoothed labelmaps),
+    # such as a private scratch scene. If None, then all intermediate nodes are added to the main scene
+    self.scratchScene = None
+
+    # Nodes created in the last run
+    self.intermediateNodes = []
+    self.fixedDistanceMapNode = None
+    self.movingDistanceMapNode = None
+
+  #------------------------------------------------------------------------------
+  def run(self, fixedLabelmapNode, movingLabelmapNode, affineTransformNode, bsplineTransformNode, initialTransformNode=None):
+    """Register moving labelmap to fixed labelmap.
+    :param affineTransformNode: Linear transform node receiving the affine result
+    :param bsplineTransformNode: Transform node receiving the deformable result (includes the affine part)
+    :param initialTransformNode: Linear transform node (moving to fixed) initializing the affine registration, such as
+      a pre-alignment. The results include this transform. No initialization if None
+    :return: True on success
+    """
+    if not self.computeDistanceMaps(fixedLabelmapNode, movingLabelmapNode):
+      return False
+    if not self.startAffineRegistration(affineTransformNode, waitForCompletion=True, initialTransformNode=initialTransformNode):
+      return False
+    return self.startDeformableRegistration(affineTransformNode, bsplineTransformNode, waitForCompletion=True)
+
+  #------------------------------------------------------------------------------
+  def computeDistanceMaps(self, fixedLabelmapNode, movingLabelmapNode, waitForCompletion=True):
+    """First step of the registration: compute the distance maps to register.
+    The voxels of the labelmaps are copied from the scene, so that cropping, smoothing, and computing the distance
+    maps can run on a worker thread. The intermediate nodes are added to the scene when the task is applied.
+    :return: Success if waiting for completion, the background task otherwise (see AsyncPipeline.BackgroundTask)
+    """
+    from .AsyncPipeline import BackgroundTask
+
+    # Intermediate nodes of earlier runs are kept in the list until removeIntermediateNodes is called
+    self.fixedDistanceMapNode = None
+    self.movingDistanceMapNode = None
+    if fixedLabelmapNode is None or movingLabelmapNode is None:
+      logging.error('Invalid inputs for distance map based registration')
+      return False
+
+    # Look up cached results and copy the inputs of the others (on the main thread)
+    labelmapInputs = []
+    for labelmapNode, cache in [(fixedLabelmapNode, self.fixedDistanceMapCache), (movingLabelmapNode, None)]:
+      cacheKey, cachedArrays = self.getCachedDistanceMapArrays(labelmapNode, cache)
+      labelArray = slicer.util.arrayFromVolume(labelmapNode).copy() if cachedArrays is None else None
+      labelmapInputs.append((labelmapNode, cache, cacheKey, cachedArrays, labelArray, labelmapNode.GetSpacing()))
+
+    # The summed distance maps of the structures only correspond if both labelmaps contain the same structures
+    fixedLabels, movingLabels = [self.getLabelValues(labelArray) if cachedArrays is None
+      else self.getLabelValues(cachedArrays.get('labels', cachedArrays['smoothedvoxels']))
+      for _, _, _, cachedArrays, labelArray, _ in labelmapInputs]
+    if fixedLabels != movingLabels:
+      logging.error('Labelmaps %s and %s contain different labels (%s and %s), their distance maps do not correspond' % (
+        fixedLabelmapNode.GetName(), movingLabelmapNode.GetName(), sorted(fixedLabels), sorted(movingLabels)))
+      return False
+
+    def computeArrays():
+      return [self.computeDistanceMapArrays(labelArray, spacing) if cachedArrays is None else None
+        for _, _, _, cachedArrays, labelArray, spacing in labelmapInputs]
+
+    def addDistanceMapNodes(computedArrays):
+      distanceMapNodes = []
+      for (labelmapNode, cache, cacheKey, cachedArrays, _, _), arrays in zip(labelmapInputs, computedArrays):
+        if cachedArrays is not None:
+          distanceMapNodes.append(self.addCachedDistanceMapNodes(labelmapNode, cachedArrays))
+        else:
+          distanceMapNodes.append(self.addDistanceMapNodes(labelmapNode, arrays, cache, cacheKey))
+      self.fixedDistanceMapNode, self.movingDistanceMapNode = distanceMapNodes
+      return self.fixedDistanceMapNode is not None and self.movingDistanceMapNode is not None
+
+    task = BackgroundTask(computeArrays, addDistanceMapNodes)
+    if not waitForCompletion:
+      return task
+    return task.run()
+
+  #------------------------------------------------------------------------------
+  def startAffineRegistration(self, affineTransformNode, waitForCompletion=True, initialTransformNode=None):
+    """Second step of the registration: affine registration of the distance maps.
+    :param initialTransformNode: Linear transform node initializing the registration (see run)
+    :return: Success if waiting for completion, the CLI node running in the background otherwise
+    """
+    affineParameters = {
+      'fixedVolume': self.fixedDistanceMapNode.GetID(),
+      'movingVolume': self.movingDistanceMapNode.GetID(),
+      'linearTransform': affineTransformNode.GetID(),
+      'initializeTransformMode': 'Off',
+      'useRigid': True,
+      'useScaleVersor3D': True,
+      'useScaleSkewVersor3D': True,
+      'useAffine': True,
+      'costMetric': 'MSE',
+      'interpolationMode': 'Linear' }
+    if initialTransformNode is not None:
+      affineParameters['initialTransform'] = initialTransformNode.GetID()
+    return self.runCli(slicer.modules.brainsfit, affineParameters, 'Affine registration', waitForCompletion)
+
+  #------------------------------------------------------------------------------
+  def startDeformableRegistration(self, affineTransformNode, bsplineTransformNode, waitForCompletion=True):
+    """Third step of the registration: deformable registration initialized with the affine result.
+    :return: Success if waiting for completion, the CLI node running in the background otherwise
+    """
+    bsplineParameters = {
+      'fixedVolume': self.fixedDistanceMapNode.GetID(),
+      'movingVolume': self.movingDistanceMapNode.GetID(),
+      'initialTransform': affineTransformNode.GetID(),
+      'bsplineTransform': bsplineTransformNode.GetID(),
+      'useBSpline': True,
+      'splineGridSize': self.splineGridSize,
+      'costMetric': 'MSE',
+      'interpolationMode': 'Linear' }
+    return self.runCli(slicer.modules.brainsfit, bsplineParameters, 'Deformable registration', waitForCompletion)
+
+  #------------------------------------------------------------------------------
+  def getCachedDistanceMapArrays(self, labelmapNode, cache):
+    """Look up the smoothed labelmap and distance map of a labelmap in a cache
+    :param cache: StageCache for the smoothed labelmap and the distance map. Not cached if None
+    :return: Tuple of the cache key (None if not cached) and the cached arrays (None if not found)
+    """
+    if not cache:
+      return None, None
+    cacheKey = cache.computeKey('DistanceMap', volumeNodes=[labelmapNode], parameters={
+      'labelmapPaddingVoxels':self.labelmapPaddingVoxels, 'smoothingSigmaMm':self.smoothingSigmaMm, 'perLabelDistanceMaps':True})
+    return cacheKey, cache.get(cacheKey)
+
+  #------------------------------------------------------------------------------
+  def computeDistanceMapArrays(self, labelArray, spacing):
+    """Crop, smooth, and compute signed distance map of the voxels of a labelmap. Only processes the given
+    arrays (no MRML access), so it can run on a worker thread. The distance map is the sum of the signed distance
+    maps of the labels (see the class description), and the smoothed labelmap contains the smoothed labels (a later
+    label overwriting earlier ones).
+    :param labelArray: Voxels of the labelmap (KJI order)
+    :param spacing: Spacing of the labelmap (IJK order)
+    :return: Dictionary with the index of the first voxel of the cropped region ('lower', KJI order), and the
+      cropped labelmap ('cropped'), the smoothed labelmap ('smoothed') and the distance map ('distanceMap') arrays.
+      None if the labelmap is empty
+    """
+    import SimpleITK as sitk
+
+    lower, croppedArray = self.cropLabelArray(labelArray)
+    if croppedArray is None:
+      return None
+
+    smoothedArray = np.zeros(croppedArray.shape, dtype=croppedArray.dtype)
+    distanceArray = np.zeros(croppedArray.shape, dtype=np.float32)
+    for label in np.unique(croppedArray):
+      if label == 0:
+        continue
+      # Smooth the structure so that the distance map is not affected by the staircase artifacts of the labelmap.
+      # The physical size of the voxels is needed for both filters, the origin and axis directions are not
+      binaryImage = sitk.GetImageFromArray((croppedArray == label).astype(np.float32))
+      binaryImage.SetSpacing(spacing)
+      smoothedImage = sitk.SmoothingRecursiveGaussian(binaryImage, self.smoothingSigmaMm)
+      smoothedLabelImage = sitk.Cast(smoothedImage > 0.5, sitk.sitkUInt8)
+      smoothedLabelArray = sitk.GetArrayFromImage(smoothedLabelImage)
+      if not smoothedLabelArray.any():
+        # Structures thinner than the smoothing kernel would vanish, use them as they are
+        smoothedLabelImage = sitk.Cast(binaryImage, sitk.sitkUInt8)
+        smoothedLabelArray = sitk.GetArrayFromImage(smoothedLabelImage)
+      smoothedArray[smoothedLabelArray > 0] = label
+      distanceImage = sitk.SignedMaurerDistanceMap(smoothedLabelImage, insideIsPositive=False, squaredDistance=False, useImageSpacing=True)
+      distanceArray += sitk.GetArrayFromImage(distanceImage)
+    return { 'lower': lower, 'cropped': croppedArray, 'smoothed': smoothedArray, 'distanceMap': distanceArray }
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getLabelValues(labelArray):
+    """Get the set of label values (except background) in the voxels of a labelmap
+    """
+    labelValues = np.unique(labelArray)
+    return set(labelValues[labelValues != 0].tolist())
+
+  #------------------------------------------------------------------------------
+  def cropLabelArray(self, labelArray):
+    """Crop labelmap voxels to the bounding box of the structures, padded by labelmapPaddingVoxels.
+    The padding may extend beyond the original extent, in which case the labelmap is zero-padded. Label values are kept.
+    :return: Tuple of the index of the first voxel of the cropped region (KJI order) and the cropped array.
+      (None, None) if the labelmap is empty
+    """
+    nonzeroIndices = np.nonzero(labelArray)
+    if len(nonzeroIndices[0]) == 0:
+      return None, None
+
+    # Bounds in KJI order (as in the NumPy array)
+    lower = np.array([indices.min() for indices in nonzeroIndices]) - self.labelmapPaddingVoxels
+    upper = np.array([indices.max() for indices in nonzeroIndices]) + self.labelmapPaddingVoxels + 1
+    croppedArray = np.zeros(upper - lower, dtype=labelArray.dtype)
+    sourceLower = np.maximum(lower, 0)
+    sourceUpper = np.minimum(upper, labelArray.shape)
+    croppedArray[tuple(slice(l, u) for l, u in zip(sourceLower - lower, sourceUpper - lower))] = \
+      labelArray[tuple(slice(l, u) for l, u in zip(sourceLower, sourceUpper))]
+    return lower, croppedArray
+
+  #------------------------------------------------------------------------------
+  def addDistanceMapNodes(self, labelmapNode, arrays, cache=None, cacheKey=None):
+    """Add the cropped labelmap, smoothed labelmap, and distance map computed by computeDistanceMapArrays as
+    intermediate nodes, and store the smoothed labelmap and distance map in the cache if any
+    :return: Distance map scalar volume node, None if the labelmap is empty
+    """
+    from .StageCache import StageCache
+
+    if arrays is None:
+      logging.error('Labelmap %s is empty' % labelmapNode.GetName())
+      return None
+
+    # Shift origin to the first voxel of the cropped region
+    lower = arrays['lower']
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    labelmapNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    croppedOrigin = ijkToRasMatrix.MultiplyPoint([float(lower[2]), float(lower[1]), float(lower[0]), 1.0])
+    for row in range(3):
+      ijkToRasMatrix.SetElement(row, 3, croppedOrigin[row])
+
+    nodes = {}
+    for className, suffix, arrayName, scene in [
+        ('vtkMRMLLabelMapVolumeNode', '-Cropped', 'cropped', self.scratchScene),
+        ('vtkMRMLLabelMapVolumeNode', '-Smoothed', 'smoothed', self.scratchScene),
+        ('vtkMRMLScalarVolumeNode', '-DistanceMap', 'distanceMap', None) ]:
+      node = self.addIntermediateNode(className, labelmapNode.GetName() + suffix, scene)
+      node.SetIJKToRASMatrix(ijkToRasMatrix)
+      slicer.util.updateVolumeFromArray(node, arrays[arrayName])
+      nodes[arrayName] = node
+
+    if cache:
+      cachedArrays = StageCache.arraysFromVolumeNode(nodes['smoothed'], 'smoothed')
+      cachedArrays.update(StageCache.arraysFromVolumeNode(nodes['distanceMap'], 'distanceMap'))
+      # Labels of the input (the smoothed labelmap may not contain labels overwritten by later ones)
+      cachedArrays['labels'] = np.array(sorted(self.getLabelValues(arrays['cropped'])))
+      cache.put(cacheKey, cachedArrays)
+    return nodes['distanceMap']
+
+  #------------------------------------------------------------------------------
+  def addCachedDistanceMapNodes(self, labelmapNode, cachedArrays):
+    """Add the smoothed labelmap and distance map found in the cache as intermediate nodes
+    :return: Distance map scalar volume node
+    """
+    from .StageCache import StageCache
+
+    smoothedLabelmapNode = self.addIntermediateNode('vtkMRMLLabelMapVolumeNode', labelmapNode.GetName() + '-Smoothed', self.scratchScene)
+    StageCache.updateVolumeNodeFromArrays(smoothedLabelmapNode, cachedArrays, 'smoothed')
+    distanceMapNode = self.addIntermediateNode('vtkMRMLScalarVolumeNode', labelmapNode.GetName() + '-DistanceMap')
+    StageCache.updateVolumeNodeFromArrays(distanceMapNode, cachedArrays, 'distanceMap')
+    return distanceMapNode
+
+  #------------------------------------------------------------------------------
+  def addIntermediateNode(self, className, name, scene=None):
+    """Create intermediate node in the given scene (main scene if None)
+    """
+    if scene is None:
+      scene = slicer.mrmlScene
+    node = slicer.mrmlScene.CreateNodeByClass(className)
+    node.UnRegister(None)
+    node.SetName(scene.GenerateUniqueName(name))
+    node.SetHideFromEditors(self.hideIntermediateNodes)
+    scene.AddNode(node)
+    self.intermediateNodes.append(node)
+    return node
+
+  #------------------------------------------------------------------------------
+  def removeIntermediateNodes(self):
+    for node in self.intermediateNodes:
+      if node.GetScene() is not None:
+        node.GetScene().RemoveNode(node)
+    self.intermediateNodes = []
+
+  #------------------------------------------------------------------------------
+  def runCli(self, module, parameters, description, waitForCompletion=True):
+    cliNode = slicer.cli.run(module, None, parameters, wait_for_completion=waitForCompletion)
+    if not waitForCompletion:
+      return cliNode
+    success = not (cliNode.GetStatus() & cliNode.ErrorsMask)
+    if not success:
+      logging.error('%s failed: %s' % (description, cliNode.GetErrorText()))
+    slicer.mrmlScene.RemoveNode(cliNode)
+    return success
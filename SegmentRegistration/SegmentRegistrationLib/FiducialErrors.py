@@ -0,0 +1,126 @@
+import logging
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+#
+# -----------------------------------------------------------------------------
+# FiducialErrors
+# -----------------------------------------------------------------------------
+#
+
+class FiducialErrors(object):
+  """Target registration error (TRE) of corresponding fiducials, with summary statistics.
+
+  The errors of all fiducial pairs are computed at once from position arrays: the 3D distance and the absolute
+  differences along the R-L, A-P, and I-S axes. Results are written into a table with one row per fiducial and
+  numeric error columns, followed by summary rows (mean, RMS, maximum, and percentiles of each error column).
+  Fiducial lists of a whole cohort can be evaluated in one call, producing one table with the case of each row
+  and the summary over all cases.
+  """
+
+  # Error columns of the table
+  errorColumnNames = ['3D', '2D R-L', '2D A-P', '2D I-S']
+  # Percentiles added to the summary rows
+  summaryPercentiles = [50, 95]
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getFiducialPositions(fiducialsNode):
+    """Get positions of all fiducials in a markups fiducial node
+    :return: Nx3 array
+    """
+    positions = np.zeros([fiducialsNode.GetNumberOfFiducials(), 3])
+    position = [0,0,0]
+    for index in range(fiducialsNode.GetNumberOfFiducials()):
+      fiducialsNode.GetNthFiducialPosition(index, position)
+      positions[index] = position
+    return positions
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeErrors(referencePositions, comparePositions):
+    """Compute errors of corresponding positions
+    :return: Nx4 array of the 3D distances and the absolute differences along the axes (see errorColumnNames)
+    """
+    differences = np.abs(np.asarray(comparePositions, dtype=np.float64) - np.asarray(referencePositions, dtype=np.float64))
+    return np.column_stack([np.linalg.norm(differences, axis=1), differences])
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeSummaryStatistics(errors):
+    """Compute summary statistics of each error column
+    :return: List of (statistic name, array of the statistic for each column) tuples
+    """
+    summary = [
+      ('Mean', errors.mean(axis=0)),
+      ('RMS', np.sqrt((errors**2).mean(axis=0))),
+      ('Max', errors.max(axis=0)) ]
+    for percentile in FiducialErrors.summaryPercentiles:
+      summary.append(('%dth percentile' % percentile, np.percentile(errors, percentile, axis=0)))
+    return summary
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def calculateFiducialErrors(referenceFiducialsNode, compareFiducialsNode, tableNode):
+    """Compute errors of two corresponding fiducial lists and write them with the summary rows into the table
+    :return: Nx4 error array, None on failure
+    """
+    return FiducialErrors.calculateCohortFiducialErrors([(None, referenceFiducialsNode, compareFiducialsNode)], tableNode)
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def calculateCohortFiducialErrors(cases, tableNode):
+    """Compute errors of the corresponding fiducial lists of multiple cases and write them into one table
+    :param cases: List of (case ID, reference fiducials node, compare fiducials node) tuples. If the case ID
+      is None for all cases, then the case column is omitted
+    :return: Error array of the fiducials of all cases (in order), None on failure
+    """
+    caseIds = []
+    fiducialLabels = []
+    errors = []
+    for caseId, referenceFiducialsNode, compareFiducialsNode in cases:
+      if referenceFiducialsNode is None or compareFiducialsNode is None:
+        logging.error('Invalid fiducial nodes in case %s' % caseId)
+        return None
+      if referenceFiducialsNode.GetNumberOfFiducials() != compareFiducialsNode.GetNumberOfFiducials():
+        logging.error('Fiducial lists need to contain the same number of fiducials (case %s)' % caseId)
+        return None
+      numberOfFiducials = referenceFiducialsNode.GetNumberOfFiducials()
+      errors.append(FiducialErrors.computeErrors(FiducialErrors.getFiducialPositions(referenceFiducialsNode),
+        FiducialErrors.getFiducialPositions(compareFiducialsNode)))
+      caseIds.extend([caseId] * numberOfFiducials)
+      # Labels are prefixed by the node name (such as 'US fiducials-1'), which is removed
+      labelPrefix = referenceFiducialsNode.GetName() + '-'
+      for index in range(numberOfFiducials):
+        label = referenceFiducialsNode.GetNthFiducialLabel(index)
+        fiducialLabels.append(label[len(labelPrefix):] if label.startswith(labelPrefix) else label)
+    errors = np.concatenate(errors) if errors else np.zeros([0,4])
+    if len(errors) == 0:
+      logging.error('Fiducial lists need to contain at least one fiducial')
+      return None
+
+    summary = FiducialErrors.computeSummaryStatistics(errors)
+    rowHeaders = fiducialLabels + [name for name, _ in summary]
+    tableErrors = np.vstack([errors] + [values for _, values in summary])
+
+    table = vtk.vtkTable()
+    headerColumn = vtk.vtkStringArray()
+    headerColumn.SetName('Fiducial')
+    for rowHeader in rowHeaders:
+      headerColumn.InsertNextValue(rowHeader)
+    table.AddColumn(headerColumn)
+    if any([caseId is not None for caseId in caseIds]):
+      caseColumn = vtk.vtkStringArray()
+      caseColumn.SetName('Case')
+      for caseId in caseIds + [''] * len(summary):
+        caseColumn.InsertNextValue(str(caseId) if caseId is not None else '')
+      table.AddColumn(caseColumn)
+    for columnIndex, columnName in enumerate(FiducialErrors.errorColumnNames):
+      errorColumn = numpy_support.numpy_to_vtk(np.ascontiguousarray(tableErrors[:,columnIndex]), deep=1)
+      errorColumn.SetName(columnName)
+      table.AddColumn(errorColumn)
+    tableNode.SetAndObserveTable(table)
+    tableNode.SetUseFirstColumnAsRowHeader(True)
+    tableNode.SetUseColumnNameAsColumnHeader(True)
+    return errors
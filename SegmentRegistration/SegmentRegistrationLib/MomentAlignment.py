@@ -0,0 +1,102 @@
+import logging
+import numpy as np
+import vtk, slicer
+from .SegmentRasterizer import SegmentRasterizer
+
+#
+# -----------------------------------------------------------------------------
+# MomentAlignment
+# -----------------------------------------------------------------------------
+#
+
+class MomentAlignment(object):
+  """Rigid pre-alignment of segments from their voxel moments.
+
+  The segments are rasterized on the grid of a reference volume (only within their extent, see
+  SegmentRasterizer), and the centroid and principal axes are computed from the first and second order
+  moments of the voxel positions. The rigid transform maps the moving centroid to the fixed centroid, and
+  rotates the moving principal axes onto the fixed ones.
+
+  The direction of each principal axis is ambiguous, so of the possible rotations the one closest to identity
+  is used (the structures are assumed to be rotated by less than 90 degrees). The axes of near-spherical
+  structures are not well defined, in which case only the translation is used.
+  """
+
+  # Minimum relative difference between the variances along the principal axes for the axes to be used
+  minimumRelativeVarianceDifference = 0.05
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeSegmentMoments(segmentationNode, segmentNames, referenceVolumeNode):
+    """Compute centroid and principal axes of the union of segments
+    :param referenceVolumeNode: Volume defining the voxel grid used for computing the moments.
+      Positions are given in the coordinate system of this volume
+    :return: Tuple of centroid, principal axes (columns of 3x3 array, in order of decreasing variance),
+      and variances along the axes. None on failure
+    """
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    ijkToRasArray = slicer.util.arrayFromVTKMatrix(ijkToRasMatrix)
+
+    voxelPositions = []
+    for segmentName in segmentNames:
+      labelArray, extent = SegmentRasterizer.getSegmentLabelArray(segmentationNode, segmentName, referenceVolumeNode, True)
+      if labelArray is None:
+        return None
+      # Voxel indices (KJI order in the array) converted to IJK on the whole reference grid
+      ijkIndices = np.transpose(np.nonzero(labelArray))[:,::-1] + [extent[0], extent[2], extent[4]]
+      voxelPositions.append(ijkIndices.dot(ijkToRasArray[:3,:3].T) + ijkToRasArray[:3,3])
+    voxelPositions = np.concatenate(voxelPositions)
+    if len(voxelPositions) < 4:
+      logging.error('Too few voxels for computing segment moments in ' + segmentationNode.GetName())
+      return None
+
+    # All voxels have the same volume, so the moments are the mean and covariance of the positions
+    centroid = voxelPositions.mean(axis=0)
+    covariance = np.cov(voxelPositions - centroid, rowvar=False)
+    variances, axes = np.linalg.eigh(covariance)
+    order = np.argsort(variances)[::-1]
+    variances = variances[order]
+    axes = axes[:,order]
+    # Right-handed coordinate system
+    if np.linalg.det(axes) < 0:
+      axes[:,2] = -axes[:,2]
+    return centroid, axes, variances
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeMoving2FixedMatrix(fixedMoments, movingMoments):
+    """Compute rigid transform aligning the moving moments with the fixed moments
+    :return: vtkMatrix4x4 (moving to fixed)
+    """
+    fixedCentroid, fixedAxes, fixedVariances = fixedMoments
+    movingCentroid, movingAxes, movingVariances = movingMoments
+
+    rotation = np.eye(3)
+    if MomentAlignment.arePrincipalAxesDefined(fixedVariances) and MomentAlignment.arePrincipalAxesDefined(movingVariances):
+      # Choose axis directions (keeping both systems right-handed) so that the rotation is the closest to identity
+      bestTrace = None
+      for signs in [[1,1,1], [1,-1,-1], [-1,1,-1], [-1,-1,1]]:
+        candidateRotation = (fixedAxes * signs).dot(movingAxes.T)
+        if bestTrace is None or np.trace(candidateRotation) > bestTrace:
+          bestTrace = np.trace(candidateRotation)
+          rotation = candidateRotation
+    else:
+      logging.warning('Principal axes of the segments are not well defined, only translation is used for pre-alignment')
+    translation = fixedCentroid - rotation.dot(movingCentroid)
+
+    moving2FixedMatrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for column in range(3):
+        moving2FixedMatrix.SetElement(row, column, rotation[row, column])
+      moving2FixedMatrix.SetElement(row, 3, translation[row])
+    return moving2FixedMatrix
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def arePrincipalAxesDefined(variances):
+    """Check if the variances along the principal axes (in decreasing order) are distinct enough
+    """
+    if variances[0] <= 0:
+      return False
+    return all([(variances[index] - variances[index+1]) / variances[0] >= MomentAlignment.minimumRelativeVarianceDifference for index in range(2)])
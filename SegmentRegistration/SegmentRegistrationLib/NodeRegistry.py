@@ -0,0 +1,129 @@
+import logging
+import vtk, slicer
+
+#
+# -----------------------------------------------------------------------------
+# NodeRegistry
+# -----------------------------------------------------------------------------
+#
+
+class NodeRegistry(object):
+  """Track the nodes that one run of a pipeline adds to the scene, and release them together when the run ends.
+
+  Usage:
+    nodeRegistry = NodeRegistry('SegmentRegistration', caseId)
+    nodeRegistry.start()
+    try:
+      runPipeline()
+    finally:
+      leakReport = nodeRegistry.finish(resultNodes, intermediateNodes)
+
+  While the run is tracked, every node added to the scene is recorded (singletons excepted), independently of
+  its name, so nodes renamed by GenerateUniqueName or created by CLIs and other modules are also found. At the
+  end of the run all recorded nodes except the result nodes (and their display and storage nodes) are removed
+  in one batch, also if the run failed halfway.
+
+  Recorded nodes that are neither results nor known intermediate nodes of the run (such as parameter nodes
+  and ROIs created by other modules) are leaks of the run, which are released too, and are listed in the leak
+  report with the size of their data.
+  """
+
+  def __init__(self, runName, runId=None):
+    self.runName = runName
+    self.runId = runId
+    self.scene = slicer.mrmlScene
+    self.addedNodes = []
+    self.nodeAddedObserverTag = None
+
+  #------------------------------------------------------------------------------
+  def start(self):
+    """Start recording the nodes added to the scene
+    """
+    self.addedNodes = []
+    if self.nodeAddedObserverTag is None:
+      self.nodeAddedObserverTag = self.scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+
+  #------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    if node is not None and node.GetSingletonTag() is None:
+      self.addedNodes.append(node)
+
+  #------------------------------------------------------------------------------
+  def finish(self, resultNodes, intermediateNodes, releaseNodes=True):
+    """Stop recording, and remove all nodes of the run except the results in one batch
+    :param resultNodes: Nodes created by the run that are kept in the scene (None entries are ignored)
+    :param intermediateNodes: Nodes the run knows to be temporary (None entries are ignored). Other recorded
+      nodes that are not results are reported as leaked
+    :param releaseNodes: If disabled, then no nodes are removed (for keeping intermediate nodes for inspection)
+    :return: Leak report dictionary with the number of released nodes and bytes, and the number, bytes, and
+      names of the leaked nodes
+    """
+    if self.nodeAddedObserverTag is not None:
+      self.scene.RemoveObserver(self.nodeAddedObserverTag)
+      self.nodeAddedObserverTag = None
+
+    # Nodes of other scenes (such as a scratch scene of the run) are not tracked, and their IDs are not unique here
+    resultNodeIDs = self.getNodeIDsWithDisplayAndStorageNodes([node for node in resultNodes if node is not None and node.GetScene() is self.scene])
+    intermediateNodeIDs = self.getNodeIDsWithDisplayAndStorageNodes([node for node in intermediateNodes if node is not None and node.GetScene() is self.scene])
+    runNodes = [node for node in self.addedNodes if node.GetScene() is self.scene and node.GetID() not in resultNodeIDs]
+    leakedNodes = [node for node in runNodes if node.GetID() not in intermediateNodeIDs]
+    self.addedNodes = []
+
+    releasedNodes = runNodes if releaseNodes else []
+    report = {
+      'run': self.runName,
+      'runId': self.runId,
+      'releasedNodes': len(releasedNodes),
+      'releasedBytes': sum([self.getNodeMemorySize(node) for node in releasedNodes]),
+      'leakedNodes': len(leakedNodes),
+      'leakedBytes': sum([self.getNodeMemorySize(node) for node in leakedNodes]),
+      'leakedNodeNames': [node.GetName() for node in leakedNodes] }
+
+    if releasedNodes:
+      self.scene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+      try:
+        for node in releasedNodes:
+          if node.GetScene() is self.scene:
+            self.scene.RemoveNode(node)
+      finally:
+        self.scene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+    if leakedNodes:
+      logging.warning('%s run %s leaked %d nodes (%d bytes): %s' % (self.runName, self.runId, report['leakedNodes'],
+        report['leakedBytes'], ', '.join(report['leakedNodeNames'])))
+    return report
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getNodeIDsWithDisplayAndStorageNodes(nodes):
+    nodeIDs = set()
+    for node in [node for node in nodes if node is not None]:
+      nodeIDs.add(node.GetID())
+      if node.IsA('vtkMRMLDisplayableNode'):
+        nodeIDs.update([node.GetNthDisplayNodeID(index) for index in range(node.GetNumberOfDisplayNodes())])
+      if node.IsA('vtkMRMLStorableNode') and node.GetStorageNodeID():
+        nodeIDs.add(node.GetStorageNodeID())
+    return nodeIDs
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getNodeMemorySize(node):
+    """Get size of the data (image, mesh, segment representations, table) held by a node in bytes
+    """
+    dataObjects = []
+    if node.IsA('vtkMRMLVolumeNode'):
+      dataObjects.append(node.GetImageData())
+    elif node.IsA('vtkMRMLModelNode'):
+      dataObjects.append(node.GetPolyData())
+    elif node.IsA('vtkMRMLTableNode'):
+      dataObjects.append(node.GetTable())
+    elif node.IsA('vtkMRMLSegmentationNode'):
+      segmentation = node.GetSegmentation()
+      representationNames = [slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName(),
+        slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()]
+      for segmentIndex in range(segmentation.GetNumberOfSegments()):
+        segment = segmentation.GetNthSegment(segmentIndex)
+        dataObjects.extend([segment.GetRepresentation(name) for name in representationNames])
+    # Actual memory size is reported in kibibytes
+    return sum([dataObject.GetActualMemorySize() for dataObject in dataObjects if dataObject is not None]) * 1024
@@ -0,0 +1,143 @@
+import logging
+import numpy as np
+import vtk
+from .SegmentRasterizer import SegmentRasterizer
+
+#
+# -----------------------------------------------------------------------------
+# OverlapMetrics
+# -----------------------------------------------------------------------------
+#
+
+class OverlapMetrics(object):
+  """Overlap metrics (Dice, Jaccard, volume difference, false positive and false negative volumes) of segment pairs.
+
+  Both segments of a pair are rasterized on the grid of a reference volume, only within their extent (see
+  SegmentRasterizer). The voxels of each mask are counted within its own extent, and the voxels of the intersection
+  within the overlap of the two extents (on views of the masks, without placing them into a common array), so no
+  array larger than the masks is allocated. All pairs are evaluated in one call, and the results are written into
+  one table with a row per pair.
+  """
+
+  # Metric columns of the results table (in addition to the segment names), with the keys of the metric dictionaries
+  metricColumns = [
+    ('Dice', 'dice'),
+    ('Jaccard', 'jaccard'),
+    ('Reference volume (cc)', 'referenceVolumeCc'),
+    ('Compare volume (cc)', 'compareVolumeCc'),
+    ('Volume difference (cc)', 'volumeDifferenceCc'),
+    ('False positive volume (cc)', 'falsePositiveVolumeCc'),
+    ('False negative volume (cc)', 'falseNegativeVolumeCc') ]
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeOverlapMetrics(referenceSegmentationNode, compareSegmentationNode, segmentNamePairs, referenceVolumeNode):
+    """Compute overlap metrics of segment pairs
+    :param segmentNamePairs: List of (reference segment name, compare segment name) tuples
+    :param referenceVolumeNode: Volume defining the voxel grid on which the segments are compared
+    :return: List of metric dictionaries (one per pair, see metricColumns for the keys), None on failure
+    """
+    if referenceSegmentationNode is None or compareSegmentationNode is None or referenceVolumeNode is None:
+      logging.error('Invalid inputs for computing overlap metrics')
+      return None
+    spacing = referenceVolumeNode.GetSpacing()
+    voxelVolumeCc = spacing[0] * spacing[1] * spacing[2] / 1000.0
+
+    metrics = []
+    for referenceSegmentName, compareSegmentName in segmentNamePairs:
+      referenceMask = OverlapMetrics.getSegmentMask(referenceSegmentationNode, referenceSegmentName, referenceVolumeNode)
+      compareMask = OverlapMetrics.getSegmentMask(compareSegmentationNode, compareSegmentName, referenceVolumeNode)
+      if referenceMask is None or compareMask is None:
+        return None
+      pairMetrics = OverlapMetrics.computeMaskMetrics(referenceMask, compareMask, voxelVolumeCc)
+      pairMetrics['referenceSegmentName'] = referenceSegmentName
+      pairMetrics['compareSegmentName'] = compareSegmentName
+      metrics.append(pairMetrics)
+    return metrics
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getSegmentMask(segmentationNode, segmentName, referenceVolumeNode):
+    """Rasterize segment within its extent on the reference grid
+    :return: Tuple of boolean array (KJI) and extent. Empty segments are returned as (None, None).
+      None if the segment does not exist
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    if segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(segmentName)) is None:
+      logging.error('Failed to get segment %s in %s' % (segmentName, segmentationNode.GetName()))
+      return None
+    return SegmentRasterizer.getSegmentLabelArray(segmentationNode, segmentName, referenceVolumeNode, True)
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeMaskMetrics(referenceMask, compareMask, voxelVolumeCc):
+    """Compute overlap metrics of two masks given as (boolean array, extent) tuples on the same grid
+    :return: Metric dictionary
+    """
+    referenceVoxels = np.count_nonzero(referenceMask[0]) if referenceMask[1] is not None else 0
+    compareVoxels = np.count_nonzero(compareMask[0]) if compareMask[1] is not None else 0
+    intersectionVoxels = 0
+    intersectionExtent = OverlapMetrics.getIntersectionExtent(referenceMask[1], compareMask[1])
+    if intersectionExtent is not None:
+      intersectionVoxels = np.count_nonzero(OverlapMetrics.getMaskInExtent(referenceMask[0], referenceMask[1], intersectionExtent)
+        & OverlapMetrics.getMaskInExtent(compareMask[0], compareMask[1], intersectionExtent))
+    unionVoxels = referenceVoxels + compareVoxels - intersectionVoxels
+
+    return {
+      'dice': 2.0 * intersectionVoxels / (referenceVoxels + compareVoxels) if referenceVoxels + compareVoxels > 0 else 1.0,
+      'jaccard': float(intersectionVoxels) / unionVoxels if unionVoxels > 0 else 1.0,
+      'referenceVolumeCc': referenceVoxels * voxelVolumeCc,
+      'compareVolumeCc': compareVoxels * voxelVolumeCc,
+      'volumeDifferenceCc': (compareVoxels - referenceVoxels) * voxelVolumeCc,
+      'falsePositiveVolumeCc': (compareVoxels - intersectionVoxels) * voxelVolumeCc,
+      'falseNegativeVolumeCc': (referenceVoxels - intersectionVoxels) * voxelVolumeCc }
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getIntersectionExtent(extent1, extent2):
+    """Get overlap of two extents
+    :return: Intersection extent, None if the extents do not overlap or any of them is None
+    """
+    if extent1 is None or extent2 is None:
+      return None
+    intersectionExtent = [max(extent1[2*axis], extent2[2*axis]) if bound == 0 else min(extent1[2*axis+1], extent2[2*axis+1])
+      for axis in range(3) for bound in range(2)]
+    if any([intersectionExtent[2*axis] > intersectionExtent[2*axis+1] for axis in range(3)]):
+      return None
+    return intersectionExtent
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getMaskInExtent(maskArray, maskExtent, extent):
+    """Get view of the voxels of a mask within an extent contained by the extent of the mask (no copy)
+    """
+    return maskArray[extent[4]-maskExtent[4]:extent[5]-maskExtent[4]+1, extent[2]-maskExtent[2]:extent[3]-maskExtent[2]+1,
+      extent[0]-maskExtent[0]:extent[1]-maskExtent[0]+1]
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def writeMetricsTable(metrics, tableNode, metricColumns=None):
+    """Write metrics of all pairs into the table node (one row per pair, numeric metric columns)
+    :param metricColumns: List of (column name, metric key) tuples. Default is the overlap metric columns.
+      Metrics of other engines (such as SurfaceDistanceMetrics) can be written to the same table by merging
+      the metric dictionaries and concatenating the column lists
+    """
+    if metricColumns is None:
+      metricColumns = OverlapMetrics.metricColumns
+    table = vtk.vtkTable()
+    for columnName, key in [('Reference segment', 'referenceSegmentName'), ('Compare segment', 'compareSegmentName')]:
+      column = vtk.vtkStringArray()
+      column.SetName(columnName)
+      column.SetNumberOfValues(len(metrics))
+      for row, pairMetrics in enumerate(metrics):
+        column.SetValue(row, pairMetrics[key])
+      table.AddColumn(column)
+    for columnName, key in metricColumns:
+      column = vtk.vtkDoubleArray()
+      column.SetName(columnName)
+      column.SetNumberOfValues(len(metrics))
+      for row, pairMetrics in enumerate(metrics):
+        column.SetValue(row, pairMetrics[key])
+      table.AddColumn(column)
+    tableNode.SetAndObserveTable(table)
+    tableNode.SetUseColumnNameAsColumnHeader(True)
@@ -0,0 +1,268 @@
+"""Offline benchmark of the segment registration pipeline on synthetic phantoms.
+
+Fixed and moving volumes and segmentations are generated from an ellipsoid, the moving one being
+the fixed ellipsoid mapped by a known ground truth transform (rotation, translation, scaling, and
+optionally a smooth sinusoidal deformation). Each configuration (volume size and spacing, and type
+of deformation) is registered with SegmentRegistrationLogic, and the per-stage timing report is
+recorded together with the target registration error (TRE) of landmarks sampled in the moving
+structure, and the overlap metrics of the deformed moving structure with the fixed structure. No data is downloaded, so the benchmark runs on machines without network access.
+
+The benchmark needs to run inside Slicer:
+
+  Slicer --no-splash --no-main-window --python-script RegistrationBenchmark.py --output benchmark.json --sizes small,medium
+
+The result is a JSON file containing one record per configuration and the per-stage timing
+statistics over all configurations.
+"""
+
+import sys
+import json
+import math
+import time
+import argparse
+import logging
+import numpy as np
+import vtk, slicer
+
+# Volume geometries of the benchmark. The phantom has the same physical size in all of them,
+# so the configurations differ in the number of voxels to process
+volumeGeometries = {
+  'small': {'dimensions': [64, 64, 48], 'spacing': [1.5, 1.5, 2.0]},
+  'medium': {'dimensions': [128, 128, 96], 'spacing': [0.75, 0.75, 1.0]},
+  'large': {'dimensions': [256, 256, 128], 'spacing': [0.4, 0.4, 0.75]},
+  'anisotropic': {'dimensions': [256, 256, 32], 'spacing': [0.4, 0.4, 3.0]} }
+
+# Ground truth moving to fixed transforms
+deformations = {
+  'rigid': {'rotationDeg': [8.0, -5.0, 12.0], 'translationMm': [6.0, -4.0, 3.0], 'scale': [1.0, 1.0, 1.0], 'amplitudeMm': 0.0},
+  'affine': {'rotationDeg': [8.0, -5.0, 12.0], 'translationMm': [6.0, -4.0, 3.0], 'scale': [1.1, 0.92, 1.05], 'amplitudeMm': 0.0},
+  'deformable': {'rotationDeg': [8.0, -5.0, 12.0], 'translationMm': [6.0, -4.0, 3.0], 'scale': [1.1, 0.92, 1.05], 'amplitudeMm': 2.5} }
+
+# Radii of the ellipsoid in the fixed phantom (similar to a prostate)
+phantomRadiiMm = [22.0, 18.0, 16.0]
+# Wavelength of the sinusoidal deformation
+deformationWavelengthMm = 60.0
+numberOfLandmarks = 200
+randomSeed = 42
+
+#
+# -----------------------------------------------------------------------------
+# GroundTruthTransform
+# -----------------------------------------------------------------------------
+#
+
+class GroundTruthTransform(object):
+  """Known mapping from moving to fixed physical space: p_fixed = A*p_moving + t + d(p_moving)
+  where A contains rotation and scaling around the origin, and d is a smooth sinusoidal deformation.
+  """
+
+  def __init__(self, rotationDeg, translationMm, scale, amplitudeMm):
+    rx, ry, rz = [math.radians(angle) for angle in rotationDeg]
+    rotationX = np.array([[1, 0, 0], [0, math.cos(rx), -math.sin(rx)], [0, math.sin(rx), math.cos(rx)]])
+    rotationY = np.array([[math.cos(ry), 0, math.sin(ry)], [0, 1, 0], [-math.sin(ry), 0, math.cos(ry)]])
+    rotationZ = np.array([[math.cos(rz), -math.sin(rz), 0], [math.sin(rz), math.cos(rz), 0], [0, 0, 1]])
+    self.matrix = rotationZ.dot(rotationY).dot(rotationX).dot(np.diag(scale))
+    self.translation = np.array(translationMm, dtype=float)
+    self.amplitudeMm = amplitudeMm
+
+  #------------------------------------------------------------------------------
+  def transformPoints(self, points):
+    """Map Nx3 array of moving points to fixed space
+    """
+    transformedPoints = points.dot(self.matrix.T) + self.translation
+    if self.amplitudeMm:
+      phase = 2.0 * math.pi * points / deformationWavelengthMm
+      transformedPoints[:,0] += self.amplitudeMm * np.sin(phase[:,2])
+      transformedPoints[:,1] += self.amplitudeMm * np.sin(phase[:,0])
+      transformedPoints[:,2] += self.amplitudeMm * np.sin(phase[:,1])
+    return transformedPoints
+
+# -----------------------------------------------------------------------------
+# Phantom generation
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def getVoxelCenterPoints(dimensions, spacing):
+  """Get RAS coordinates of the voxel centers of a volume centered at the origin, as a KJIx3 array
+  """
+  origin = [-(dimension-1) * voxelSpacing / 2.0 for dimension, voxelSpacing in zip(dimensions, spacing)]
+  axes = [np.arange(dimensions[axis], dtype=np.float32) * spacing[axis] + origin[axis] for axis in range(3)]
+  k, j, i = np.meshgrid(axes[2], axes[1], axes[0], indexing='ij')
+  return np.stack([i, j, k], axis=-1), origin
+
+#------------------------------------------------------------------------------
+def isInsidePhantom(points):
+  """Check which points (...x3 array in fixed space) are inside the phantom ellipsoid
+  """
+  return (((points / np.array(phantomRadiiMm, dtype=np.float32)) ** 2).sum(axis=-1)) <= 1.0
+
+#------------------------------------------------------------------------------
+def createPhantomNodes(name, dimensions, spacing, groundTruthTransform=None):
+  """Create volume and segmentation nodes of a phantom.
+  :param groundTruthTransform: Moving to fixed transform if a moving phantom is created, None for the fixed phantom
+  :return: Tuple of volume node, segmentation node, and label array (KJI)
+  """
+  points, origin = getVoxelCenterPoints(dimensions, spacing)
+  if groundTruthTransform is not None:
+    points = groundTruthTransform.transformPoints(points.reshape(-1,3)).reshape(points.shape)
+  labelArray = isInsidePhantom(points).astype(np.uint8)
+
+  # Image with structure brighter than background and some noise, so that intensity-based steps have realistic input
+  randomState = np.random.RandomState(randomSeed)
+  imageArray = (labelArray * 100.0 + 20.0 + randomState.normal(0.0, 5.0, labelArray.shape)).astype(np.int16)
+
+  volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+  volumeNode.SetOrigin(origin)
+  volumeNode.SetSpacing(spacing)
+  slicer.util.updateVolumeFromArray(volumeNode, imageArray)
+  volumeNode.CreateDefaultDisplayNodes()
+
+  labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', name + '_Label')
+  labelmapNode.SetOrigin(origin)
+  labelmapNode.SetSpacing(spacing)
+  slicer.util.updateVolumeFromArray(labelmapNode, labelArray)
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', name + '_Segmentation')
+  segmentationNode.CreateDefaultDisplayNodes()
+  slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+  segmentationNode.GetSegmentation().GetNthSegment(0).SetName('Structure')
+  slicer.mrmlScene.RemoveNode(labelmapNode)
+
+  return volumeNode, segmentationNode, labelArray
+
+#------------------------------------------------------------------------------
+def sampleLandmarks(labelArray, volumeNode, numberOfPoints):
+  """Sample random points inside the structure of a phantom
+  :return: Nx3 array of RAS coordinates
+  """
+  randomState = np.random.RandomState(randomSeed)
+  insideIndices = np.argwhere(labelArray > 0)
+  selectedIndices = insideIndices[randomState.choice(len(insideIndices), min(numberOfPoints, len(insideIndices)), replace=False)]
+  ijkToRas = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRas)
+  ijkToRasArray = slicer.util.arrayFromVTKMatrix(ijkToRas)
+  # Indices are in KJI order
+  ijkPoints = np.hstack([selectedIndices[:,::-1], np.ones((len(selectedIndices),1))])
+  return ijkPoints.dot(ijkToRasArray.T)[:,:3]
+
+# -----------------------------------------------------------------------------
+# Benchmark
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def computeEstimatedFixedPoints(logic, movingPoints):
+  """Map moving points to fixed space with the registration result (the deformable transform includes the pre-alignment)
+  """
+  deformableTransform = logic.bsplineTransformNode.GetTransformToParent()
+  return np.array([deformableTransform.TransformPoint(point) for point in movingPoints])
+
+#------------------------------------------------------------------------------
+def computeErrorStatistics(estimatedPoints, groundTruthPoints):
+  errors = np.linalg.norm(estimatedPoints - groundTruthPoints, axis=1)
+  return {'meanMm': float(errors.mean()), 'rmsMm': float(np.sqrt((errors**2).mean())), 'maxMm': float(errors.max())}
+
+#------------------------------------------------------------------------------
+def runConfiguration(geometryName, deformationName, preAlignmentMode='BoundingBox'):
+  """Generate phantoms for one configuration, register them, and measure time and accuracy
+  :return: Result record
+  """
+  from SegmentRegistration import SegmentRegistrationLogic
+  from SegmentRegistrationLib import OverlapMetrics
+
+  geometry = volumeGeometries[geometryName]
+  deformation = deformations[deformationName]
+  configurationName = geometryName + '_' + deformationName
+  record = {'name': configurationName, 'geometry': geometryName, 'deformation': deformationName, 'preAlignmentMode': preAlignmentMode,
+    'dimensions': geometry['dimensions'], 'spacing': geometry['spacing'], 'success': False}
+  logging.info('Benchmark configuration ' + configurationName)
+
+  slicer.mrmlScene.Clear(0)
+  groundTruthTransform = GroundTruthTransform(**deformation)
+  startTime = time.perf_counter()
+  fixedVolumeNode, fixedSegmentationNode, _ = createPhantomNodes('Fixed', geometry['dimensions'], geometry['spacing'])
+  movingVolumeNode, movingSegmentationNode, movingLabelArray = createPhantomNodes('Moving', geometry['dimensions'], geometry['spacing'], groundTruthTransform)
+  record['phantomGenerationTimeSec'] = time.perf_counter() - startTime
+
+  movingLandmarks = sampleLandmarks(movingLabelArray, movingVolumeNode, numberOfLandmarks)
+  groundTruthFixedLandmarks = groundTruthTransform.transformPoints(movingLandmarks)
+  record['initialTre'] = computeErrorStatistics(movingLandmarks, groundTruthFixedLandmarks)
+
+  logic = SegmentRegistrationLogic()
+  logic.fixedVolumeNode = fixedVolumeNode
+  logic.fixedSegmentationNode = fixedSegmentationNode
+  logic.fixedSegmentName = 'Structure'
+  logic.movingVolumeNode = movingVolumeNode
+  logic.movingSegmentationNode = movingSegmentationNode
+  logic.movingSegmentName = 'Structure'
+  logic.preAlignmentMode = preAlignmentMode
+  logic.countSceneEvents = True
+  try:
+    record['success'] = bool(logic.performRegistration(configurationName))
+  except Exception as e:
+    import traceback
+    traceback.print_exc()
+    record['error'] = str(e)
+  record['timing'] = logic.timingReport
+  record['leakReport'] = logic.leakReport
+  record['sceneEvents'] = logic.sceneEventReport
+
+  if record['success']:
+    estimatedFixedLandmarks = computeEstimatedFixedPoints(logic, movingLandmarks)
+    record['tre'] = computeErrorStatistics(estimatedFixedLandmarks, groundTruthFixedLandmarks)
+    logic.applyDeformableTransformation()
+    overlapMetrics = OverlapMetrics.computeOverlapMetrics(fixedSegmentationNode, movingSegmentationNode, [('Structure', 'Structure')], fixedVolumeNode)
+    record['overlap'] = overlapMetrics[0] if overlapMetrics else None
+    logging.info('Configuration %s: %.1fs, TRE %.2fmm (initial %.2fmm)' % (configurationName,
+      record['timing']['totalWallTimeSec'], record['tre']['meanMm'], record['initialTre']['meanMm']))
+
+  slicer.mrmlScene.Clear(0)
+  return record
+
+#------------------------------------------------------------------------------
+def runBenchmark(geometryNames=None, deformationNames=None, preAlignmentMode='BoundingBox'):
+  """Run all combinations of the given geometries and deformations
+  :return: Dictionary with the configuration records and the per-stage timing statistics
+  """
+  from SegmentRegistrationLib import aggregateTimingReports
+
+  if geometryNames is None:
+    geometryNames = list(volumeGeometries.keys())
+  if deformationNames is None:
+    deformationNames = list(deformations.keys())
+
+  records = []
+  for geometryName in geometryNames:
+    for deformationName in deformationNames:
+      records.append(runConfiguration(geometryName, deformationName, preAlignmentMode))
+
+  return {
+    'slicerVersion': slicer.app.applicationVersion,
+    'configurations': records,
+    'stageStatistics': aggregateTimingReports([record['timing'] for record in records if record['timing']]) }
+
+#------------------------------------------------------------------------------
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark segment registration on synthetic phantoms')
+  parser.add_argument('--output', required=True, help='Output JSON file')
+  parser.add_argument('--sizes', default=','.join(volumeGeometries.keys()), help='Comma-separated list of volume geometries: ' + ', '.join(volumeGeometries.keys()))
+  parser.add_argument('--deformations', default=','.join(deformations.keys()), help='Comma-separated list of deformations: ' + ', '.join(deformations.keys()))
+  parser.add_argument('--preAlignment', default='BoundingBox', choices=['BoundingBox', 'Moments'], help='Pre-alignment mode of the registration')
+  args = parser.parse_args(argv)
+
+  geometryNames = args.sizes.split(',')
+  deformationNames = args.deformations.split(',')
+  for name in geometryNames:
+    if name not in volumeGeometries:
+      parser.error('Unknown size: ' + name)
+  for name in deformationNames:
+    if name not in deformations:
+      parser.error('Unknown deformation: ' + name)
+
+  result = runBenchmark(geometryNames, deformationNames, args.preAlignment)
+  with open(args.output, 'w') as outputFile:
+    json.dump(result, outputFile, indent=2)
+  return 0 if all(record['success'] for record in result['configurations']) else 1
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  # Slicer keeps running after the script is executed, so the application needs to be exited explicitly
+  slicer.util.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+import functools
+import threading
+from .DistanceMapRegistration import DistanceMapRegistrationLogic
+from .VolumeResampler import VolumeResampler
+from .DisplacementFieldCache import DisplacementFieldCache
+
+#
+# -----------------------------------------------------------------------------
+# RegistrationContext
+# -----------------------------------------------------------------------------
+#
+
+class RegistrationContext(object):
+  """Per-case state of the segment registration workflow: the inputs, the intermediate and result nodes, and the
+  reports of one registration.
+
+  SegmentRegistrationLogic only keeps its settings (the options set in its constructor) as attributes, and all per-case
+  state in a context. The per-case attributes of the logic (such as logic.fixedVolumeNode) are views of the current
+  context (see addContextProperties), so code setting the inputs and reading the results on the logic works as before,
+  using the default context of the logic. The stages of the workflow also take a context and return it (see
+  contextStage), so that several cases can be processed by the same logic one after the other or interleaved (such as
+  preparing a case while the results of another one are reviewed) without sharing mutable state:
+
+    context = RegistrationContext(fixedVolumeNode=fixedVolumeNode, fixedSegmentationNode=fixedSegmentationNode,
+      fixedSegmentName='Prostate', movingVolumeNode=movingVolumeNode, movingSegmentationNode=movingSegmentationNode,
+      movingSegmentName='Prostate')
+    context = logic.performRegistration('Case1', context=context)
+    if context.success:
+      applyTransform(context.bsplineTransformNode)
+
+  Contexts do not make the registration thread safe: the stages modify the main MRML scene (adding nodes, batch
+  processing state, running CLIs), which is not thread safe, so stages must not run concurrently from several threads.
+  Cases are processed in parallel in separate Slicer processes instead (see BatchRegistration).
+  """
+
+  __slots__ = [
+    'caseId',
+    # Inputs
+    'fixedVolumeNode', 'fixedSegmentationNode', 'fixedSegmentName',
+    'movingVolumeNode', 'movingSegmentationNode', 'movingSegmentName',
+    # List of (fixed segment name, moving segment name) tuples to register in one pass. If empty, then the
+    # single pair given by fixedSegmentName and movingSegmentName is registered. The preprocessed volumes are
+    # shared by all pairs, and the labelmaps contain all pairs (pair i having label value i+1)
+    'segmentNamePairs',
+    'movingVolumeNodeForExport', 'movingSegmentationNodeForExport',
+    # Intermediate nodes
+    'fixedVolumeHardenedNode', 'fixedSegmentationHardenedNode', 'fixedResampledVolumeNode', 'fixedLabelmap',
+    'movingSegmentationHardenedNode', 'movingLabelmap', 'pairLabelmaps',
+    # Results. If the segment pairs are registered separately, then pairTransformNodes contains the
+    # (affine transform node, deformable transform node) tuple of each pair
+    'movingCroppedVolumeNode', 'preAlignmentMoving2FixedLinearTransform', 'affineTransformNode', 'bsplineTransformNode',
+    'pairTransformNodes', 'success',
+    # Run state: distance map registration of the labelmaps (own intermediate nodes), volume resampler, displacement
+    # field cache of the deformable result, node registry, scratch scene, and whether intermediate nodes are hidden
+    'distanceMapRegistrationLogic', 'volumeResampler', 'displacementFieldCache', 'nodeRegistry', 'scratchScene',
+    'hideIntermediateNodes',
+    # Reports of the last run (see StageProfiler, NodeRegistry, and SceneEventCounter)
+    'timingReport', 'leakReport', 'sceneEventReport' ]
+
+  def __init__(self, **kwargs):
+    for name in self.__slots__:
+      setattr(self, name, None)
+    self.segmentNamePairs = []
+    self.pairLabelmaps = []
+    self.pairTransformNodes = []
+    self.hideIntermediateNodes = False
+    self.distanceMapRegistrationLogic = DistanceMapRegistrationLogic()
+    self.volumeResampler = VolumeResampler()
+    self.displacementFieldCache = DisplacementFieldCache()
+    for name, value in kwargs.items():
+      setattr(self, name, value)
+
+#------------------------------------------------------------------------------
+def addContextProperties(logicClass, contextClass):
+  """Add the per-case attributes of the context class to the logic class as properties reading and writing the
+  current context (see getCurrentContext). The logic needs to have a defaultContext attribute
+  """
+  def contextProperty(name):
+    return property(lambda logic: getattr(getCurrentContext(logic), name),
+      lambda logic, value: setattr(getCurrentContext(logic), name, value))
+  for name in contextClass.__slots__:
+    setattr(logicClass, name, contextProperty(name))
+
+#------------------------------------------------------------------------------
+# Context of the running stage of each logic. Thread-local, so that setting it never affects code of other threads
+currentContexts = threading.local()
+
+#------------------------------------------------------------------------------
+def getCurrentContext(logic):
+  """Get the context of the stage of the logic running in the calling thread, or the default context of the logic
+  """
+  return getattr(currentContexts, 'logic%d' % id(logic), logic.defaultContext)
+
+#------------------------------------------------------------------------------
+def contextStage(stageMethod):
+  """Decorator of the stage methods of a logic. The stage takes an optional context keyword argument, which is the
+  current context of the logic while the stage runs. If a context is given, then the stage returns it, otherwise the
+  stage returns its own return value on the current context (as before contexts). Stages are re-entrant (a stage may
+  run another stage on a different context), but not thread safe (see RegistrationContext)
+  """
+  @functools.wraps(stageMethod)
+  def stage(logic, *args, **kwargs):
+    context = kwargs.pop('context', None)
+    if context is None:
+      return stageMethod(logic, *args, **kwargs)
+    key = 'logic%d' % id(logic)
+    previousContext = getattr(currentContexts, key, None)
+    setattr(currentContexts, key, context)
+    try:
+      stageMethod(logic, *args, **kwargs)
+    finally:
+      if previousContext is None:
+        delattr(currentContexts, key)
+      else:
+        setattr(currentContexts, key, previousContext)
+    return context
+  return stage
@@ -0,0 +1,77 @@
+import vtk, slicer
+
+#
+# -----------------------------------------------------------------------------
+# SceneEventCounter
+# -----------------------------------------------------------------------------
+#
+
+class SceneEventCounter(object):
+  """Count the MRML events invoked while a pipeline runs, for measuring the effect of batch processing.
+
+  Usage:
+    eventCounter = SceneEventCounter()
+    eventCounter.start()
+    try:
+      runPipeline()
+    finally:
+      eventCounter.stop()
+    eventReport = eventCounter.getReport()
+
+  All events of the scene, of the nodes that are in the scene when counting starts, and of the nodes added
+  while counting are counted by event name. These are the events that observers (views, widgets, subject
+  hierarchy, other modules) react to, so the count is a measure of the user interface work caused by the run.
+  """
+
+  def __init__(self):
+    self.scene = slicer.mrmlScene
+    self.eventCounts = {}
+    # List of (observed object, observer tag) tuples
+    self.observations = []
+    self.nodeAddedObserverTag = None
+
+  #------------------------------------------------------------------------------
+  def start(self):
+    """Start counting events (counts of earlier runs are reset)
+    """
+    self.stop()
+    self.eventCounts = {}
+    self.observations.append((self.scene, self.scene.AddObserver(vtk.vtkCommand.AnyEvent, self.onEvent)))
+    for node in slicer.util.getNodes('*').values():
+      self.observeNode(node)
+    self.nodeAddedObserverTag = self.scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+
+  #------------------------------------------------------------------------------
+  def stop(self):
+    """Stop counting events and remove all observers
+    """
+    for observedObject, observerTag in self.observations:
+      observedObject.RemoveObserver(observerTag)
+    self.observations = []
+    if self.nodeAddedObserverTag is not None:
+      self.scene.RemoveObserver(self.nodeAddedObserverTag)
+      self.nodeAddedObserverTag = None
+
+  #------------------------------------------------------------------------------
+  def observeNode(self, node):
+    self.observations.append((node, node.AddObserver(vtk.vtkCommand.AnyEvent, self.onEvent)))
+
+  #------------------------------------------------------------------------------
+  def onEvent(self, caller, event):
+    self.eventCounts[event] = self.eventCounts.get(event, 0) + 1
+
+  #------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    if node is not None:
+      self.observeNode(node)
+
+  #------------------------------------------------------------------------------
+  def getReport(self):
+    """Get counted events
+    :return: Dictionary with the total number of events ('total') and the number of each event ('events',
+      dictionary of event name to count)
+    """
+    return {
+      'total': sum(self.eventCounts.values()),
+      'events': dict(self.eventCounts) }
@@ -0,0 +1,224 @@
+import math
+import logging
+import numpy as np
+import vtk, slicer
+from vtk.util import numpy_support
+
+#
+# -----------------------------------------------------------------------------
+# SegmentRasterizer
+# -----------------------------------------------------------------------------
+#
+
+class SegmentRasterizer(object):
+  """Rasterize single segments directly on the voxel grid of a reference volume.
+
+  Only the selected segments are processed: the segmentation node is not cloned, its transform is not
+  hardened, and the other segments are not converted. Transforms of the segmentation and the reference
+  volume (linear or not) are applied during rasterization.
+
+  If the master representation of the segment is a binary labelmap, then it is resampled to the
+  reference grid (nearest neighbor). Otherwise the closed surface representation of the segment is
+  rasterized directly on the reference grid, so there is no intermediate labelmap in the default
+  geometry of the segmentation. Rasterization can be restricted to the extent of the segment on the
+  reference grid, in which case each segment is processed in a single pass over its own voxels only.
+  """
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def createLabelmapFromSegments(segments, referenceVolumeNode, labelmapNode, cropToSegmentExtent=True):
+    """Rasterize segments into a labelmap volume node on the voxel grid of the reference volume
+    :param segments: List of (segmentation node, segment name, label value) tuples. Where segments overlap,
+      the label value of the later segment is used
+    :param cropToSegmentExtent: If enabled, then the labelmap only covers the union of the segment extents.
+      Otherwise it has the same extent as the reference volume
+    :return: True on success
+    """
+    segmentLabelmaps = []
+    for segmentationNode, segmentName, labelValue in segments:
+      labelArray, extent = SegmentRasterizer.getSegmentLabelArray(segmentationNode, segmentName, referenceVolumeNode, cropToSegmentExtent)
+      if labelArray is None:
+        return False
+      segmentLabelmaps.append((labelArray, extent, labelValue))
+
+    outputExtent = list(referenceVolumeNode.GetImageData().GetExtent())
+    if cropToSegmentExtent:
+      outputExtent = [min([extent[axis] for _, extent, _ in segmentLabelmaps]) if axis % 2 == 0
+        else max([extent[axis] for _, extent, _ in segmentLabelmaps]) for axis in range(6)]
+
+    # Combine segments into one array (KJI order)
+    outputArray = np.zeros([outputExtent[5]-outputExtent[4]+1, outputExtent[3]-outputExtent[2]+1, outputExtent[1]-outputExtent[0]+1], dtype=np.uint8)
+    for labelArray, extent, labelValue in segmentLabelmaps:
+      segmentRegion = tuple(slice(extent[2*axis]-outputExtent[2*axis], extent[2*axis+1]-outputExtent[2*axis]+1) for axis in [2,1,0])
+      outputArray[segmentRegion][labelArray] = labelValue
+
+    # Labelmap geometry is the reference geometry with the origin moved to the first voxel of the extent
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    origin = ijkToRasMatrix.MultiplyPoint([float(outputExtent[0]), float(outputExtent[2]), float(outputExtent[4]), 1.0])
+    for row in range(3):
+      ijkToRasMatrix.SetElement(row, 3, origin[row])
+    labelmapNode.SetIJKToRASMatrix(ijkToRasMatrix)
+    slicer.util.updateVolumeFromArray(labelmapNode, outputArray)
+    return True
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getSegmentLabelArray(segmentationNode, segmentName, referenceVolumeNode, cropToSegmentExtent=False):
+    """Get binary labelmap of a segment on the voxel grid of the reference volume
+    :param cropToSegmentExtent: If enabled, then only the extent of the segment on the reference grid is rasterized
+    :return: Tuple of boolean NumPy array (KJI) and its extent on the reference grid. (None, None) on failure
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    segment = segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(segmentName))
+    if segment is None:
+      logging.error('Failed to get segment ' + segmentName)
+      return None, None
+    if referenceVolumeNode is None or referenceVolumeNode.GetImageData() is None:
+      logging.error('Invalid reference volume for rasterizing segment ' + segmentName)
+      return None, None
+
+    # Transform from the segmentation coordinate system to the reference volume coordinate system
+    segmentationToReferenceTransform = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(segmentationNode.GetParentTransformNode(),
+      referenceVolumeNode.GetParentTransformNode(), segmentationToReferenceTransform)
+
+    labelmapRepresentationName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+    closedSurfaceRepresentationName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    if segmentation.GetMasterRepresentationName() == labelmapRepresentationName:
+      labelArray, extent = SegmentRasterizer.resampleSegmentLabelmap(segment, segmentationToReferenceTransform, referenceVolumeNode, cropToSegmentExtent)
+    else:
+      closedSurface = segment.GetRepresentation(closedSurfaceRepresentationName)
+      if closedSurface is None:
+        # Segments with other master representations (such as planar contours) need the closed surface for rasterization.
+        # The closed surface is also used for display, so it is typically already available
+        segmentation.CreateRepresentation(closedSurfaceRepresentationName)
+        closedSurface = segment.GetRepresentation(closedSurfaceRepresentationName)
+      if closedSurface is None:
+        logging.error('Failed to get closed surface of segment ' + segmentName)
+        return None, None
+      labelArray, extent = SegmentRasterizer.rasterizeClosedSurface(closedSurface, segmentationToReferenceTransform, referenceVolumeNode, cropToSegmentExtent)
+
+    if extent is None:
+      logging.error('Segment %s is empty or outside the reference volume' % segmentName)
+    return labelArray, extent
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def resampleSegmentLabelmap(segment, segmentationToReferenceTransform, referenceVolumeNode, cropToSegmentExtent):
+    segmentLabelmap = segment.GetRepresentation(slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName())
+    if segmentLabelmap is None:
+      return None, None
+
+    referenceIjkToRasMatrix = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(referenceIjkToRasMatrix)
+    extent = list(referenceVolumeNode.GetImageData().GetExtent())
+    if cropToSegmentExtent:
+      # Map the corners of the effective extent of the segment to the reference grid
+      effectiveExtent = [0]*6
+      slicer.vtkOrientedImageDataResample.CalculateEffectiveExtent(segmentLabelmap, effectiveExtent)
+      if effectiveExtent[0] > effectiveExtent[1] or effectiveExtent[2] > effectiveExtent[3] or effectiveExtent[4] > effectiveExtent[5]:
+        return None, None
+      segmentImageToWorldMatrix = vtk.vtkMatrix4x4()
+      segmentLabelmap.GetImageToWorldMatrix(segmentImageToWorldMatrix)
+      referenceRasToIjkMatrix = vtk.vtkMatrix4x4()
+      referenceVolumeNode.GetRASToIJKMatrix(referenceRasToIjkMatrix)
+      cornerIndices = []
+      for i in [effectiveExtent[0]-0.5, effectiveExtent[1]+0.5]:
+        for j in [effectiveExtent[2]-0.5, effectiveExtent[3]+0.5]:
+          for k in [effectiveExtent[4]-0.5, effectiveExtent[5]+0.5]:
+            segmentationPoint = segmentImageToWorldMatrix.MultiplyPoint([i, j, k, 1.0])[:3]
+            referencePoint = segmentationToReferenceTransform.TransformPoint(segmentationPoint)
+            cornerIndices.append(referenceRasToIjkMatrix.MultiplyPoint(list(referencePoint) + [1.0])[:3])
+      extent = SegmentRasterizer.clipBoundsToExtent(
+        [bound([corner[axis] for corner in cornerIndices]) for axis in range(3) for bound in [min, max]], extent)
+      if extent is None:
+        return None, None
+
+    # Reference geometry without voxel data (only the geometry is used by the resampling)
+    referenceGeometry = slicer.vtkOrientedImageData()
+    referenceGeometry.SetImageToWorldMatrix(referenceIjkToRasMatrix)
+    referenceGeometry.SetExtent(extent)
+
+    resampledLabelmap = slicer.vtkOrientedImageData()
+    if not slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
+        segmentLabelmap, referenceGeometry, resampledLabelmap, False, False, segmentationToReferenceTransform):
+      logging.error('Failed to resample binary labelmap of segment ' + segment.GetName())
+      return None, None
+
+    # Segments may share the labelmap with other segments, in which case they are distinguished by label value
+    dimensions = resampledLabelmap.GetDimensions()
+    labelArray = numpy_support.vtk_to_numpy(resampledLabelmap.GetPointData().GetScalars()).reshape(dimensions[::-1])
+    return labelArray == segment.GetLabelValue(), extent
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def rasterizeClosedSurface(closedSurface, segmentationToReferenceTransform, referenceVolumeNode, cropToSegmentExtent):
+    # Transform surface into the IJK coordinate system of the reference volume, where the voxels are on the integer grid
+    segmentationToReferenceIjkTransform = vtk.vtkGeneralTransform()
+    segmentationToReferenceIjkTransform.PostMultiply()
+    segmentationToReferenceIjkTransform.Concatenate(segmentationToReferenceTransform)
+    referenceRasToIjkMatrix = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetRASToIJKMatrix(referenceRasToIjkMatrix)
+    segmentationToReferenceIjkTransform.Concatenate(referenceRasToIjkMatrix)
+
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputData(closedSurface)
+    transformFilter.SetTransform(segmentationToReferenceIjkTransform)
+    transformFilter.Update()
+
+    extent = list(referenceVolumeNode.GetImageData().GetExtent())
+    if cropToSegmentExtent:
+      if transformFilter.GetOutput().GetNumberOfPoints() == 0:
+        return None, None
+      extent = SegmentRasterizer.clipBoundsToExtent(transformFilter.GetOutput().GetBounds(), extent)
+      if extent is None:
+        return None, None
+
+    polyDataToStencil = vtk.vtkPolyDataToImageStencil()
+    polyDataToStencil.SetInputConnection(transformFilter.GetOutputPort())
+    polyDataToStencil.SetOutputOrigin(0, 0, 0)
+    polyDataToStencil.SetOutputSpacing(1, 1, 1)
+    polyDataToStencil.SetOutputWholeExtent(extent)
+
+    stencilToImage = vtk.vtkImageStencilToImage()
+    stencilToImage.SetInputConnection(polyDataToStencil.GetOutputPort())
+    stencilToImage.SetInsideValue(1)
+    stencilToImage.SetOutsideValue(0)
+    stencilToImage.SetOutputScalarTypeToUnsignedChar()
+    stencilToImage.Update()
+
+    labelImage = stencilToImage.GetOutput()
+    dimensions = labelImage.GetDimensions()
+    return numpy_support.vtk_to_numpy(labelImage.GetPointData().GetScalars()).reshape(dimensions[::-1]) > 0, extent
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def createReferenceGeometryNode(volumeNode, transformMatrix):
+    """Create volume node (not added to the scene) with the geometry of a volume mapped by a linear transform, but
+    without voxels. It can be used as reference volume for rasterizing segments in the transformed frame of the
+    volume, without transforming the volume itself.
+    """
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    vtk.vtkMatrix4x4.Multiply4x4(transformMatrix, ijkToRasMatrix, ijkToRasMatrix)
+    geometryImageData = vtk.vtkImageData()
+    geometryImageData.SetExtent(volumeNode.GetImageData().GetExtent())
+    geometryNode = slicer.vtkMRMLScalarVolumeNode()
+    geometryNode.SetIJKToRASMatrix(ijkToRasMatrix)
+    geometryNode.SetAndObserveImageData(geometryImageData)
+    return geometryNode
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def clipBoundsToExtent(bounds, extent):
+    """Get the extent of voxels covering the bounds (given in IJK coordinates), clipped to the given extent
+    :return: Clipped extent, None if empty
+    """
+    clippedExtent = []
+    for axis in range(3):
+      clippedExtent.append(max(extent[2*axis], int(math.floor(bounds[2*axis]))))
+      clippedExtent.append(min(extent[2*axis+1], int(math.ceil(bounds[2*axis+1]))))
+      if clippedExtent[2*axis] > clippedExtent[2*axis+1]:
+        return None
+    return clippedExtent
@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import vtk, slicer
+from vtk.util import numpy_support
+
+#
+# -----------------------------------------------------------------------------
+# StageCache
+# -----------------------------------------------------------------------------
+#
+
+class StageCache(object):
+  """Content-addressed disk cache for the outputs of the preprocessing stages of the registration.
+
+  The cache key is a hash of the stage name, the voxels and geometry of the input volumes, the master
+  representation of the input segments, the transforms of the inputs to world, and the stage parameters.
+  Outputs are stored as NumPy archives in the cache directory. If the total size of the cache exceeds the
+  maximum size, then the least recently used entries are removed.
+  """
+
+  def __init__(self, cacheDirectory=None, maximumSizeBytes=2*1024*1024*1024):
+    if cacheDirectory is None:
+      cacheDirectory = os.path.join(slicer.app.temporaryPath, 'SegmentRegistrationStageCache')
+    self.cacheDirectory = cacheDirectory
+    self.maximumSizeBytes = maximumSizeBytes
+    if not os.access(self.cacheDirectory, os.F_OK):
+      os.makedirs(self.cacheDirectory, exist_ok=True)
+
+  #------------------------------------------------------------------------------
+  def computeKey(self, stageName, volumeNodes=None, segments=None, parameters=None):
+    """Compute cache key for a stage.
+    :param volumeNodes: Input volume nodes. Voxels, geometry, and transform to world are hashed
+    :param segments: Input segments as (segmentation node, segment name) tuples
+    :param parameters: Dictionary of stage parameters (must be JSON serializable)
+    :return: Key string, or None if any of the inputs cannot be hashed (in which case the stage is not cached)
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(stageName.encode())
+    for volumeNode in volumeNodes or []:
+      if not self.hashVolumeNode(hasher, volumeNode):
+        return None
+    for segmentationNode, segmentName in segments or []:
+      if not self.hashSegment(hasher, segmentationNode, segmentName):
+        return None
+    hasher.update(json.dumps(parameters or {}, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+  #------------------------------------------------------------------------------
+  def get(self, key):
+    """Get cached stage outputs
+    :return: Dictionary of NumPy arrays, None if not found
+    """
+    if key is None:
+      return None
+    filePath = self.getFilePath(key)
+    if not os.path.exists(filePath):
+      return None
+    try:
+      with np.load(filePath) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+    except Exception as e:
+      logging.warning('Failed to read stage cache entry %s: %s' % (filePath, str(e)))
+      return None
+    # Mark entry as recently used
+    try:
+      os.utime(filePath, None)
+    except OSError:
+      pass
+    logging.info('Stage cache hit: ' + key)
+    return arrays
+
+  #------------------------------------------------------------------------------
+  def put(self, key, arrays):
+    """Store stage outputs (dictionary of NumPy arrays) in the cache
+    """
+    if key is None:
+      return
+    filePath = self.getFilePath(key)
+    temporaryFilePath = '%s.%d.tmp.npz' % (filePath, os.getpid())
+    np.savez(temporaryFilePath, **arrays)
+    os.replace(temporaryFilePath, filePath)
+    self.evict()
+
+  #------------------------------------------------------------------------------
+  def evict(self):
+    """Remove least recently used entries until the cache fits in the maximum size
+    """
+    # The cache directory may be shared by multiple processes, so entries may disappear at any time
+    entries = []
+    for fileName in os.listdir(self.cacheDirectory):
+      if not fileName.endswith('.npz') or fileName.endswith('.tmp.npz'):
+        continue
+      try:
+        fileStat = os.stat(os.path.join(self.cacheDirectory, fileName))
+      except OSError:
+        continue
+      entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+    totalSize = sum([entry[1] for entry in entries])
+    for modifiedTime, size, fileName in sorted(entries):
+      if totalSize <= self.maximumSizeBytes:
+        break
+      try:
+        os.remove(os.path.join(self.cacheDirectory, fileName))
+      except OSError:
+        pass
+      totalSize -= size
+
+  #------------------------------------------------------------------------------
+  def clear(self):
+    for fileName in os.listdir(self.cacheDirectory):
+      if fileName.endswith('.npz'):
+        os.remove(os.path.join(self.cacheDirectory, fileName))
+
+  #------------------------------------------------------------------------------
+  def getFilePath(self, key):
+    return os.path.join(self.cacheDirectory, key + '.npz')
+
+  #------------------------------------------------------------------------------
+  # Hashing
+  #------------------------------------------------------------------------------
+  def hashVolumeNode(self, hasher, volumeNode):
+    if volumeNode is None or volumeNode.GetImageData() is None:
+      return False
+    hasher.update(volumeNode.GetClassName().encode())
+    hasher.update(self.getVolumeIjkToRasArray(volumeNode).tobytes())
+    imageData = volumeNode.GetImageData()
+    hasher.update(np.array(imageData.GetExtent()).tobytes())
+    hasher.update(numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).tobytes())
+    return self.hashTransformToWorld(hasher, volumeNode)
+
+  #------------------------------------------------------------------------------
+  def hashSegment(self, hasher, segmentationNode, segmentName):
+    if segmentationNode is None:
+      return False
+    segmentation = segmentationNode.GetSegmentation()
+    segment = segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(segmentName))
+    if segment is None:
+      return False
+    masterRepresentationName = segmentation.GetMasterRepresentationName()
+    masterRepresentation = segment.GetRepresentation(masterRepresentationName)
+    if masterRepresentation is None:
+      return False
+    hasher.update(masterRepresentationName.encode())
+    if masterRepresentation.IsA('vtkOrientedImageData'):
+      imageToWorldMatrix = vtk.vtkMatrix4x4()
+      masterRepresentation.GetImageToWorldMatrix(imageToWorldMatrix)
+      hasher.update(slicer.util.arrayFromVTKMatrix(imageToWorldMatrix).tobytes())
+      hasher.update(np.array(masterRepresentation.GetExtent()).tobytes())
+      scalars = masterRepresentation.GetPointData().GetScalars()
+      if scalars is not None:
+        hasher.update(numpy_support.vtk_to_numpy(scalars).tobytes())
+    elif masterRepresentation.IsA('vtkPolyData'):
+      if masterRepresentation.GetPoints() is not None:
+        hasher.update(numpy_support.vtk_to_numpy(masterRepresentation.GetPoints().GetData()).tobytes())
+      for cells in [masterRepresentation.GetVerts(), masterRepresentation.GetLines(), masterRepresentation.GetPolys(), masterRepresentation.GetStrips()]:
+        if cells is not None and cells.GetNumberOfCells() > 0:
+          hasher.update(numpy_support.vtk_to_numpy(cells.GetData()).tobytes())
+    else:
+      return False
+    return self.hashTransformToWorld(hasher, segmentationNode)
+
+  #------------------------------------------------------------------------------
+  def hashTransformToWorld(self, hasher, node):
+    parentTransformNode = node.GetParentTransformNode()
+    if parentTransformNode is None:
+      hasher.update(b'identity')
+      return True
+    if not parentTransformNode.IsTransformToWorldLinear():
+      # Non-linear transforms cannot be hashed cheaply, so results depending on them are not cached
+      return False
+    transformToWorldMatrix = vtk.vtkMatrix4x4()
+    parentTransformNode.GetMatrixTransformToWorld(transformToWorldMatrix)
+    hasher.update(slicer.util.arrayFromVTKMatrix(transformToWorldMatrix).tobytes())
+    return True
+
+  #------------------------------------------------------------------------------
+  # Conversion between volume nodes and cached arrays
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getVolumeIjkToRasArray(volumeNode):
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    return slicer.util.arrayFromVTKMatrix(ijkToRasMatrix)
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def arraysFromVolumeNode(volumeNode, prefix=''):
+    """Get voxels and geometry of a volume node as arrays that can be stored in the cache
+    """
+    return {
+      prefix + 'voxels': np.array(slicer.util.arrayFromVolume(volumeNode)),
+      prefix + 'ijkToRas': StageCache.getVolumeIjkToRasArray(volumeNode) }
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def updateVolumeNodeFromArrays(volumeNode, arrays, prefix=''):
+    """Set voxels and geometry of a volume node from arrays retrieved from the cache
+    """
+    volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(arrays[prefix + 'ijkToRas']))
+    slicer.util.updateVolumeFromArray(volumeNode, arrays[prefix + 'voxels'])
@@ -0,0 +1,245 @@
+import sys
+import json
+import time
+import logging
+
+# Peak memory of the process is read from the resource module on Linux and macOS, and from psutil (if available)
+# on Windows. If neither is available, then memory is not reported.
+try:
+  import resource
+except ImportError:
+  resource = None
+
+#
+# -----------------------------------------------------------------------------
+# StageProfiler
+# -----------------------------------------------------------------------------
+#
+
+class StageProfiler(object):
+  """Record wall time, CPU time, peak memory, and input/output voxel counts of the stages of a pipeline.
+
+  Usage:
+    profiler = StageProfiler('SegmentRegistration')
+    with profiler.measureStage('CropMovingVolume', [movingVolumeNode]) as stage:
+      croppedVolumeNode = crop(movingVolumeNode)
+      stage.setSuccess(croppedVolumeNode is not None)
+      stage.setOutputNodes([croppedVolumeNode])
+    report = profiler.getReport()
+
+  A stage is reported as failed if it raised an exception or if setSuccess(False) was called (for stages that
+  log errors and return instead of raising). Stages that do not end in the calling scope (such as stages of an
+  AsyncPipeline) are measured by calling start and stop of the measurement instead of using it as context manager.
+
+  The report is a JSON serializable dictionary, see getReport. Reports of multiple cases can be combined
+  with aggregateTimingReports.
+
+  Peak memory is the high water mark of the resident memory of the process, so the increase of the peak
+  during a stage is only non-zero for the stage that exceeded all earlier stages. CPU time of CLI modules
+  running as separate executables is reported as child CPU time.
+  """
+
+  def __init__(self, pipelineName, caseId=None):
+    self.pipelineName = pipelineName
+    self.caseId = caseId
+    self.stages = []
+    self.startTime = time.time()
+
+  #------------------------------------------------------------------------------
+  def measureStage(self, stageName, inputNodes=None):
+    """Create context manager measuring one stage.
+    :param inputNodes: Nodes whose voxels are counted as stage input (None entries are ignored)
+    """
+    return StageMeasurement(self, stageName, inputNodes or [])
+
+  #------------------------------------------------------------------------------
+  def getReport(self):
+    """Get report of all measured stages
+    :return: Dictionary with pipeline name, case ID, stage records, and totals
+    """
+    return {
+      'pipeline': self.pipelineName,
+      'caseId': self.caseId,
+      'startTime': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.startTime)),
+      'totalWallTimeSec': sum([stage['wallTimeSec'] for stage in self.stages]),
+      'totalCpuTimeSec': sum([stage['cpuTimeSec'] for stage in self.stages]),
+      'totalChildCpuTimeSec': sum([stage['childCpuTimeSec'] or 0.0 for stage in self.stages]),
+      'peakMemoryBytes': max([stage['peakMemoryBytes'] or 0 for stage in self.stages] + [0]) or None,
+      'stages': list(self.stages) }
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def writeReport(report, filePath):
+    with open(filePath, 'w') as reportFile:
+      json.dump(report, reportFile, indent=2)
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def readReport(filePath):
+    with open(filePath) as reportFile:
+      return json.load(reportFile)
+
+#
+# -----------------------------------------------------------------------------
+# StageMeasurement
+# -----------------------------------------------------------------------------
+#
+
+class StageMeasurement(object):
+  """Context manager measuring one stage of a StageProfiler. The stage record is added to the profiler
+  when the context is exited, even if the stage raised an exception.
+  """
+
+  def __init__(self, profiler, stageName, inputNodes):
+    self.profiler = profiler
+    self.success = True
+    self.record = {
+      'name': stageName,
+      'success': False,
+      'inputVoxels': getVoxelCounts(inputNodes),
+      'outputVoxels': {} }
+
+  #------------------------------------------------------------------------------
+  def setOutputNodes(self, outputNodes):
+    self.record['outputVoxels'] = getVoxelCounts(outputNodes)
+
+  #------------------------------------------------------------------------------
+  def setSuccess(self, success):
+    """Set outcome of the stage. Stages are successful unless set otherwise or an exception is raised
+    """
+    self.success = bool(success)
+
+  #------------------------------------------------------------------------------
+  def start(self):
+    self.startPeakMemory = getPeakMemoryBytes()
+    self.startChildCpuTime = getChildCpuTime()
+    self.startCpuTime = time.process_time()
+    self.startWallTime = time.perf_counter()
+
+  #------------------------------------------------------------------------------
+  def stop(self, success=True):
+    """Finish measuring and add the stage record to the profiler
+    :param success: Outcome of the stage, combined with the outcome set by setSuccess
+    """
+    self.record['wallTimeSec'] = time.perf_counter() - self.startWallTime
+    self.record['cpuTimeSec'] = time.process_time() - self.startCpuTime
+    childCpuTime = getChildCpuTime()
+    self.record['childCpuTimeSec'] = childCpuTime - self.startChildCpuTime if childCpuTime is not None else None
+    peakMemory = getPeakMemoryBytes()
+    self.record['peakMemoryBytes'] = peakMemory
+    self.record['peakMemoryIncreaseBytes'] = peakMemory - self.startPeakMemory if peakMemory is not None else None
+    self.record['success'] = self.success and bool(success)
+    self.profiler.stages.append(self.record)
+    logging.info('Stage %s: %.2fs wall time, %.2fs CPU time%s' % (self.record['name'], self.record['wallTimeSec'],
+      self.record['cpuTimeSec'], '' if self.record['success'] else ' (failed)'))
+
+  #------------------------------------------------------------------------------
+  def __enter__(self):
+    self.start()
+    return self
+
+  #------------------------------------------------------------------------------
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self.stop(exceptionType is None)
+    # Do not suppress exceptions
+    return False
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------
+def getPeakMemoryBytes():
+  """Get peak resident memory of the process in bytes, None if not available
+  """
+  if resource is not None:
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peakMemory if sys.platform == 'darwin' else peakMemory * 1024
+  try:
+    import psutil
+    memoryInfo = psutil.Process().memory_info()
+    return getattr(memoryInfo, 'peak_wset', memoryInfo.rss)
+  except ImportError:
+    return None
+
+#------------------------------------------------------------------------------
+def getChildCpuTime():
+  """Get CPU time used by terminated child processes (such as CLI executables), None if not available
+  """
+  if resource is None:
+    return None
+  childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return childUsage.ru_utime + childUsage.ru_stime
+
+#------------------------------------------------------------------------------
+def getNumberOfVoxels(node):
+  """Get number of voxels in a volume node or in the binary labelmap representation of a segmentation node
+  :return: Number of voxels, None if the node contains no voxel data
+  """
+  if node is None:
+    return None
+  if node.IsA('vtkMRMLVolumeNode'):
+    imageData = node.GetImageData()
+    return imageData.GetNumberOfPoints() if imageData is not None else None
+  if node.IsA('vtkMRMLSegmentationNode'):
+    segmentation = node.GetSegmentation()
+    numberOfVoxels = None
+    for segmentIndex in range(segmentation.GetNumberOfSegments()):
+      labelmap = segmentation.GetNthSegment(segmentIndex).GetRepresentation('Binary labelmap')
+      if labelmap is not None:
+        numberOfVoxels = (numberOfVoxels or 0) + labelmap.GetNumberOfPoints()
+    return numberOfVoxels
+  return None
+
+#------------------------------------------------------------------------------
+def getVoxelCounts(nodes):
+  """Get number of voxels per node name (nodes without voxel data are omitted)
+  """
+  voxelCounts = {}
+  for node in nodes or []:
+    numberOfVoxels = getNumberOfVoxels(node)
+    if numberOfVoxels is not None:
+      voxelCounts[node.GetName()] = numberOfVoxels
+  return voxelCounts
+
+#------------------------------------------------------------------------------
+def aggregateTimingReports(reports):
+  """Combine timing reports of multiple cases into per-stage statistics
+  :return: Dictionary containing the number of cases and, for each stage (in order of first appearance),
+    the number of cases, number of failures, and mean/min/max of the times, memory, and voxel counts
+  """
+  stageNames = []
+  stageRecords = {}
+  for report in reports:
+    for stage in report['stages']:
+      if stage['name'] not in stageRecords:
+        stageNames.append(stage['name'])
+        stageRecords[stage['name']] = []
+      stageRecords[stage['name']].append(stage)
+
+  def statistics(values):
+    values = [value for value in values if value is not None]
+    if not values:
+      return None
+    return {'mean': float(sum(values)) / len(values), 'min': min(values), 'max': max(values)}
+
+  stages = []
+  for stageName in stageNames:
+    records = stageRecords[stageName]
+    stages.append({
+      'name': stageName,
+      'numberOfCases': len(records),
+      'numberOfFailures': len([record for record in records if not record['success']]),
+      'wallTimeSec': statistics([record['wallTimeSec'] for record in records]),
+      'cpuTimeSec': statistics([record['cpuTimeSec'] for record in records]),
+      'childCpuTimeSec': statistics([record['childCpuTimeSec'] for record in records]),
+      'peakMemoryIncreaseBytes': statistics([record['peakMemoryIncreaseBytes'] for record in records]),
+      'inputVoxels': statistics([sum(record['inputVoxels'].values()) for record in records]),
+      'outputVoxels': statistics([sum(record['outputVoxels'].values()) for record in records]) })
+
+  return {
+    'numberOfCases': len(reports),
+    'totalWallTimeSec': statistics([report['totalWallTimeSec'] for report in reports]),
+    'peakMemoryBytes': statistics([report['peakMemoryBytes'] for report in reports]),
+    'stages': stages }
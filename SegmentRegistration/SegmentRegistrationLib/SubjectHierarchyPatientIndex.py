@@ -0,0 +1,194 @@
+import bisect
+import vtk, slicer
+
+#
+# -----------------------------------------------------------------------------
+# SubjectHierarchyPatientIndex
+# -----------------------------------------------------------------------------
+#
+
+class SubjectHierarchyPatientIndex(object):
+  """Index of the volume and segmentation nodes of each patient in subject hierarchy, by modality.
+
+  The index maps patient item -> (node type, modality) -> data node items of the patient branch, where the modality
+  of volumes is the DICOM series modality attribute of their item (segmentations are indexed without modality).
+  It is built once by walking subject hierarchy, then kept up to date from the item added, modified, reparented,
+  and about to be removed events, so looking up the nodes of a patient does not involve walking its branch.
+  The index is rebuilt on next use after a scene is closed or imported, as these change many items at once.
+
+  If a patient contains multiple matching nodes, then the one with the highest item ID (the last one added)
+  is returned, which is the last one in the branch of a loaded DICOM patient.
+  """
+
+  def __init__(self):
+    self.shNode = None
+    # List of (observed object, observer tag) tuples
+    self.observations = []
+    # Sorted list of the patient items
+    self.patientItemIDs = []
+    # Dictionary of patient item to dictionary of (node type, modality) key to sorted list of data node items
+    self.patientDataItemIDs = {}
+    # Dictionary of indexed data node item to (patient item, key) tuple
+    self.indexedDataItems = {}
+    self.upToDate = False
+
+  #------------------------------------------------------------------------------
+  def start(self):
+    """Start observing the subject hierarchy of the scene. Does nothing if already observing it
+    """
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    if shNode is self.shNode:
+      return
+    self.stop()
+    self.shNode = shNode
+    for event, callback in [
+        (slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyItemAddedEvent, self.onBranchChanged),
+        (slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyItemReparentedEvent, self.onBranchChanged),
+        (slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyItemModifiedEvent, self.onItemModified),
+        (slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyItemAboutToBeRemovedEvent, self.onItemAboutToBeRemoved),
+        (slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyEndResolveEvent, self.onInvalidated) ]:
+      self.observations.append((shNode, shNode.AddObserver(event, callback)))
+    for event in [slicer.vtkMRMLScene.EndCloseEvent, slicer.vtkMRMLScene.EndImportEvent]:
+      self.observations.append((slicer.mrmlScene, slicer.mrmlScene.AddObserver(event, self.onInvalidated)))
+    self.upToDate = False
+
+  #------------------------------------------------------------------------------
+  def stop(self):
+    """Stop observing subject hierarchy. The index is rebuilt on next use
+    """
+    for observedObject, observerTag in self.observations:
+      observedObject.RemoveObserver(observerTag)
+    self.observations = []
+    self.shNode = None
+    self.upToDate = False
+
+  #------------------------------------------------------------------------------
+  def update(self):
+    """Make sure the index is built and observes the current subject hierarchy
+    """
+    self.start()
+    if self.upToDate:
+      return
+    self.patientItemIDs = []
+    self.patientDataItemIDs = {}
+    self.indexedDataItems = {}
+    itemIDs = vtk.vtkIdList()
+    self.shNode.GetItemChildren(self.shNode.GetSceneItemID(), itemIDs, True)
+    for index in range(itemIDs.GetNumberOfIds()):
+      self.indexItem(itemIDs.GetId(index))
+    self.upToDate = True
+
+  #------------------------------------------------------------------------------
+  def getPatientItemIDs(self):
+    """Get patient items in the order they were added
+    """
+    self.update()
+    return list(self.patientItemIDs)
+
+  #------------------------------------------------------------------------------
+  def getVolumeNode(self, patientItemID, modality):
+    """Get scalar volume node of the given DICOM modality (such as 'US' or 'MR') in the branch of a patient
+    :return: Volume node, None if the patient has no such volume
+    """
+    return self.getDataNode(patientItemID, ('volume', modality))
+
+  #------------------------------------------------------------------------------
+  def getSegmentationNode(self, patientItemID):
+    """Get segmentation node in the branch of a patient
+    :return: Segmentation node, None if the patient has no segmentation
+    """
+    return self.getDataNode(patientItemID, ('segmentation', None))
+
+  #------------------------------------------------------------------------------
+  def getDataNode(self, patientItemID, key):
+    self.update()
+    dataItemIDs = self.patientDataItemIDs.get(patientItemID, {}).get(key)
+    if not dataItemIDs:
+      return None
+    return self.shNode.GetItemDataNode(dataItemIDs[-1])
+
+  #------------------------------------------------------------------------------
+  def indexItem(self, itemID):
+    """Add item to the index (or update its entry)
+    """
+    self.removeItem(itemID)
+    if self.shNode.GetItemLevel(itemID) == slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMLevelPatient():
+      bisect.insort(self.patientItemIDs, itemID)
+
+    dataNode = self.shNode.GetItemDataNode(itemID)
+    if dataNode is None:
+      return
+    if dataNode.IsA('vtkMRMLSegmentationNode'):
+      key = ('segmentation', None)
+    elif dataNode.IsA('vtkMRMLScalarVolumeNode'):
+      key = ('volume', self.shNode.GetItemAttribute(itemID, slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMSeriesModalityAttributeName()))
+    else:
+      return
+    patientItemID = self.getPatientItemID(itemID)
+    if not patientItemID:
+      return
+    bisect.insort(self.patientDataItemIDs.setdefault(patientItemID, {}).setdefault(key, []), itemID)
+    self.indexedDataItems[itemID] = (patientItemID, key)
+
+  #------------------------------------------------------------------------------
+  def removeItem(self, itemID):
+    """Remove item from the index
+    """
+    if itemID in self.indexedDataItems:
+      patientItemID, key = self.indexedDataItems.pop(itemID)
+      self.patientDataItemIDs[patientItemID][key].remove(itemID)
+    if itemID in self.patientItemIDs:
+      self.patientItemIDs.remove(itemID)
+
+  #------------------------------------------------------------------------------
+  def getPatientItemID(self, itemID):
+    """Get the patient item that contains the given item (itself if it is a patient)
+    :return: Patient item ID, invalid item ID if the item is not in a patient branch
+    """
+    patientLevel = slicer.vtkMRMLSubjectHierarchyConstants.GetDICOMLevelPatient()
+    sceneItemID = self.shNode.GetSceneItemID()
+    while itemID and itemID != sceneItemID:
+      if self.shNode.GetItemLevel(itemID) == patientLevel:
+        return itemID
+      itemID = self.shNode.GetItemParent(itemID)
+    return slicer.vtkMRMLSubjectHierarchyNode.GetInvalidItemID()
+
+  #------------------------------------------------------------------------------
+  def getBranchItemIDs(self, itemID):
+    """Get the item and all the items in its branch
+    """
+    childItemIDs = vtk.vtkIdList()
+    self.shNode.GetItemChildren(itemID, childItemIDs, True)
+    return [itemID] + [childItemIDs.GetId(index) for index in range(childItemIDs.GetNumberOfIds())]
+
+  #------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_LONG)
+  def onBranchChanged(self, caller, event, itemID):
+    # The patient of all items in the branch may have changed
+    if self.upToDate:
+      for branchItemID in self.getBranchItemIDs(itemID):
+        self.indexItem(branchItemID)
+
+  #------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_LONG)
+  def onItemModified(self, caller, event, itemID):
+    # Level, modality attribute, or data node of the item may have changed. If the item became a patient
+    # (or stopped being one), then the patient of the items in its branch changed too
+    if not self.upToDate:
+      return
+    wasPatient = itemID in self.patientItemIDs
+    self.indexItem(itemID)
+    if (itemID in self.patientItemIDs) != wasPatient:
+      for branchItemID in self.getBranchItemIDs(itemID)[1:]:
+        self.indexItem(branchItemID)
+
+  #------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_LONG)
+  def onItemAboutToBeRemoved(self, caller, event, itemID):
+    if self.upToDate:
+      for branchItemID in self.getBranchItemIDs(itemID):
+        self.removeItem(branchItemID)
+
+  #------------------------------------------------------------------------------
+  def onInvalidated(self, caller, event):
+    self.upToDate = False
@@ -0,0 +1,143 @@
+import logging
+import numpy as np
+import vtk, slicer
+from vtk.util import numpy_support
+
+# SciPy (if available) provides vectorized KD-tree queries of all points at once. Otherwise the VTK KD-tree
+# point locator is queried point by point, which gives the same result more slowly.
+try:
+  from scipy.spatial import cKDTree
+except ImportError:
+  cKDTree = None
+
+#
+# -----------------------------------------------------------------------------
+# SurfaceDistanceMetrics
+# -----------------------------------------------------------------------------
+#
+
+class SurfaceDistanceMetrics(object):
+  """Surface distance metrics (maximum (Hausdorff), 95th percentile Hausdorff, and mean distance) of segment pairs.
+
+  The closed surface representations of the two segments are transformed to world coordinates and subdivided
+  so that no edge is longer than maximumEdgeLengthMm. The vertices of each surface are then used as samples,
+  and their distances to the nearest sample of the other surface are found with a KD-tree, in both directions.
+  The distances therefore approximate the point to surface distances with an error below half the edge length.
+
+  Metrics are symmetric: the maximum is the larger of the two directed maxima, HD95 is the larger of the two
+  directed 95th percentiles, and the mean is computed over the distances of both directions.
+  """
+
+  # Metric columns of the results table (see OverlapMetrics.writeMetricsTable), with the keys of the metric dictionaries
+  metricColumns = [
+    ('Maximum Hausdorff distance (mm)', 'maximumDistanceMm'),
+    ('95% Hausdorff distance (mm)', 'hausdorff95DistanceMm'),
+    ('Mean surface distance (mm)', 'meanDistanceMm') ]
+
+  # Maximum edge length of the surfaces used for sampling
+  maximumEdgeLengthMm = 1.0
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeSurfaceDistanceMetrics(referenceSegmentationNode, compareSegmentationNode, segmentNamePairs):
+    """Compute surface distance metrics of segment pairs
+    :param segmentNamePairs: List of (reference segment name, compare segment name) tuples
+    :return: List of metric dictionaries (one per pair, see metricColumns for the keys), None on failure
+    """
+    if referenceSegmentationNode is None or compareSegmentationNode is None:
+      logging.error('Invalid inputs for computing surface distance metrics')
+      return None
+
+    # Surface samples and KD-trees are computed once per segment even if it is part of multiple pairs
+    surfaceSamples = {}
+    def getSurfaceSamples(segmentationNode, segmentName):
+      key = (segmentationNode.GetID(), segmentName)
+      if key not in surfaceSamples:
+        points = SurfaceDistanceMetrics.getSurfacePoints(segmentationNode, segmentName)
+        surfaceSamples[key] = (points, SurfaceDistanceMetrics.buildKdTree(points)) if points is not None else None
+      return surfaceSamples[key]
+
+    metrics = []
+    for referenceSegmentName, compareSegmentName in segmentNamePairs:
+      referenceSamples = getSurfaceSamples(referenceSegmentationNode, referenceSegmentName)
+      compareSamples = getSurfaceSamples(compareSegmentationNode, compareSegmentName)
+      if referenceSamples is None or compareSamples is None:
+        return None
+      referenceToCompareDistances = SurfaceDistanceMetrics.queryDistances(compareSamples[1], referenceSamples[0])
+      compareToReferenceDistances = SurfaceDistanceMetrics.queryDistances(referenceSamples[1], compareSamples[0])
+      pairMetrics = SurfaceDistanceMetrics.computeDistanceStatistics(referenceToCompareDistances, compareToReferenceDistances)
+      pairMetrics['referenceSegmentName'] = referenceSegmentName
+      pairMetrics['compareSegmentName'] = compareSegmentName
+      metrics.append(pairMetrics)
+    return metrics
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeDistanceStatistics(referenceToCompareDistances, compareToReferenceDistances):
+    """Compute symmetric metrics from the directed distances
+    :return: Metric dictionary
+    """
+    return {
+      'maximumDistanceMm': float(max(referenceToCompareDistances.max(), compareToReferenceDistances.max())),
+      'hausdorff95DistanceMm': float(max(np.percentile(referenceToCompareDistances, 95), np.percentile(compareToReferenceDistances, 95))),
+      'meanDistanceMm': float(np.concatenate([referenceToCompareDistances, compareToReferenceDistances]).mean()) }
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def getSurfacePoints(segmentationNode, segmentName):
+    """Get sample points of the closed surface of a segment in world coordinates
+    :return: Nx3 array, None on failure
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    segment = segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(segmentName))
+    if segment is None:
+      logging.error('Failed to get segment %s in %s' % (segmentName, segmentationNode.GetName()))
+      return None
+    closedSurfaceRepresentationName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    if segment.GetRepresentation(closedSurfaceRepresentationName) is None:
+      segmentation.CreateRepresentation(closedSurfaceRepresentationName)
+    closedSurface = segment.GetRepresentation(closedSurfaceRepresentationName)
+    if closedSurface is None or closedSurface.GetNumberOfPoints() == 0:
+      logging.error('Failed to get closed surface of segment ' + segmentName)
+      return None
+
+    segmentationToWorldTransform = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(segmentationNode.GetParentTransformNode(), None, segmentationToWorldTransform)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputData(closedSurface)
+    transformFilter.SetTransform(segmentationToWorldTransform)
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputConnection(transformFilter.GetOutputPort())
+    subdivisionFilter = vtk.vtkAdaptiveSubdivisionFilter()
+    subdivisionFilter.SetInputConnection(triangleFilter.GetOutputPort())
+    subdivisionFilter.SetMaximumEdgeLength(SurfaceDistanceMetrics.maximumEdgeLengthMm)
+    subdivisionFilter.Update()
+    return numpy_support.vtk_to_numpy(subdivisionFilter.GetOutput().GetPoints().GetData()).astype(np.float64)
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def buildKdTree(points):
+    if cKDTree is not None:
+      return cKDTree(points)
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    locator = vtk.vtkKdTreePointLocator()
+    locator.SetDataSet(polyData)
+    locator.BuildLocator()
+    return locator
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def queryDistances(kdTree, points):
+    """Get distance of each point to the nearest point in the KD-tree
+    :return: Array of distances
+    """
+    if cKDTree is not None:
+      distances, _ = kdTree.query(points)
+      return distances
+    closestPoints = kdTree.GetDataSet().GetPoints()
+    closestIndices = [kdTree.FindClosestPoint(point) for point in points]
+    closestPositions = np.array([closestPoints.GetPoint(index) for index in closestIndices])
+    return np.linalg.norm(points - closestPositions, axis=1)
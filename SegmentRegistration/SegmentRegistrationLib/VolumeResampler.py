@@ -0,0 +1,356 @@
+import os
+import math
+import logging
+import concurrent.futures
+import numpy as np
+import vtk, slicer
+from vtk.util import numpy_support
+
+#
+# -----------------------------------------------------------------------------
+# VolumeResampler
+# -----------------------------------------------------------------------------
+#
+
+class VolumeResampler(object):
+  """In-process resampling of scalar volumes to a new spacing, as a replacement of the Resample Scalar
+  Volume CLI module.
+
+  The image data of the volume node is resampled directly with multithreaded vtkImageReslice, so no
+  temporary files or processes are involved. The parent transform of the input volume (linear or not)
+  is applied during resampling, so there is no need to harden it on a clone first. The output geometry
+  is the same as the one the CLI produces from the hardened volume: same origin and axis directions,
+  and the extent scaled according to the new spacing. The output can be restricted to a region of interest,
+  in which case only the voxels within the region are computed.
+
+  Volumes can also be resampled into the geometry of a reference volume slab by slab (see resampleToReferenceGeometry),
+  which bounds the memory used in addition to the input and the output, and allows writing the output directly to disk.
+  Cropping to a region without resampling (see crop) replaces the Crop Volume module where no ROI node is wanted.
+  """
+
+  # NRRD type names of the supported scalar types (for writing slab-wise resampled volumes to disk)
+  nrrdTypeNames = {'int8': 'signed char', 'uint8': 'uchar', 'int16': 'short', 'uint16': 'ushort',
+    'int32': 'int', 'uint32': 'uint', 'float32': 'float', 'float64': 'double'}
+
+  # Supported interpolation types (names as in the Resample Scalar Volume CLI)
+  windowedSincInterpolationTypes = ['lanczos', 'hamming', 'cosine', 'blackman']
+  interpolationTypes = ['nearestNeighbor', 'linear'] + windowedSincInterpolationTypes
+
+  def __init__(self):
+    # Number of threads used by the resampling filter. Default (None) uses the VTK default (all cores)
+    self.numberOfThreads = None
+    # Half width of the windowed sinc kernels in voxels
+    self.windowHalfWidth = 3
+    # Number of output slices resampled at once in slab-wise resampling
+    self.slabThicknessSlices = 8
+    # Number of slabs resampled in parallel in slab-wise resampling. Default (None) is the number of cores
+    self.numberOfSlabWorkers = None
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def isInterpolationTypeSupported(interpolationType):
+    return interpolationType in VolumeResampler.interpolationTypes
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def parseSpacing(spacingString):
+    """Parse spacing given as a CLI parameter string such as '1,1,1'
+    """
+    return [float(component) for component in spacingString.split(',')]
+
+  #------------------------------------------------------------------------------
+  def resample(self, inputVolumeNode, outputVolumeNode, outputSpacing, interpolationType='lanczos', outputBounds=None, waitForCompletion=True):
+    """Resample volume to the given spacing, applying its parent transform.
+    :param outputSpacing: List of three spacing values in mm
+    :param interpolationType: One of interpolationTypes
+    :param outputBounds: If specified, then the output is cropped to these world bounds (see computeStructureRoiBounds)
+    :param waitForCompletion: If disabled, then the voxels are computed on a worker thread, and the output volume is
+      updated when the returned task is applied (see AsyncPipeline.BackgroundTask). The input volume must not be
+      modified until then
+    :return: Success if waiting for completion, the background task otherwise (False on invalid inputs)
+    """
+    from .AsyncPipeline import BackgroundTask
+
+    if inputVolumeNode is None or inputVolumeNode.GetImageData() is None or outputVolumeNode is None:
+      logging.error('Invalid inputs for resampling')
+      return False
+    if not self.isInterpolationTypeSupported(interpolationType):
+      logging.error('Unsupported interpolation type: ' + interpolationType)
+      return False
+
+    outputIjkToRasMatrix, outputDimensions = self.computeOutputGeometry(inputVolumeNode, outputSpacing)
+    if outputBounds is not None:
+      outputDimensions = self.cropOutputGeometry(outputIjkToRasMatrix, outputDimensions, outputBounds)
+      if outputDimensions is None:
+        logging.error('Resampling region does not overlap with volume ' + inputVolumeNode.GetName())
+        return False
+
+    # The filter processes a shallow copy of the input image data, which is not observed by the volume node
+    inputImageData = vtk.vtkImageData()
+    inputImageData.ShallowCopy(inputVolumeNode.GetImageData())
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(inputImageData)
+    reslice.SetResliceTransform(self.createResliceTransform(inputVolumeNode, outputIjkToRasMatrix))
+    reslice.SetInterpolator(self.createInterpolator(interpolationType))
+    reslice.SetOutputOrigin(0, 0, 0)
+    reslice.SetOutputSpacing(1, 1, 1)
+    reslice.SetOutputExtent(0, outputDimensions[0]-1, 0, outputDimensions[1]-1, 0, outputDimensions[2]-1)
+    reslice.SetBackgroundLevel(0)
+    if self.numberOfThreads:
+      reslice.SetNumberOfThreads(self.numberOfThreads)
+
+    def computeOutput():
+      reslice.Update()
+      outputImageData = vtk.vtkImageData()
+      outputImageData.ShallowCopy(reslice.GetOutput())
+      return outputImageData
+
+    def updateOutputVolume(outputImageData):
+      outputVolumeNode.SetIJKToRASMatrix(outputIjkToRasMatrix)
+      outputVolumeNode.SetAndObserveImageData(outputImageData)
+      return True
+
+    task = BackgroundTask(computeOutput, updateOutputVolume)
+    if not waitForCompletion:
+      return task
+    return task.run()
+
+  #------------------------------------------------------------------------------
+  def resampleToReferenceGeometry(self, inputVolumeNode, referenceVolumeNode, outputVolumeNode=None, interpolationType='linear', outputFilePath=None):
+    """Resample volume into the voxel grid of the reference volume, applying the parent transform of the input volume
+    (linear or not). The output is computed in slabs of slabThicknessSlices slices on a thread pool, and each slab is
+    copied into the output buffer, or written into the output file, as soon as it is computed.
+    :param outputVolumeNode: Volume node to store the output in (its image data is allocated once)
+    :param outputFilePath: NRRD file to write the output into instead of an output volume node. The file is written
+      through a memory map, so the output does not need to fit in memory
+    :return: True on success
+    """
+    if inputVolumeNode is None or inputVolumeNode.GetImageData() is None or referenceVolumeNode is None \
+        or referenceVolumeNode.GetImageData() is None or (outputVolumeNode is None) == (outputFilePath is None):
+      logging.error('Invalid inputs for slab-wise resampling')
+      return False
+    if not self.isInterpolationTypeSupported(interpolationType):
+      logging.error('Unsupported interpolation type: ' + interpolationType)
+      return False
+
+    outputIjkToRasMatrix = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(outputIjkToRasMatrix)
+    referenceParentTransformNode = referenceVolumeNode.GetParentTransformNode()
+    if referenceParentTransformNode is not None and referenceParentTransformNode.IsTransformToWorldLinear():
+      referenceToWorldMatrix = vtk.vtkMatrix4x4()
+      referenceParentTransformNode.GetMatrixTransformToWorld(referenceToWorldMatrix)
+      vtk.vtkMatrix4x4.Multiply4x4(referenceToWorldMatrix, outputIjkToRasMatrix, outputIjkToRasMatrix)
+    outputDimensions = referenceVolumeNode.GetImageData().GetDimensions()
+    inputImageData = inputVolumeNode.GetImageData()
+    scalarType = numpy_support.get_numpy_array_type(inputImageData.GetScalarType())
+
+    # Output buffer (KJI), either the scalars of the output image data or a memory map of the output file
+    if outputVolumeNode is not None:
+      outputImageData = vtk.vtkImageData()
+      outputImageData.SetDimensions(outputDimensions)
+      outputImageData.AllocateScalars(inputImageData.GetScalarType(), 1)
+      outputArray = numpy_support.vtk_to_numpy(outputImageData.GetPointData().GetScalars()).reshape(outputDimensions[::-1])
+    else:
+      outputArray = self.createNrrdFileMemoryMap(outputFilePath, outputIjkToRasMatrix, outputDimensions, scalarType)
+      if outputArray is None:
+        return False
+
+    resliceTransform = self.createResliceTransform(inputVolumeNode, outputIjkToRasMatrix)
+    def resampleSlab(firstSlice):
+      lastSlice = min(firstSlice + self.slabThicknessSlices, outputDimensions[2]) - 1
+      reslice = vtk.vtkImageReslice()
+      reslice.SetInputData(inputImageData)
+      reslice.SetResliceTransform(resliceTransform)
+      reslice.SetInterpolator(self.createInterpolator(interpolationType))
+      reslice.SetOutputOrigin(0, 0, 0)
+      reslice.SetOutputSpacing(1, 1, 1)
+      reslice.SetOutputExtent(0, outputDimensions[0]-1, 0, outputDimensions[1]-1, firstSlice, lastSlice)
+      reslice.SetBackgroundLevel(0)
+      # Parallelism is across slabs
+      reslice.SetNumberOfThreads(1)
+      reslice.Update()
+      slabArray = numpy_support.vtk_to_numpy(reslice.GetOutput().GetPointData().GetScalars())
+      outputArray[firstSlice:lastSlice+1] = slabArray.reshape(lastSlice-firstSlice+1, outputDimensions[1], outputDimensions[0])
+
+    numberOfWorkers = self.numberOfSlabWorkers if self.numberOfSlabWorkers else os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+      list(executor.map(resampleSlab, range(0, outputDimensions[2], self.slabThicknessSlices)))
+
+    if outputVolumeNode is not None:
+      outputVolumeNode.SetIJKToRASMatrix(outputIjkToRasMatrix)
+      outputVolumeNode.SetAndObserveImageData(outputImageData)
+    else:
+      outputArray.flush()
+      del outputArray
+    return True
+
+  #------------------------------------------------------------------------------
+  def createNrrdFileMemoryMap(self, filePath, ijkToRasMatrix, dimensions, scalarType):
+    """Write NRRD header of a volume and map the voxel data following the header into memory
+    :return: Writable memory mapped array (KJI), None on failure
+    """
+    typeName = self.nrrdTypeNames.get(np.dtype(scalarType).name)
+    if typeName is None:
+      logging.error('Unsupported scalar type for writing NRRD file: ' + np.dtype(scalarType).name)
+      return None
+    # NRRD files use the LPS coordinate system
+    rasToLps = [-1, -1, 1]
+    directions = ' '.join(['(%.17g,%.17g,%.17g)' % tuple([rasToLps[row] * ijkToRasMatrix.GetElement(row, column) for row in range(3)])
+      for column in range(3)])
+    origin = '(%.17g,%.17g,%.17g)' % tuple([rasToLps[row] * ijkToRasMatrix.GetElement(row, 3) for row in range(3)])
+    header = ('NRRD0004\ntype: %s\ndimension: 3\nspace: left-posterior-superior\nsizes: %d %d %d\n'
+      'space directions: %s\nkinds: domain domain domain\nendian: little\nencoding: raw\nspace origin: %s\n\n') % (
+      typeName, dimensions[0], dimensions[1], dimensions[2], directions, origin)
+    with open(filePath, 'wb') as nrrdFile:
+      nrrdFile.write(header.encode('ascii'))
+    return np.memmap(filePath, dtype=np.dtype(scalarType).newbyteorder('<'), mode='r+', offset=len(header),
+      shape=(dimensions[2], dimensions[1], dimensions[0]))
+
+  #------------------------------------------------------------------------------
+  def crop(self, inputVolumeNode, outputVolumeNode, bounds):
+    """Crop volume to the voxels within the given bounds without resampling, as the voxel based cropping of the
+    Crop Volume module, but without the ROI and the parameter nodes. The parent transform of the input volume is
+    not applied (the bounds are in the coordinate system of the volume)
+    :return: True on success
+    """
+    if inputVolumeNode is None or inputVolumeNode.GetImageData() is None or outputVolumeNode is None:
+      logging.error('Invalid inputs for cropping')
+      return False
+
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    croppedIjkToRasMatrix = vtk.vtkMatrix4x4()
+    croppedIjkToRasMatrix.DeepCopy(ijkToRasMatrix)
+    croppedDimensions = self.cropOutputGeometry(croppedIjkToRasMatrix, inputVolumeNode.GetImageData().GetDimensions(), bounds)
+    if croppedDimensions is None:
+      logging.error('Cropping region does not overlap with volume ' + inputVolumeNode.GetName())
+      return False
+
+    # Index of the first voxel of the region (the origin of the cropped geometry)
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Invert(ijkToRasMatrix, rasToIjkMatrix)
+    croppedOrigin = [croppedIjkToRasMatrix.GetElement(row, 3) for row in range(3)]
+    lower = [int(round(index)) for index in rasToIjkMatrix.MultiplyPoint(croppedOrigin + [1.0])[:3]]
+
+    inputArray = slicer.util.arrayFromVolume(inputVolumeNode)
+    croppedArray = np.array(inputArray[lower[2]:lower[2]+croppedDimensions[2], lower[1]:lower[1]+croppedDimensions[1],
+      lower[0]:lower[0]+croppedDimensions[0]])
+    outputVolumeNode.SetIJKToRASMatrix(croppedIjkToRasMatrix)
+    slicer.util.updateVolumeFromArray(outputVolumeNode, croppedArray)
+    return True
+
+  #------------------------------------------------------------------------------
+  def createResliceTransform(self, inputVolumeNode, outputIjkToRasMatrix):
+    """Create transform mapping output IJK to input IJK: output IJK -> world -> input RAS -> input IJK
+    """
+    resliceTransform = vtk.vtkGeneralTransform()
+    resliceTransform.PostMultiply()
+    resliceTransform.Concatenate(outputIjkToRasMatrix)
+    parentTransformNode = inputVolumeNode.GetParentTransformNode()
+    if parentTransformNode is not None:
+      worldToInputTransform = vtk.vtkGeneralTransform()
+      parentTransformNode.GetTransformFromWorld(worldToInputTransform)
+      resliceTransform.Concatenate(worldToInputTransform)
+    inputRasToIjkMatrix = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetRASToIJKMatrix(inputRasToIjkMatrix)
+    resliceTransform.Concatenate(inputRasToIjkMatrix)
+    return resliceTransform
+
+  #------------------------------------------------------------------------------
+  def computeOutputGeometry(self, inputVolumeNode, outputSpacing):
+    """Compute geometry of the resampled volume in world coordinates
+    :return: Tuple of output IJK to RAS matrix and output dimensions
+    """
+    # Linear parent transforms are included in the geometry (as if the transform was hardened),
+    # while the geometry of volumes under non-linear transforms is kept
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    parentTransformNode = inputVolumeNode.GetParentTransformNode()
+    if parentTransformNode is not None and parentTransformNode.IsTransformToWorldLinear():
+      transformToWorldMatrix = vtk.vtkMatrix4x4()
+      parentTransformNode.GetMatrixTransformToWorld(transformToWorldMatrix)
+      vtk.vtkMatrix4x4.Multiply4x4(transformToWorldMatrix, ijkToRasMatrix, ijkToRasMatrix)
+
+    inputDimensions = inputVolumeNode.GetImageData().GetDimensions()
+    outputDimensions = [0]*3
+    outputIjkToRasMatrix = vtk.vtkMatrix4x4()
+    outputIjkToRasMatrix.DeepCopy(ijkToRasMatrix)
+    for column in range(3):
+      inputSpacing = sum([ijkToRasMatrix.GetElement(row, column)**2 for row in range(3)]) ** 0.5
+      scale = outputSpacing[column] / inputSpacing
+      for row in range(3):
+        outputIjkToRasMatrix.SetElement(row, column, ijkToRasMatrix.GetElement(row, column) * scale)
+      outputDimensions[column] = max(1, int(round(inputDimensions[column] / scale)))
+    return outputIjkToRasMatrix, outputDimensions
+
+  #------------------------------------------------------------------------------
+  def cropOutputGeometry(self, outputIjkToRasMatrix, outputDimensions, outputBounds):
+    """Restrict output geometry to the voxels within the given world bounds. The origin in the IJK to RAS
+    matrix is moved to the first voxel of the region.
+    :return: Output dimensions of the cropped region, None if the region is empty
+    """
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Invert(outputIjkToRasMatrix, rasToIjkMatrix)
+    cornerIndices = [rasToIjkMatrix.MultiplyPoint([x, y, z, 1.0])[:3]
+      for x in outputBounds[0:2] for y in outputBounds[2:4] for z in outputBounds[4:6]]
+    lower = [max(0, int(math.floor(min([corner[axis] for corner in cornerIndices])))) for axis in range(3)]
+    upper = [min(outputDimensions[axis]-1, int(math.ceil(max([corner[axis] for corner in cornerIndices])))) for axis in range(3)]
+    if any([upper[axis] < lower[axis] for axis in range(3)]):
+      return None
+    croppedOrigin = outputIjkToRasMatrix.MultiplyPoint([float(lower[0]), float(lower[1]), float(lower[2]), 1.0])
+    for row in range(3):
+      outputIjkToRasMatrix.SetElement(row, 3, croppedOrigin[row])
+    return [upper[axis] - lower[axis] + 1 for axis in range(3)]
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def computeStructureRoiBounds(structureBounds):
+    """Compute region of interest around a structure as used for cropping in the registration workflows:
+    three times the structure width along the RL axis, square slice, and twice the height along the IS axis.
+    :param structureBounds: Bounds of the structure in RAS
+    :return: ROI bounds
+    """
+    center = [(structureBounds[0]+structureBounds[1])/2, (structureBounds[2]+structureBounds[3])/2, (structureBounds[4]+structureBounds[5])/2]
+    structureLR3 = (structureBounds[1]-structureBounds[0]) * 3
+    structureIS2 = (structureBounds[5]-structureBounds[4]) * 2
+    radius = [structureLR3/2, structureLR3/2, structureIS2/2]
+    return [center[0]-radius[0], center[0]+radius[0], center[1]-radius[1], center[1]+radius[1], center[2]-radius[2], center[2]+radius[2]]
+
+  #------------------------------------------------------------------------------
+  @staticmethod
+  def transformBoundsToWorld(bounds, node):
+    """Get world bounds of a box given in the local coordinate system of a transformable node
+    """
+    parentTransformNode = node.GetParentTransformNode()
+    if parentTransformNode is None:
+      return list(bounds)
+    transformToWorld = vtk.vtkGeneralTransform()
+    parentTransformNode.GetTransformToWorld(transformToWorld)
+    corners = [transformToWorld.TransformPoint(x, y, z) for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]]
+    worldBounds = []
+    for axis in range(3):
+      worldBounds.extend([min([corner[axis] for corner in corners]), max([corner[axis] for corner in corners])])
+    return worldBounds
+
+  #------------------------------------------------------------------------------
+  def createInterpolator(self, interpolationType):
+    if interpolationType in self.windowedSincInterpolationTypes:
+      interpolator = vtk.vtkImageSincInterpolator()
+      if interpolationType == 'lanczos':
+        interpolator.SetWindowFunctionToLanczos()
+      elif interpolationType == 'hamming':
+        interpolator.SetWindowFunctionToHamming()
+      elif interpolationType == 'cosine':
+        interpolator.SetWindowFunctionToCosine()
+      elif interpolationType == 'blackman':
+        interpolator.SetWindowFunctionToBlackman()
+      interpolator.SetWindowHalfWidth(self.windowHalfWidth)
+      # Avoid blurring when downsampling (consistent with the CLI)
+      interpolator.AntialiasingOff()
+      return interpolator
+    interpolator = vtk.vtkImageInterpolator()
+    if interpolationType == 'nearestNeighbor':
+      interpolator.SetInterpolationModeToNearest()
+    else:
+      interpolator.SetInterpolationModeToLinear()
+    return interpolator
@@ -0,0 +1,18 @@
+# Helper library of the Segment Registration extension.
+# BatchRegistration and RegistrationBenchmark are standalone scripts, so they are not imported here.
+from .StageCache import StageCache
+from .DistanceMapRegistration import DistanceMapRegistrationLogic
+from .AsyncPipeline import AsyncPipeline, BackgroundTask
+from .StageProfiler import StageProfiler, aggregateTimingReports
+from .VolumeResampler import VolumeResampler
+from .SegmentRasterizer import SegmentRasterizer
+from .MomentAlignment import MomentAlignment
+from .DisplacementFieldCache import DisplacementFieldCache
+from .OverlapMetrics import OverlapMetrics
+from .SurfaceDistanceMetrics import SurfaceDistanceMetrics
+from .FiducialErrors import FiducialErrors
+from .DicomStudyExporter import DicomStudyExporter
+from .NodeRegistry import NodeRegistry
+from .SceneEventCounter import SceneEventCounter
+from .RegistrationContext import RegistrationContext, addContextProperties, contextStage
+from .SubjectHierarchyPatientIndex import SubjectHierarchyPatientIndex